@@ -0,0 +1,124 @@
+"""
+bench_startup.py
+启动耗时基准：每个入口脚本在子进程里重复启动几次，取中位数
+
+测三种情况：
+    import     只导入模块 (不执行 main)
+    --help     打印帮助后退出
+    --dry-run  只读输入、列出计划任务，不调用接口
+同时检查这些情况下有没有提前导入 openai / instructor (应当没有)。
+
+使用方法：
+    python bench_startup.py
+    python bench_startup.py --repeat 10 --output outputs/bench/startup.json
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+import subprocess
+from pathlib import Path
+
+SCRIPTS = [
+    "step1_gen_batch",
+    "step1_gen_selfplay",
+    "step4_whole_judge",
+    "step4_score_turns",
+    "step_eval_full_new",
+    "dd.step1_generate",
+    "dd.step1_optimize",
+]
+HEAVY_MODULES = ("openai", "instructor")
+DEFAULT_REPEAT = 5
+DEFAULT_OUTPUT = "outputs/bench/startup.json"
+
+# 在子进程里执行：导入 / 运行入口，最后把已导入的重型模块写到 stderr 最后一行
+_PROBE = """
+import sys, runpy
+mode, module = sys.argv[1], sys.argv[2]
+try:
+    if mode == "import":
+        __import__(module)
+    else:
+        sys.argv = [module, mode]
+        runpy.run_module(module, run_name="__main__")
+except SystemExit:
+    pass
+finally:
+    heavy = [m for m in {heavy!r} if m in sys.modules]
+    sys.stderr.write("\\nHEAVY=" + ",".join(heavy) + "\\n")
+""".format(heavy=HEAVY_MODULES)
+
+
+def run_once(mode, module):
+    start = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, "-c", _PROBE, mode, module],
+        capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)),
+    )
+    elapsed = time.perf_counter() - start
+    last = proc.stderr.strip().rsplit("\n", 1)[-1]
+    heavy = last[len("HEAVY="):].split(",") if last.startswith("HEAVY=") else ["?"]
+    return elapsed, [m for m in heavy if m], proc.returncode
+
+
+def bench(modules=SCRIPTS, modes=("import", "--help", "--dry-run"), repeat=DEFAULT_REPEAT):
+    # 基线：空解释器启动
+    baseline = statistics.median(run_once("import", "os")[0] for _ in range(repeat))
+    results = {"python": sys.version.split()[0], "repeat": repeat, "baseline_seconds": round(baseline, 3), "scripts": {}}
+
+    for module in modules:
+        entry = {}
+        for mode in modes:
+            times, heavy, code = [], set(), 0
+            for _ in range(repeat):
+                elapsed, loaded, rc = run_once(mode, module)
+                times.append(elapsed)
+                heavy.update(loaded)
+                code = code or rc
+            entry[mode] = {
+                "median_seconds": round(statistics.median(times), 3),
+                "min_seconds": round(min(times), 3),
+                "heavy_imported": sorted(heavy),
+                "exit_code": code,
+            }
+        results["scripts"][module] = entry
+    return results
+
+
+def print_results(results):
+    print(f"⏱️ 启动耗时 (中位数，{results['repeat']} 次；空解释器 {results['baseline_seconds']}s)")
+    modes = list(next(iter(results["scripts"].values())).keys()) if results["scripts"] else []
+    print(f"   {'脚本':<22}" + "".join(f"{m:>14}" for m in modes))
+    for module, entry in results["scripts"].items():
+        cells = []
+        for mode in modes:
+            r = entry[mode]
+            flag = "⚠" if r["heavy_imported"] else " "
+            cells.append(f"{r['median_seconds']:>12.3f}s{flag}")
+        print(f"   {module:<22}" + "".join(cells))
+    print("   ⚠ 表示该情况下已经导入了 openai / instructor")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="入口脚本启动耗时基准")
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT)
+    parser.add_argument("--only", default="", help="只测这些脚本 (逗号分隔的模块名)")
+    parser.add_argument("--output", default=DEFAULT_OUTPUT)
+    args = parser.parse_args()
+
+    modules = [m for m in args.only.split(",") if m] or SCRIPTS
+    results = bench(modules, repeat=args.repeat)
+    print_results(results)
+
+    Path(args.output).parent.mkdir(parents=True, exist_ok=True)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    print(f"📁 结果已保存: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
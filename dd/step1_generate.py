@@ -6,13 +6,17 @@ from pydantic import ValidationError
 # 导入配置和工具
 from step0_config import GENERATION_PROMPT_TEMPLATE, DEFAULT_RAW_DIR, GENERATION_MODEL_NAME_QWEN, GENERATION_MODEL_NAME_DS
 from utils.file_utils import load_questions, write_jsonl
-from utils.api_utils import get_qwen_client, get_deepseek_client
+from utils.api_utils import get_qwen_client, get_deepseek_client, guarded_create
+from utils.structured_output import print_structured_report
 from utils.pydantic_schema import CoT_Answer_Schema
+from utils.dry_run import new_plan, add_calls, run_cli
+
+QUESTIONS_FILE = "inputs/questions.txt"
 
 # --- 核心函数：结构化调用 LLM ---
 def structured_call(client, model_name: str, question: str) -> dict:
     """
-    使用 instructor 调用模型，强制返回 CoT_Answer_Schema。
+    按模型配置的结构化输出模式调用，强制返回 CoT_Answer_Schema。
     """
     if client is None:
         return {"CoT": None, "Answer": None, "error": "Client not initialized or API_KEY missing."}
@@ -22,15 +26,16 @@ def structured_call(client, model_name: str, question: str) -> dict:
     
     try:
         # 核心调用：response_model 强制结构化输出
-        # instructor 会在后台自动处理 JSON 解析和验证
-        structured_response: CoT_Answer_Schema = client.chat.completions.create(
-            model=model_name,
+        # 解析、校验与重试统计由 utils/structured_output.py 统一处理
+        structured_response: CoT_Answer_Schema = guarded_create(
+            client,
+            model_name,
             response_model=CoT_Answer_Schema, 
             messages=[
                 {"role": "system", "content": "You are a warm and empathetic child companion."}, # 简单的人设系统提示词
                 {"role": "user", "content": prompt},
             ],
-            # max_retries=1: 如果格式不对，instructor 会自动让模型重试一次
+            # max_retries=1: 只尝试一次，格式不对直接记为失败
             max_retries=1 
         )
         
@@ -48,12 +53,12 @@ def structured_call(client, model_name: str, question: str) -> dict:
         # 其他 API 或网络错误
         return {"CoT": None, "Answer": None, "error": f"API Call Error: {type(e).__name__}: {str(e)}"}
 
-def generate_sample(question):
+def generate_sample(question, qwen_client=None, deepseek_client=None):
     """为单个问题生成 Qwen 和 Deepseek 的结构化 CoT/Answer。"""
     
-    # 1. 初始化客户端
-    qwen_client = get_qwen_client()
-    deepseek_client = get_deepseek_client()
+    # 1. 初始化客户端 (批量/流水线调用时可以传入复用的客户端)
+    qwen_client = qwen_client or get_qwen_client()
+    deepseek_client = deepseek_client or get_deepseek_client()
     
     # 2. 结构化调用 Qwen 模型
     # 使用配置中的模型名 (如 qwen-max-latest)
@@ -70,12 +75,22 @@ def generate_sample(question):
         "deepseek_result": deepseek_output
     }
 
+def plan():
+    """--dry-run：每个问题分别调用 Qwen 和 DeepSeek 各一次"""
+    questions = load_questions(QUESTIONS_FILE)
+    result = new_plan("dd_generate")
+    result["files"][QUESTIONS_FILE] = len(questions)
+    result["items"] = len(questions)
+    add_calls(result, GENERATION_MODEL_NAME_QWEN, len(questions))
+    add_calls(result, GENERATION_MODEL_NAME_DS, len(questions))
+    return result
+
 def main():
     # 1. 确保输出目录存在
     Path(DEFAULT_RAW_DIR).mkdir(parents=True, exist_ok=True)
     
     # 2. 加载问题
-    questions_file = "inputs/questions.txt"
+    questions_file = QUESTIONS_FILE
     questions = load_questions(questions_file)
     
     if not questions:
@@ -86,19 +101,22 @@ def main():
     print(f"Qwen 模型: {GENERATION_MODEL_NAME_QWEN}")
     print(f"DeepSeek 模型: {GENERATION_MODEL_NAME_DS}")
 
-    # 3. 循环处理
+    # 3. 循环处理 (客户端只创建一次，所有问题复用)
+    qwen_client = get_qwen_client()
+    deepseek_client = get_deepseek_client()
     samples = []
     for i, q in enumerate(questions):
         print(f"[{i+1}/{len(questions)}] Processing: {q[:30]}...")
-        samples.append(generate_sample(q))
+        samples.append(generate_sample(q, qwen_client, deepseek_client))
 
     # 4. 保存结果
     output_path = os.path.join(DEFAULT_RAW_DIR, "raw_data.jsonl")
     write_jsonl(samples, output_path)
     
     print("---------------------------------------------------------")
+    print_structured_report()
     print("✅ Step 1 complete.")
     print(f"Output saved to: {output_path}")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    run_cli(main, plan, "dd Step 1: 结构化 CoT 数据生成")
\ No newline at end of file
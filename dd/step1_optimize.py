@@ -1,7 +1,9 @@
 import os
 import json
 import time
+import difflib
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pydantic import ValidationError
 
 # 导入配置
@@ -12,140 +14,242 @@ from step0_config import (
     DEFAULT_RAW_DIR,
     GENERATION_MODEL_NAME_QWEN, # Qwen 模型名
     GENERATION_MODEL_NAME_DS,   # DeepSeek 模型名
-    JUDGE_MODEL_NAME
+    JUDGE_MODEL_NAME,
+    JUDGE_FALLBACK_MODEL_NAME
 )
 from utils.file_utils import load_questions, write_jsonl
-from utils.api_utils import get_qwen_client, get_deepseek_client, get_judge_client
-from utils.pydantic_schema import CoT_Answer_Schema, JudgeSchema
+from utils.api_utils import get_qwen_client, get_deepseek_client, get_judge_client, guarded_create
+from utils.circuit_breaker import print_breaker_report
+from utils.structured_output import print_structured_report
+from utils.pydantic_schema import CoT_Answer_Schema, CritiqueSchema
+from utils.dry_run import new_plan, add_calls, run_cli
 
-# --- 核心流程封装：对单个模型进行"生成-评价-优化" ---
-def process_single_model_optimization(model_name, client, model_id, question, judge_client):
+# ================= 优化引擎配置 =================
+MAX_REFINE_ROUNDS = 3      # 最多优化几轮 (V2, V3, ...)
+MIN_SCORE_GAIN = 1         # 新版本至少比历史最好分数高这么多才算"有提升"
+CRITIQUE_STALL_RATIO = 0.9 # 相邻两轮评语相似度超过该值，视为评语不再变化
+MAX_WORKERS = 8            # 同时在跑的 (问题, 模型) 任务数
+
+JUDGE_SINGLE_PLACEHOLDER = "（无对比项，请作为专家对模型A进行严格的单项评审，指出不足之处，并给出0-10分的评分）"
+
+
+def _timed_create(client, model, fallback_model=None, **kwargs):
+    """调用一次结构化接口 (经过熔断器)，返回 (结果, 耗时秒, token 用量)"""
+    start = time.time()
+    resp = guarded_create(client, model, fallback_model=fallback_model, **kwargs)
+    latency = round(time.time() - start, 3)
+
+    # instructor 会把原始 completion 挂在 _raw_response 上，从中取 usage
+    usage = getattr(getattr(resp, "_raw_response", None), "usage", None)
+    tokens = {
+        "prompt_tokens": getattr(usage, "prompt_tokens", 0) or 0,
+        "completion_tokens": getattr(usage, "completion_tokens", 0) or 0,
+    }
+    tokens["total_tokens"] = tokens["prompt_tokens"] + tokens["completion_tokens"]
+    return resp, latency, tokens
+
+
+def generate_version(client, model_id, question, critique=None):
+    """生成一个版本：critique 为空时是初始版本 (V1)，否则按评审意见重写"""
+    if critique is None:
+        messages = [
+            {"role": "system", "content": "You are AiMe, a warm child companion."},
+            {"role": "user", "content": GENERATION_PROMPT_TEMPLATE.format(question=question)}
+        ]
+        temperature = 0.7 # 正常温度
+    else:
+        messages = [
+            # 这里的 System Prompt 稍微改得强硬一点，要求它改变
+            {"role": "system", "content": "You are AiMe. You MUST improve your answer significantly based on the expert feedback."},
+            {"role": "user", "content": REFINEMENT_PROMPT_TEMPLATE.format(question=question, critique=critique)}
+        ]
+        temperature = 0.8 # 调高温度，增加变化幅度
+
+    return _timed_create(
+        client,
+        model_id,
+        response_model=CoT_Answer_Schema,
+        messages=messages,
+        temperature=temperature,
+        max_retries=3
+    )
+
+
+def critique_version(judge_client, version):
+    """裁判对单个版本打分并挑刺"""
+    # 构造给裁判看的内容
+    formatted_output = f"【思维链】{version.CoT}\n【回答】{version.Answer}"
+    judge_prompt = JUDGE_PROMPT_TEMPLATE.format(
+        output_a=formatted_output,
+        output_b=JUDGE_SINGLE_PLACEHOLDER
+    )
+    return _timed_create(
+        judge_client,
+        JUDGE_MODEL_NAME,
+        fallback_model=JUDGE_FALLBACK_MODEL_NAME,
+        response_model=CritiqueSchema,
+        messages=[
+            {"role": "system", "content": "You are a strict child psychology expert. Be critical."},
+            {"role": "user", "content": judge_prompt}
+        ],
+        temperature=0.3, # 裁判要冷静
+        max_retries=3
+    )
+
+
+def _round_record(index, version, gen_latency, gen_tokens, critique, judge_latency, judge_tokens):
+    return {
+        "round": index,
+        "version": version.model_dump(),
+        "score": critique.score,
+        "critique": f"共情不足点：{critique.accuracy_analysis}\n引导改进点：{critique.reasoning_analysis}",
+        "gen_latency": gen_latency,
+        "judge_latency": judge_latency,
+        "gen_tokens": gen_tokens["total_tokens"],
+        "judge_tokens": judge_tokens["total_tokens"],
+    }
+
+
+# --- 核心流程封装：对单个模型进行"生成-评价-多轮优化" ---
+def process_single_model_optimization(model_name, client, model_id, question, judge_client,
+                                      max_rounds=MAX_REFINE_ROUNDS):
     """
-    输入：模型名称、客户端、模型ID、问题、裁判客户端
-    输出：包含 V1, 评价, V2 的字典
+    输入：模型名称、客户端、模型ID、问题、裁判客户端、最多优化轮数
+    输出：包含 V1, 评价, 最后一次修正 (V2), 最优版本以及每一轮耗时/token 明细的字典
+
+    每轮都会让裁判打分；当分数不再提升 (< MIN_SCORE_GAIN) 或评语基本不变时提前停止，
+    只在确实有收益的题目上多花优化轮次。
     """
-    print(f"  🤖 [{model_name}] 正在进行优化流程...")
-    
-    # --- Round 1: 初始生成 (V1) ---
-    # print(f"    1️⃣  生成初始版本...")
-    prompt_v1 = GENERATION_PROMPT_TEMPLATE.format(question=question)
+    print(f"  🤖 [{model_name}] 正在进行优化流程: {question[:20]}...")
+
+    # --- Round 0: 初始生成 (V1) + 裁判点评 ---
     try:
-        v1_resp = client.chat.completions.create(
-            model=model_id,
-            response_model=CoT_Answer_Schema,
-            messages=[
-                {"role": "system", "content": "You are AiMe, a warm child companion."},
-                {"role": "user", "content": prompt_v1}
-            ],
-            temperature=0.7, # 正常温度
-            max_retries=3
-        )
+        v1, gen_latency, gen_tokens = generate_version(client, model_id, question)
     except Exception as e:
         print(f"    ❌ {model_name} V1 生成失败: {e}")
         return None
 
-    # --- Round 2: 裁判点评 ---
-    # print(f"    2️⃣  裁判正在挑刺...")
-    # 构造给裁判看的内容
-    formatted_output = f"【思维链】{v1_resp.CoT}\n【回答】{v1_resp.Answer}"
-    judge_prompt = JUDGE_PROMPT_TEMPLATE.format(
-        output_a=formatted_output,
-        output_b="（无对比项，请作为专家对模型A进行严格的单项评审，指出不足之处）"
-    )
-    
     try:
-        critique_res = judge_client.chat.completions.create(
-            model=JUDGE_MODEL_NAME,
-            response_model=JudgeSchema,
-            messages=[
-                {"role": "system", "content": "You are a strict child psychology expert. Be critical."},
-                {"role": "user", "content": judge_prompt}
-            ],
-            temperature=0.3, # 裁判要冷静
-            max_retries=3
-        )
+        critique, judge_latency, judge_tokens = critique_version(judge_client, v1)
     except Exception as e:
         print(f"    ❌ 裁判点评失败: {e}")
         return None
-    
-    # 提取修改意见
-    feedback = f"共情不足点：{critique_res.accuracy_analysis}\n引导改进点：{critique_res.reasoning_analysis}"
-    
-    # --- Round 3: 优化修正 (V2) ---
-    # print(f"    3️⃣  根据意见重写...")
-    refine_prompt = REFINEMENT_PROMPT_TEMPLATE.format(
-        question=question,
-        critique=feedback
-    )
-    
-    try:
-        v2_resp = client.chat.completions.create(
-            model=model_id,
-            response_model=CoT_Answer_Schema,
-            messages=[
-                # 这里的 System Prompt 稍微改得强硬一点，要求它改变
-                {"role": "system", "content": "You are AiMe. You MUST improve your answer significantly based on the expert feedback."},
-                {"role": "user", "content": refine_prompt}
-            ],
-            temperature=0.8, # ★ 关键修改：调高温度，增加变化幅度
-            max_retries=3
-        )
-    except Exception as e:
-        print(f"    ❌ {model_name} V2 修正失败: {e}")
-        v2_resp = None
+
+    rounds = [_round_record(0, v1, gen_latency, gen_tokens, critique, judge_latency, judge_tokens)]
+    best = rounds[0]
+    stop_reason = "max_rounds"
+
+    # --- Round 1..N: 根据意见重写，直到不再提升 ---
+    for r in range(1, max_rounds + 1):
+        feedback = rounds[-1]["critique"]
+        try:
+            version, gen_latency, gen_tokens = generate_version(client, model_id, question, critique=feedback)
+            critique, judge_latency, judge_tokens = critique_version(judge_client, version)
+        except Exception as e:
+            print(f"    ❌ {model_name} 第 {r} 轮修正失败: {e}")
+            stop_reason = "error"
+            break
+
+        record = _round_record(r, version, gen_latency, gen_tokens, critique, judge_latency, judge_tokens)
+        rounds.append(record)
+
+        improved = record["score"] >= best["score"] + MIN_SCORE_GAIN
+        stalled = difflib.SequenceMatcher(None, feedback, record["critique"]).ratio() >= CRITIQUE_STALL_RATIO
+        if improved:
+            best = record
+        if not improved:
+            stop_reason = "score_plateau"
+            break
+        if stalled:
+            stop_reason = "critique_stalled"
+            break
+
+    print(f"    ✅ [{model_name}] 共 {len(rounds)} 个版本，最优第 {best['round']} 轮 "
+          f"(分数 {rounds[0]['score']} -> {best['score']}，停止原因: {stop_reason})")
 
     return {
         "model_name": model_name,
-        "v1_initial": v1_resp.model_dump(),
-        "critique": feedback,
-        "v2_optimized": v2_resp.model_dump() if v2_resp else "Optimization Failed"
+        "v1_initial": rounds[0]["version"],
+        "critique": rounds[0]["critique"],
+        # 与原来一致：v2_optimized 是最后一次修正的结果，只有第 1 轮修正本身失败时才是失败标记
+        "v2_optimized": rounds[-1]["version"] if len(rounds) > 1 else "Optimization Failed",
+        "best_version": best["version"],
+        "best_round": best["round"],
+        "stop_reason": stop_reason,
+        "rounds": rounds,
+        "total_latency": round(sum(x["gen_latency"] + x["judge_latency"] for x in rounds), 3),
+        "total_tokens": sum(x["gen_tokens"] + x["judge_tokens"] for x in rounds),
     }
 
+
+def plan():
+    """--dry-run：每个 (问题, 模型) 至少 1 轮、最多 1 + MAX_REFINE_ROUNDS 轮，每轮生成 + 裁判各一次"""
+    questions = load_questions("inputs/questions.txt")
+    result = new_plan("dd_optimize")
+    result["files"]["inputs/questions.txt"] = len(questions)
+    result["items"] = len(questions) * 2
+    rounds = 1 + MAX_REFINE_ROUNDS
+    add_calls(result, GENERATION_MODEL_NAME_QWEN, len(questions) * rounds)
+    add_calls(result, GENERATION_MODEL_NAME_DS, len(questions) * rounds)
+    add_calls(result, JUDGE_MODEL_NAME, len(questions) * 2 * rounds)
+    result["notes"].append(f"按最多 {rounds} 轮估算；分数不再提升时提前停止，实际调用数通常更少")
+    return result
+
+
 def main():
     Path(DEFAULT_RAW_DIR).mkdir(parents=True, exist_ok=True)
     questions = load_questions("inputs/questions.txt")
-    
+    if not questions:
+        print("❌ 没有找到问题，请检查 inputs/questions.txt")
+        return
+
     # 初始化所有客户端
     qwen_client = get_qwen_client()
     ds_client = get_deepseek_client()
     judge_client = get_judge_client()
-    
-    optimized_samples = []
-    
+
+    models = [
+        ("Qwen", qwen_client, GENERATION_MODEL_NAME_QWEN, "qwen_data"),
+        ("DeepSeek", ds_client, GENERATION_MODEL_NAME_DS, "deepseek_data"),
+    ]
+
     print(f"--- 🚀 开始双模型自我优化 (Dual Self-Correction) ---")
-    print(f"优化目标: Qwen & DeepSeek")
-    
+    print(f"优化目标: Qwen & DeepSeek | 最多 {MAX_REFINE_ROUNDS} 轮 | 并发 {MAX_WORKERS}")
+
+    # 所有 (问题, 模型) 组合一起并发，不再逐题串行
+    results = {}
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = {
+            executor.submit(process_single_model_optimization, name, client, model_id, q, judge_client): (i, key)
+            for i, q in enumerate(questions)
+            for name, client, model_id, key in models
+        }
+        for future in as_completed(futures):
+            i, key = futures[future]
+            results.setdefault(i, {})[key] = future.result()
+
+    # 按原始题目顺序整合结果
+    optimized_samples = []
     for i, q in enumerate(questions):
-        print(f"\n[{i+1}/{len(questions)}] 处理问题: {q}")
-        
-        # 1. 优化 Qwen
-        qwen_result = process_single_model_optimization(
-            "Qwen", qwen_client, GENERATION_MODEL_NAME_QWEN, q, judge_client
-        )
-        
-        # 2. 优化 DeepSeek
-        ds_result = process_single_model_optimization(
-            "DeepSeek", ds_client, GENERATION_MODEL_NAME_DS, q, judge_client
-        )
-        
-        # 3. 整合结果
-        if qwen_result and ds_result:
-            record = {
-                "question": q,
-                "qwen_data": qwen_result,
-                "deepseek_data": ds_result
-            }
+        per_model = results.get(i, {})
+        if all(per_model.get(key) for _, _, _, key in models):
+            record = {"question": q}
+            record.update({key: per_model[key] for _, _, _, key in models})
             optimized_samples.append(record)
-            print("  ✅ 本题双模型优化完成！")
-        
-        # 避免速率限制
-        time.sleep(1)
 
     # 保存
     output_path = os.path.join(DEFAULT_RAW_DIR, "dual_optimized_data.jsonl")
     write_jsonl(optimized_samples, output_path)
+
+    all_runs = [s[key] for s in optimized_samples for _, _, _, key in models]
+    if all_runs:
+        total_tokens = sum(r["total_tokens"] for r in all_runs)
+        avg_rounds = sum(len(r["rounds"]) for r in all_runs) / len(all_runs)
+        print(f"📊 平均版本数: {avg_rounds:.2f} | 总 token: {total_tokens}")
+    print_breaker_report()
+    print_structured_report()
     print(f"\n💎 最终优化结果已保存至: {output_path}")
-    print("您可以查看文件，对比 v1_initial 和 v2_optimized 的区别。")
+    print("您可以查看文件，对比 v1_initial、v2_optimized、best_version 以及 rounds 中每一轮的分数与成本。")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    run_cli(main, plan, "dd: 双模型自我优化")
@@ -3,6 +3,14 @@ from step0_config import DEFAULT_RAW_DIR, DEFAULT_CLEAN_DIR
 # 现在 file_utils 已经修复，可以正常导入 read_jsonl 了
 from utils.file_utils import read_jsonl, write_jsonl
 
+def clean_sample(sample):
+    """单条数据的清洗逻辑：合格返回原数据，否则返回 None"""
+    # 这里可以做一些简单的逻辑检查，比如确保 CoT 不为空
+    # 但一般 instructor 已经保证了 Schema 符合要求
+    if sample.get('qwen_result') and sample.get('deepseek_result'):
+        return sample
+    return None
+
 def main():
     # 1. 准备路径
     input_file = os.path.join(DEFAULT_RAW_DIR, "raw_data.jsonl")
@@ -25,9 +33,7 @@ def main():
 
     cleaned_data = []
     for i, sample in enumerate(raw_data):
-        # 这里可以做一些简单的逻辑检查，比如确保 CoT 不为空
-        # 但一般 instructor 已经保证了 Schema 符合要求
-        if sample.get('qwen_result') and sample.get('deepseek_result'):
+        if clean_sample(sample):
             cleaned_data.append(sample)
         else:
             print(f"⚠️ 第 {i+1} 条数据缺失结果，已跳过。")
@@ -0,0 +1,167 @@
+"""
+dd 流水线融合版: generate -> clean -> extract
+
+step1_generate / step2_clean / step3_extract 分别要读写一次完整的 JSONL，
+但 clean 和 extract 都是逐条的纯变换。这里把三步串成一条流水线：
+- 生成线程并发调用模型，每生成一条就立刻送入下游
+- 各阶段之间用有界队列连接，下游处理不过来时上游自动阻塞 (背压)
+- 中间文件 (raw / clean) 只有显式要求时才写
+- stream_pipeline() 是生成器，抽取好的数据一产出就可以交给裁判
+
+使用方法：
+    python -m dd.step_fused
+"""
+
+import os
+import json
+import queue
+import threading
+from pathlib import Path
+
+from step0_config import DEFAULT_RAW_DIR, DEFAULT_CLEAN_DIR, DEFAULT_EXTRACT_DIR
+from utils.file_utils import load_questions
+from utils.api_utils import get_qwen_client, get_deepseek_client
+from dd.step1_generate import generate_sample
+from dd.step2_clean import clean_sample
+from dd.step3_extract import extract_and_format
+
+# ================= 配置区域 =================
+GEN_WORKERS = 4        # 并发生成线程数
+QUEUE_SIZE = 16        # 阶段之间的队列长度上限 (背压)
+WRITE_RAW = False      # 是否额外写出 raw_data.jsonl
+WRITE_CLEAN = False    # 是否额外写出 clean_data.jsonl
+
+_DONE = object()  # 队列结束标记
+
+
+def _open_writer(enabled, path):
+    if not enabled:
+        return None
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    return open(path, "w", encoding="utf-8")
+
+
+def _write_line(f, item):
+    if f is not None:
+        f.write(json.dumps(item, ensure_ascii=False))
+        f.write("\n")
+        f.flush()
+
+
+def _generate_worker(question_q, raw_q, stop, qwen_client, deepseek_client):
+    while not stop.is_set():
+        try:
+            q = question_q.get_nowait()
+        except queue.Empty:
+            return
+        try:
+            raw_q.put(generate_sample(q, qwen_client, deepseek_client))
+        except Exception as e:
+            print(f"⚠️ 生成失败: {q[:20]}... {e}")
+
+
+def _clean_worker(raw_q, clean_q, raw_file):
+    try:
+        while True:
+            sample = raw_q.get()
+            if sample is _DONE:
+                break
+            _write_line(raw_file, sample)
+            cleaned = clean_sample(sample)
+            if cleaned:
+                clean_q.put(cleaned)
+            else:
+                print(f"⚠️ 数据缺失结果，已跳过: {sample.get('question', '')[:20]}...")
+    finally:
+        if raw_file:
+            raw_file.close()
+        clean_q.put(_DONE)
+
+
+def stream_pipeline(questions, workers=GEN_WORKERS, queue_size=QUEUE_SIZE,
+                    raw_path=None, clean_path=None):
+    """
+    流式执行 generate -> clean -> extract，逐条 yield 抽取后的数据。
+    raw_path / clean_path 为 None 时不写对应的中间文件。
+    """
+    question_q = queue.Queue()
+    for q in questions:
+        question_q.put(q)
+    raw_q = queue.Queue(maxsize=queue_size)
+    clean_q = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+
+    # 客户端只建一次，所有生成线程共用
+    qwen_client = get_qwen_client()
+    deepseek_client = get_deepseek_client()
+
+    gen_threads = [
+        threading.Thread(target=_generate_worker, args=(question_q, raw_q, stop, qwen_client, deepseek_client), daemon=True)
+        for _ in range(max(1, min(workers, len(questions))))
+    ]
+    for t in gen_threads:
+        t.start()
+
+    clean_thread = threading.Thread(
+        target=_clean_worker, args=(raw_q, clean_q, _open_writer(raw_path is not None, raw_path)), daemon=True
+    )
+    clean_thread.start()
+
+    def _close_raw():
+        for t in gen_threads:
+            t.join()
+        raw_q.put(_DONE)
+
+    threading.Thread(target=_close_raw, daemon=True).start()
+
+    # extract 在调用方线程里做：调用方消费得慢，上游就会被队列卡住
+    clean_file = _open_writer(clean_path is not None, clean_path)
+    sample = None
+    try:
+        while True:
+            sample = clean_q.get()
+            if sample is _DONE:
+                break
+            _write_line(clean_file, sample)
+            try:
+                yield extract_and_format(sample)
+            except Exception as e:
+                print(f"⚠️ 抽取失败: {sample.get('question', '')[:20]}... {e}")
+    finally:
+        # 调用方提前停止消费时：不再领新题，并把队列里剩下的排空，让各线程正常退出
+        stop.set()
+        while sample is not _DONE:
+            sample = clean_q.get()
+        if clean_file:
+            clean_file.close()
+        clean_thread.join()
+
+
+def main():
+    questions_file = "inputs/questions.txt"
+    questions = load_questions(questions_file)
+    if not questions:
+        print(f"❌ 错误：未加载任何问题。请检查 {questions_file} 文件是否存在且包含内容。")
+        return
+
+    output_file = os.path.join(DEFAULT_EXTRACT_DIR, "extracted_data.jsonl")
+    raw_path = os.path.join(DEFAULT_RAW_DIR, "raw_data.jsonl") if WRITE_RAW else None
+    clean_path = os.path.join(DEFAULT_CLEAN_DIR, "clean_data.jsonl") if WRITE_CLEAN else None
+
+    print(f"--- 🚀 dd 流水线 (generate -> clean -> extract)，共 {len(questions)} 个问题 ---")
+    print(f"并发: {GEN_WORKERS} | 队列上限: {QUEUE_SIZE} | 中间文件: raw={WRITE_RAW}, clean={WRITE_CLEAN}")
+
+    Path(output_file).parent.mkdir(parents=True, exist_ok=True)
+    count = 0
+    with open(output_file, "w", encoding="utf-8") as f:
+        for record in stream_pipeline(questions, raw_path=raw_path, clean_path=clean_path):
+            _write_line(f, record)
+            count += 1
+            print(f"[{count}/{len(questions)}] ✅ {record['question'][:25]}...")
+
+    print("---------------------------------------------------------")
+    print(f"✅ 流水线完成！已抽取 {count} 条数据。")
+    print(f"结果保存在: {output_file}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,311 @@
+"""
+run_pipeline.py
+增量流水线调度器
+
+把现有各个 step 脚本的 main() 描述成一张 DAG，每个阶段计算一个内容指纹：
+- 输入文件内容 (questions.txt / 上游输出的 jsonl)
+- Prompt 模板 (GENERATION_PROMPT_TEMPLATE、JUDGE_PROMPT_TEMPLATE、HOLISTIC_CRITERIA 等)
+- 模型配置与阶段参数
+
+指纹没变的阶段直接跳过；裁判类阶段还会按记录缓存打分，
+所以只改一个裁判 Prompt 时，只会重新打分，不会重新生成任何对话。
+
+使用方法：
+    python run_pipeline.py                      # 跑整张图，只重跑有变化的阶段
+    python run_pipeline.py --only judge_whole   # 只跑指定阶段 (以及它依赖的阶段)
+    python run_pipeline.py --force gen_batch    # 强制重跑某个阶段
+    python run_pipeline.py --list               # 只查看各阶段状态，不执行
+    python run_pipeline.py --dry-run            # 列出需要重跑的阶段会处理的文件、条目和每个模型的调用数
+"""
+
+import os
+import sys
+import glob
+import json
+import argparse
+import importlib
+from datetime import datetime
+from pathlib import Path
+
+from step0_config import (
+    DEFAULT_RAW_DIR,
+    DEFAULT_CLEAN_DIR,
+    DEFAULT_EXTRACT_DIR,
+    DEFAULT_JUDGED_DIR,
+)
+from utils.cache_utils import fingerprint, file_fingerprint
+from utils.dry_run import print_plan, merge_calls
+
+# ================= 配置区域 =================
+QUESTIONS_FILE = "inputs/questions.txt"
+STATE_FILE = "outputs/.pipeline_state.json"
+
+
+class Stage:
+    """流水线中的一个阶段，对应某个现有脚本的入口函数"""
+
+    def __init__(self, name, target, inputs=(), outputs=(), deps=(), config=(), kwargs=None):
+        self.name = name
+        self.target = target          # "模块:函数"，例如 "step4_whole_judge:main"
+        self.inputs = list(inputs)    # 输入文件 (支持通配符)
+        self.outputs = list(outputs)  # 输出文件 (支持通配符)，缺失时强制重跑
+        self.deps = list(deps)        # 依赖的上游阶段名
+        self.config = list(config)    # 参与指纹计算的配置: [(模块, [属性名, ...]), ...]
+        self.kwargs = kwargs or {}
+
+    def resolve(self):
+        module_name, func_name = self.target.split(":")
+        return getattr(importlib.import_module(module_name), func_name)
+
+    def planner(self):
+        """阶段脚本里的 plan() (与入口函数参数相同)，没有时返回 None"""
+        module_name, _ = self.target.split(":")
+        return getattr(importlib.import_module(module_name), "plan", None)
+
+    def fingerprint(self):
+        config = {}
+        for module_name, attrs in self.config:
+            module = importlib.import_module(module_name)
+            for attr in attrs:
+                config[f"{module_name}.{attr}"] = getattr(module, attr)
+
+        files = {}
+        for pattern in self.inputs:
+            for path in sorted(glob.glob(pattern)):
+                files[path] = file_fingerprint(path)
+
+        return fingerprint(self.name, self.target, self.kwargs, config, files)
+
+    def outputs_exist(self):
+        return all(glob.glob(pattern) for pattern in self.outputs)
+
+
+# ================= 流水线定义 =================
+PIPELINE = [
+    # --- 多轮对话生成 & 打分 ---
+    Stage(
+        "gen_batch", "step1_gen_batch:main",
+        inputs=[QUESTIONS_FILE],
+        outputs=[os.path.join(DEFAULT_RAW_DIR, "data_*.jsonl")],
+        config=[("step1_gen_batch", ["PROMPT_TEMPLATE", "MODELS_CONFIG"])],
+        kwargs={"questions_file": QUESTIONS_FILE, "output_dir": DEFAULT_RAW_DIR, "num_generations": 10},
+    ),
+    Stage(
+        "gen_selfplay", "step1_gen_selfplay:main",
+        inputs=[QUESTIONS_FILE],
+        outputs=[os.path.join(DEFAULT_RAW_DIR, "data_scheme_A.jsonl")],
+        config=[("step1_gen_selfplay", [
+            "USER_SYSTEM_PROMPT", "AIME_SYSTEM_PROMPT", "MODEL_USER", "MODEL_AGENT", "NUM_TURNS",
+            "CONTEXT_WINDOW_TURNS", "SUMMARY_EVERY_TURNS", "SUMMARY_PROMPT",
+        ])],
+        kwargs={"questions_file": QUESTIONS_FILE, "output_file": os.path.join(DEFAULT_RAW_DIR, "data_scheme_A.jsonl")},
+    ),
+    Stage(
+        "judge_whole", "step4_whole_judge:main",
+        deps=["gen_batch", "gen_selfplay"],
+        inputs=[os.path.join(DEFAULT_RAW_DIR, "data_*.jsonl")],
+        outputs=[os.path.join(DEFAULT_JUDGED_DIR, "holistic_score_*.jsonl")],
+        config=[
+            ("step4_whole_judge", ["HOLISTIC_CRITERIA", "JUDGE_MODEL"]),
+            ("utils.text_compaction", ["JUDGE_INPUT_MAX_TOKENS", "HEAD_RATIO", "MIN_BOILERPLATE_CHARS",
+                                        "JUDGE_INPUT_VERSION"]),
+        ],
+        kwargs={
+            "raw_dir": DEFAULT_RAW_DIR,
+            "judged_dir": DEFAULT_JUDGED_DIR,
+            "cache_path": os.path.join(DEFAULT_JUDGED_DIR, ".holistic_cache.jsonl"),
+        },
+    ),
+    Stage(
+        "score_turns", "step4_score_turns:main",
+        deps=["gen_batch", "gen_selfplay"],
+        inputs=[os.path.join(DEFAULT_RAW_DIR, "*.jsonl")],
+        outputs=[os.path.join(DEFAULT_JUDGED_DIR, "score_*.jsonl")],
+        config=[("step4_score_turns", ["SCORING_CRITERIA", "JUDGE_MODEL"])],
+        kwargs={
+            "raw_dir": DEFAULT_RAW_DIR,
+            "judged_dir": DEFAULT_JUDGED_DIR,
+            "cache_path": os.path.join(DEFAULT_JUDGED_DIR, ".turn_cache.jsonl"),
+        },
+    ),
+    Stage(
+        "analytics", "step6_score_analytics:main",
+        deps=["judge_whole", "score_turns"],
+        inputs=[
+            os.path.join(DEFAULT_JUDGED_DIR, "holistic_score_*.jsonl"),
+            os.path.join(DEFAULT_JUDGED_DIR, "score_*.jsonl"),
+            "outputs/eval_full/*/*_score.json",
+        ],
+        outputs=["outputs/analytics/score_report.json"],
+        config=[("step6_score_analytics", ["N_BOOTSTRAP", "CI_LEVEL", "SEED"])],
+        kwargs={"judged_dirs": [DEFAULT_JUDGED_DIR]},
+    ),
+    Stage(
+        "diversity", "step7_diversity:main",
+        deps=["gen_batch", "gen_selfplay"],
+        inputs=[os.path.join(DEFAULT_RAW_DIR, "data_*.jsonl"), "outputs/eval_full/*/*_dialogue.json"],
+        outputs=["outputs/analytics/diversity_report.json"],
+        config=[("step7_diversity", ["DISTINCT_N", "BLEU_N", "OVERLAP_N"])],
+        kwargs={"raw_dir": DEFAULT_RAW_DIR},
+    ),
+
+    # --- dd: CoT 生成 -> 清洗 -> 抽取，以及自我优化 ---
+    Stage(
+        "dd_generate", "dd.step1_generate:main",
+        inputs=[QUESTIONS_FILE],
+        outputs=[os.path.join(DEFAULT_RAW_DIR, "raw_data.jsonl")],
+        config=[("step0_config", ["GENERATION_PROMPT_TEMPLATE", "GENERATION_MODEL_NAME_QWEN", "GENERATION_MODEL_NAME_DS"])],
+    ),
+    Stage(
+        "dd_clean", "dd.step2_clean:main",
+        deps=["dd_generate"],
+        inputs=[os.path.join(DEFAULT_RAW_DIR, "raw_data.jsonl")],
+        outputs=[os.path.join(DEFAULT_CLEAN_DIR, "clean_data.jsonl")],
+    ),
+    Stage(
+        "dd_extract", "dd.step3_extract:main",
+        deps=["dd_clean"],
+        inputs=[os.path.join(DEFAULT_CLEAN_DIR, "clean_data.jsonl")],
+        outputs=[os.path.join(DEFAULT_EXTRACT_DIR, "extracted_data.jsonl")],
+    ),
+    Stage(
+        "dd_optimize", "dd.step1_optimize:main",
+        inputs=[QUESTIONS_FILE],
+        outputs=[os.path.join(DEFAULT_RAW_DIR, "dual_optimized_data.jsonl")],
+        config=[
+            ("step0_config", [
+                "GENERATION_PROMPT_TEMPLATE", "REFINEMENT_PROMPT_TEMPLATE", "JUDGE_PROMPT_TEMPLATE",
+                "GENERATION_MODEL_NAME_QWEN", "GENERATION_MODEL_NAME_DS", "JUDGE_MODEL_NAME",
+            ]),
+            ("dd.step1_optimize", ["MAX_REFINE_ROUNDS", "MIN_SCORE_GAIN", "CRITIQUE_STALL_RATIO"]),
+        ],
+    ),
+]
+
+
+# ================= 调度逻辑 =================
+def load_state(path=STATE_FILE):
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_state(state, path=STATE_FILE):
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(state, f, ensure_ascii=False, indent=2)
+
+
+def topo_order(stages, only=None):
+    """按依赖关系排序；指定 only 时只保留这些阶段及其上游"""
+    by_name = {s.name: s for s in stages}
+    wanted = set(only) if only else set(by_name)
+    unknown = wanted - set(by_name)
+    if unknown:
+        raise ValueError(f"未知阶段: {', '.join(sorted(unknown))}")
+
+    order, visiting, done = [], set(), set()
+
+    def visit(name):
+        if name in done:
+            return
+        if name in visiting:
+            raise ValueError(f"流水线存在循环依赖: {name}")
+        visiting.add(name)
+        for dep in by_name[name].deps:
+            visit(dep)
+        visiting.discard(name)
+        done.add(name)
+        order.append(by_name[name])
+
+    for s in stages:
+        if s.name in wanted:
+            visit(s.name)
+    return order
+
+
+def run(stages=PIPELINE, only=None, force=(), list_only=False, state_path=STATE_FILE, dry_run=False):
+    state = load_state(state_path)
+    executed = []
+    plans = []
+
+    for stage in topo_order(stages, only):
+        # 上游阶段执行完后再算指纹，这样能看到上游的新输出
+        fp = stage.fingerprint()
+        previous = state.get(stage.name, {}).get("fingerprint")
+
+        if stage.name in force:
+            reason = "强制重跑"
+        elif previous != fp:
+            reason = "首次运行" if previous is None else "输入/配置有变化"
+        elif not stage.outputs_exist():
+            reason = "输出缺失"
+        else:
+            reason = None
+
+        if list_only:
+            print(f"  {'🔁' if reason else '✅'} {stage.name:<14} {reason or '已是最新'}")
+            continue
+
+        if reason is None:
+            print(f"⏭️  [{stage.name}] 已是最新，跳过")
+            continue
+
+        if dry_run:
+            # 上游阶段不会真的执行，下游按当前已有的文件估算
+            planner = stage.planner()
+            if planner is None:
+                print(f"🧪 [dry-run] {stage.name}: {reason} (无 plan，跳过估算)")
+            else:
+                plans.append(planner(**stage.kwargs))
+                print_plan(plans[-1])
+            executed.append(stage.name)
+            continue
+
+        print(f"\n{'='*60}")
+        print(f"▶️  [{stage.name}] {reason} -> {stage.target}")
+        print(f"{'='*60}")
+        stage.resolve()(**stage.kwargs)
+
+        state[stage.name] = {
+            "fingerprint": fp,
+            "finished_at": datetime.now().isoformat(),
+        }
+        save_state(state, state_path)
+        executed.append(stage.name)
+
+    if dry_run:
+        calls = merge_calls(plans)
+        print(f"\n📞 合计预计调用: {sum(calls.values())}")
+        for model, n in sorted(calls.items(), key=lambda x: -x[1]):
+            print(f"   - {model}: {n}")
+    return executed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="增量流水线调度器")
+    parser.add_argument("--only", default="", help="只运行这些阶段 (逗号分隔)，会自动带上依赖")
+    parser.add_argument("--force", default="", help="强制重跑这些阶段 (逗号分隔)")
+    parser.add_argument("--list", action="store_true", help="只列出各阶段状态")
+    parser.add_argument("--dry-run", action="store_true", help="只估算需要重跑的阶段 (文件/条目/调用数)，不执行")
+    args = parser.parse_args()
+
+    only = [x for x in args.only.split(",") if x] or None
+    force = {x for x in args.force.split(",") if x}
+
+    print("--- 🧭 增量流水线 ---")
+    try:
+        executed = run(only=only, force=force, list_only=args.list, dry_run=args.dry_run)
+    except ValueError as e:
+        print(f"❌ {e}")
+        sys.exit(1)
+
+    if args.dry_run:
+        print(f"\n🧪 dry-run 完成，需要执行 {len(executed)} 个阶段: {', '.join(executed) or '无'}")
+    elif not args.list:
+        print(f"\n✅ 完成，本次执行了 {len(executed)} 个阶段: {', '.join(executed) or '无'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -79,6 +79,8 @@ GENERATION_MODEL_NAME_QWEN = "qwen-max-latest"
 GENERATION_MODEL_NAME_DS = "turing/deepseek-v3.1"  # 新增这一行
 # 用于裁判评估的模型
 JUDGE_MODEL_NAME = "qwen-max-latest"
+# 主裁判熔断或故障时的备用裁判
+JUDGE_FALLBACK_MODEL_NAME = "turing/deepseek-v3.1"
 
 # ================================
 # 6. 优化/修正模板 (新增)
@@ -1,11 +1,16 @@
 import json
-import requests
 import threading
 import time
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # 直接导入已有的工具
+from step0_config import DEFAULT_RAW_DIR
 from utils.file_utils import load_questions, write_jsonl
+from utils.chat_utils import chat_completion, chat_completion_n, print_hedge_report
+from utils.circuit_breaker import get_breaker, print_breaker_report
+from utils.dashboard import DASHBOARD
+from utils.tracing import traced, sleep
+from utils.dry_run import new_plan, add_calls, run_cli
 
 # ==========================================
 # 模型配置（在这里添加或修改模型）
@@ -37,6 +42,10 @@ MODELS_CONFIG = [
     },
 ]
 
+# 同一问题的多次生成合并成一个请求 (n 参数)，一次最多要这么多个回答；
+# 接口不支持 n 时自动回退为并行的单个请求。设为 1 恢复每次生成单独发一个请求
+SAMPLES_PER_REQUEST = 10
+
 # ==========================================
 # Prompt 配置（可以在这里切换不同的 prompt）
 # ==========================================
@@ -105,69 +114,110 @@ class MultiModelGenerator:
         self.model = model_config["model"]
         self.api_url = model_config["api_url"]
         self.api_key = model_config["api_key"]
-        self.headers = {
-            "Authorization": f"Bearer {self.api_key}",
-            "Content-Type": "application/json"
-        }
         self.lock = threading.Lock()
         self.request_count = 0
         
+    @staticmethod
+    def _parse_messages(name, content):
+        """把模型输出解析成 messages 列表；解析失败返回 []"""
+        # 清洗可能存在的 Markdown 标记
+        content = content.replace("```json", "").replace("```", "").strip()
+        
+        try:
+            dialogues = json.loads(content)
+            if isinstance(dialogues, dict):
+                if "messages" in dialogues:
+                    return dialogues["messages"]
+                return [dialogues] 
+            return dialogues
+        except:
+            print(f"    [{name}] JSON解析失败，内容预览: {content[:80]}...")
+            return []
+    
+    def _to_messages(self, result):
+        """chat_completion 的结果 -> messages 列表 (模型已熔断时返回 None)"""
+        if result["success"]:
+            return self._parse_messages(self.name, result["content"])
+        elif result.get("circuit_open"):
+            print(f"    [{self.name}] 模型已熔断，快速跳过")
+            return None
+        else:
+            status = result.get("status") or "无响应"
+            print(f"    [{self.name}] API 请求失败: {status}")
+            return []
+    
+    @traced(cat="item")
     def generate_single_dialogue(self, question: str):
-        """针对单个问题生成多轮对话"""
+        """针对单个问题生成多轮对话 (模型已熔断时返回 None，由调用方延后重试)"""
         with self.lock:
             self.request_count += 1
         
         prompt = PROMPT_TEMPLATE
         
         try:
-            data = {
-                "model": self.model,
-                "messages": [{"role": "user", "content": prompt}],
-                "temperature": 0.7,
-                "max_tokens": 4000
-            }
-            
-            # 增加重试机制
-            response = None
-            for attempt in range(3):
-                try:
-                    response = requests.post(
-                        self.api_url, 
-                        headers=self.headers, 
-                        json=data, 
-                        timeout=120  # 增加超时时间
-                    )
-                    if response.status_code == 200:
-                        break
-                except requests.exceptions.RequestException as e:
-                    print(f"    [{self.name}] 请求重试 {attempt + 1}/3: {e}")
-                    time.sleep(2)
-            
-            if response and response.status_code == 200:
-                result = response.json()
-                content = result.get("choices", [{}])[0].get("message", {}).get("content", "")
-                
-                # 清洗可能存在的 Markdown 标记
-                content = content.replace("```json", "").replace("```", "").strip()
-                
-                try:
-                    dialogues = json.loads(content)
-                    if isinstance(dialogues, dict):
-                        if "messages" in dialogues:
-                            return dialogues["messages"]
-                        return [dialogues] 
-                    return dialogues
-                except:
-                    print(f"    [{self.name}] JSON解析失败，内容预览: {content[:80]}...")
-                    return []
-            else:
-                status = response.status_code if response else "无响应"
-                print(f"    [{self.name}] API 请求失败: {status}")
-                return []
+            # 统一走 chat_utils：自带重试，并按历史输出长度自动设定 max_tokens
+            result = chat_completion(
+                self.api_url,
+                self.api_key,
+                self.model,
+                [{"role": "user", "content": prompt}],
+                temperature=0.7,
+                timeout=120,  # 增加超时时间
+                budget_key="batch_prompt",
+                log_prefix=f"[{self.name}] "
+            )
+            return self._to_messages(result)
                 
         except Exception as e:
             print(f"    [{self.name}] 请求异常: {e}")
             return []
+    
+    @traced(cat="item")
+    def generate_dialogues(self, question: str, n: int):
+        """
+        同一问题一次生成 n 段对话 (一个带 n 参数的请求，不支持时回退为并行单个请求)。
+        返回长度为 n 的列表，每项同 generate_single_dialogue 的返回值 (None 表示已熔断)。
+        """
+        with self.lock:
+            self.request_count += 1
+        
+        prompt = PROMPT_TEMPLATE
+        
+        try:
+            results = chat_completion_n(
+                self.api_url,
+                self.api_key,
+                self.model,
+                [{"role": "user", "content": prompt}],
+                n,
+                temperature=0.7,
+                timeout=120,
+                budget_key="batch_prompt",
+                log_prefix=f"[{self.name}] "
+            )
+            return [self._to_messages(r) for r in results]
+        
+        except Exception as e:
+            print(f"    [{self.name}] 请求异常: {e}")
+            return [[] for _ in range(n)]
+
+
+def build_record(question: str, messages: list, model_name: str, generation_round: int) -> dict:
+    """把模型返回的 messages 整理成一条输出记录"""
+    dialogue_text = ""
+    for msg in messages:
+        role = msg.get('role', 'unknown')
+        content = msg.get('content', '')
+        display_role = "User" if role == "user" else "AiMe"
+        dialogue_text += f"【{display_role}】: {content}\n"
+    
+    return {
+        "question": question,
+        "model": model_name,
+        "generation_round": generation_round,
+        "scheme_type": "batch",
+        "dialogue_content": dialogue_text
+    }
 
 
 def run_single_model(model_config: dict, questions: list, num_generations: int, output_dir: str):
@@ -181,50 +231,90 @@ def run_single_model(model_config: dict, questions: list, num_generations: int,
     
     generator = MultiModelGenerator(model_config)
     all_results = []
+    deferred = []
     
-    for i in range(num_generations):
-        print(f"\n  [{model_name}] 第 {i+1}/{num_generations} 轮生成")
+    if SAMPLES_PER_REQUEST > 1 and num_generations > 1:
+        # 每个问题的 num_generations 次生成按 SAMPLES_PER_REQUEST 一组合并成一个请求
         for q in questions:
-            print(f"    正在处理: {q[:25]}...")
-            result = generator.generate_single_dialogue(q)
+            print(f"    正在处理: {q[:25]}... (共 {num_generations} 次生成)")
+            for start in range(0, num_generations, SAMPLES_PER_REQUEST):
+                size = min(SAMPLES_PER_REQUEST, num_generations - start)
+                results = generator.generate_dialogues(q, size)
+                done = 0
+                for j, result in enumerate(results):
+                    if result is None:
+                        deferred.append((start + j + 1, q))
+                        continue
+                    DASHBOARD.advance()
+                    if result:
+                        all_results.append(build_record(q, result, model_name, start + j + 1))
+                        done += 1
+                print(f"    ✅ 完成 {done}/{size}")
+                sleep(0.5, "throttle")
+    else:
+        for i in range(num_generations):
+            print(f"\n  [{model_name}] 第 {i+1}/{num_generations} 轮生成")
+            for q in questions:
+                print(f"    正在处理: {q[:25]}...")
+                result = generator.generate_single_dialogue(q)
             
-            if result:
-                dialogue_text = ""
-                for msg in result:
-                    role = msg.get('role', 'unknown')
-                    content = msg.get('content', '')
-                    display_role = "User" if role == "user" else "AiMe"
-                    dialogue_text += f"【{display_role}】: {content}\n"
-                
-                all_results.append({
-                    "question": q,
-                    "model": model_name,
-                    "generation_round": i + 1,
-                    "scheme_type": "batch",
-                    "dialogue_content": dialogue_text
-                })
-                print(f"    ✅ 完成")
-            else:
-                print(f"    ❌ 生成失败")
+                if result is None:
+                    # 熔断期间不再空等，留到最后补跑
+                    deferred.append((i + 1, q))
+                    continue
+                DASHBOARD.advance()
+                if result:
+                    all_results.append(build_record(q, result, model_name, i + 1))
+                    print(f"    ✅ 完成")
+                else:
+                    print(f"    ❌ 生成失败")
             
-            # 添加小延迟，避免请求过快
-            time.sleep(0.5)
+                # 添加小延迟，避免请求过快
+                sleep(0.5, "throttle")
     
-    # 保存该模型的结果
+    # 熔断期间跳过的请求：等熔断器允许探测后补跑，再次熔断就放弃剩余部分
+    if deferred:
+        print(f"\n  [{model_name}] 补跑 {len(deferred)} 个因熔断延后的请求")
+        sleep(get_breaker(generator.model).retry_after(), "circuit_open")
+    for n, (round_index, q) in enumerate(deferred):
+        result = generator.generate_single_dialogue(q)
+        if result is None:
+            print(f"    ❌ 模型仍不可用，放弃剩余 {len(deferred) - n} 个请求")
+            break
+        DASHBOARD.advance()
+        if result:
+            all_results.append(build_record(q, result, model_name, round_index))
+        sleep(0.5, "throttle")
+    
+    # 保存该模型的结果 (按生成轮次排序，同一轮内保持问题顺序，与逐轮生成时的文件一致)
+    all_results.sort(key=lambda r: r["generation_round"])
     write_jsonl(all_results, output_file)
     print(f"\n  📁 [{model_name}] 保存完成: {output_file} (共 {len(all_results)} 条)")
     
     return model_name, len(all_results)
 
 
+def plan(questions_file="inputs/questions.txt", output_dir=DEFAULT_RAW_DIR, num_generations=10):
+    """--dry-run：每个模型每个问题生成 num_generations 次，每 SAMPLES_PER_REQUEST 次合并成一个请求"""
+    questions = load_questions(questions_file)
+    result = new_plan("gen_batch")
+    result["files"][questions_file] = len(questions)
+    result["items"] = len(MODELS_CONFIG) * len(questions) * num_generations
+    per_question = -(-num_generations // max(SAMPLES_PER_REQUEST, 1))
+    for model_config in MODELS_CONFIG:
+        add_calls(result, model_config["model"], len(questions) * per_question)
+    if SAMPLES_PER_REQUEST > 1:
+        result["notes"].append(f"每个请求最多要 {SAMPLES_PER_REQUEST} 个回答 (n 参数)；接口不支持 n 时回退为单个请求，"
+                               f"调用数最多为 {result['items']}")
+    return result
+
+
 # ==========================================
 # 主执行逻辑
 # ==========================================
-def main():
-    # 配置
-    questions_file = "inputs/questions.txt"
-    output_dir = "outputs/raw"
-    num_generations = 10  # 每个模型每个问题生成的次数
+@traced("stage:gen_batch", cat="stage")
+def main(questions_file="inputs/questions.txt", output_dir=DEFAULT_RAW_DIR, num_generations=10):
+    # num_generations: 每个模型每个问题生成的次数
     
     print("=" * 60)
     print("🚀 多模型批量测试工具 - 陈鹤琴儿童教育视角")
@@ -245,6 +335,7 @@ def main():
     
     # 记录开始时间
     start_time = time.time()
+    DASHBOARD.begin_stage("gen_batch", total=len(MODELS_CONFIG) * len(questions) * num_generations)
     
     # 依次测试每个模型
     results_summary = []
@@ -268,8 +359,10 @@ def main():
         print(f"  • {model_name}: {count} 条对话")
     print(f"\n⏱️  总耗时: {total_time/60:.1f} 分钟")
     print(f"📁 所有结果已保存至: {output_dir}/")
+    print_hedge_report()
+    print_breaker_report()
     print("=" * 60)
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    run_cli(main, plan, "多模型批量生成对话")
\ No newline at end of file
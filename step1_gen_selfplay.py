@@ -1,8 +1,13 @@
 import json
-import requests
-import time
 import re
+import os
+from step0_config import DEFAULT_RAW_DIR
 from utils.file_utils import load_questions, write_jsonl
+from utils.chat_utils import chat_completion, print_hedge_report
+from utils.run_metrics import RUN_METRICS
+from utils.dashboard import DASHBOARD
+from utils.tracing import traced, sleep
+from utils.dry_run import new_plan, add_calls, run_cli
 
 # ================= 配置区域 =================
 # 请替换为你真实的 API Key
@@ -12,121 +17,235 @@ API_URL = "https://live-turing.cn.llm.tcljd.com/api/v1/chat/completions"
 # 模型选择
 MODEL_USER = "qwen-max-latest"       # 扮演用户
 MODEL_AGENT = "turing/deepseek-v3.1" # 扮演 AiMe (被测对象)
+
+# 角色设定
+USER_SYSTEM_PROMPT = """
+        【角色】你是一个5岁的男孩，性格敏感、倔强，认死理。
+        【任务】
+        1. 针对AiMe的安慰，你要表现出抗拒，不要轻易被说服。
+        2. 每次回答要简短（15字以内），口语化，多用“哼”、“不管”、“就是这样”等词。
+        3. 前3轮对话必须保持负面情绪。
+        """
+
+AIME_SYSTEM_PROMPT = """
+        【角色】你是一个温柔、幽默的儿童陪伴机器人 AiMe。
+        【任务】
+        1. 用生动、共情的语言安抚孩子。
+        2. 尝试转移注意力，或者用比喻来解释道理。
+        """
+
+NUM_TURNS = 20  # 每段对话交互轮数
+
+# 上下文策略：最近 K 轮原文 + 更早轮次的滚动摘要，避免 prompt 随轮数平方增长
+CONTEXT_WINDOW_TURNS = 6   # K: 原样保留最近几轮
+SUMMARY_EVERY_TURNS = 4    # M: 窗口外累计满这么多轮才刷新一次摘要 (设为 0 则始终发送完整历史)
+SUMMARY_MAX_TOKENS = 300
+SUMMARY_PROMPT = """
+        你在帮助一个对话角色记住之前的聊天内容。
+        请把【已有摘要】和【新增对话】合并成一段新的摘要 (200字以内)：
+        保留双方的情绪变化、关键事件、已经用过的安抚方法和尚未解决的问题，不要编造内容。
+        """
 # ===========================================
 
 class ModelAgent:
     """单个模型代理"""
-    def __init__(self, name, model, system_prompt):
+    def __init__(self, name, model, system_prompt,
+                 context_turns=CONTEXT_WINDOW_TURNS, summary_every=SUMMARY_EVERY_TURNS):
         self.name = name
         self.model = model
         self.system_prompt = system_prompt
-        self.history = []
+        self.context_turns = context_turns
+        self.summary_every = summary_every
+        self.clear_memory()
 
-    def generate(self, message):
-        """发送消息并获取回复"""
-        # 构建消息历史
+    def _build_messages(self, message):
+        """system + 滚动摘要 + 尚未进入摘要的原文轮次 + 本次消息"""
         messages = [{"role": "system", "content": self.system_prompt}]
-        for turn in self.history:
+        if self.summary:
+            messages.append({"role": "system", "content": f"【之前对话的摘要】\n{self.summary}"})
+        for turn in self.history[self.summarized_turns * 2:]:
             messages.append({"role": turn["role"], "content": turn["content"]})
         messages.append({"role": "user", "content": message})
+        return messages
 
-        payload = {
-            "model": self.model,
-            "messages": messages,
-            "temperature": 0.8, # 稍微调高，增加多样性
-            "max_tokens": 1000
-        }
-        
-        headers = {"Authorization": f"Bearer {API_KEY}", "Content-Type": "application/json"}
+    def _maybe_refresh_summary(self):
+        """
+        窗口外的原文累计满 summary_every 轮时，把它们并入摘要。
+        这样每次请求最多带 context_turns + summary_every - 1 轮原文，总 token 随轮数线性增长。
+        """
+        if not self.summary_every:
+            return
+        total_turns = len(self.history) // 2
+        overflow = total_turns - self.summarized_turns - self.context_turns
+        if overflow < self.summary_every:
+            return
+
+        old_turns = self.history[self.summarized_turns * 2:(self.summarized_turns + overflow) * 2]
+        transcript = "\n".join(
+            f"{'对方' if t['role'] == 'user' else '你'}: {t['content']}" for t in old_turns
+        )
+        result = chat_completion(
+            API_URL,
+            API_KEY,
+            self.model,
+            [
+                {"role": "system", "content": SUMMARY_PROMPT},
+                {"role": "user", "content": f"【已有摘要】\n{self.summary or '(无)'}\n\n【新增对话】\n{transcript}"},
+            ],
+            temperature=0.3,
+            default_max_tokens=SUMMARY_MAX_TOKENS,
+            timeout=60,
+            retries=1,
+            budget_key=f"selfplay_{self.name}_summary"
+        )
+        if not result["success"]:
+            # 摘要失败就继续发原文，下次再试
+            print(f"  ⚠️ [{self.name}] 摘要刷新失败: {result['error']}")
+            return
+        self.summary = result["content"].strip()
+        self.summarized_turns += overflow
+        self._record_prompt_tokens(result, "summary")
+
+    def _record_prompt_tokens(self, result, kind):
+        tokens = (result.get("usage") or {}).get("prompt_tokens", 0) or 0
+        self.prompt_tokens.append({"kind": kind, "prompt_tokens": tokens})
+        RUN_METRICS.incr("selfplay_prompt_tokens", tokens)
+
+    def generate(self, message):
+        """发送消息并获取回复"""
+        # 构建消息：摘要 + 最近几轮原文
+        messages = self._build_messages(message)
+
+        result = chat_completion(
+            API_URL,
+            API_KEY,
+            self.model,
+            messages,
+            temperature=0.8, # 稍微调高，增加多样性
+            default_max_tokens=1000,
+            timeout=60,
+            retries=1,
+            budget_key=f"selfplay_{self.name}"
+        )
         
-        try:
-            resp = requests.post(API_URL, headers=headers, json=payload, timeout=60)
-            if resp.status_code == 200:
-                content = resp.json()['choices'][0]['message']['content']
-                # 记录历史 (Self-Play 关键：我的输出是下一次我的输入)
-                self.history.append({"role": "user", "content": message})
-                self.history.append({"role": "assistant", "content": content})
-                return content
-            else:
-                print(f"❌ API Error: {resp.text}")
-                return "..."
-        except Exception as e:
-            print(f"❌ Request Error: {e}")
+        if result["success"]:
+            content = result["content"]
+            self._record_prompt_tokens(result, "reply")
+            # 记录历史 (Self-Play 关键：我的输出是下一次我的输入)
+            self.history.append({"role": "user", "content": message})
+            self.history.append({"role": "assistant", "content": content})
+            self._maybe_refresh_summary()
+            return content
+        else:
+            print(f"❌ API Error: {result['error']}")
             return "..."
 
+    def total_prompt_tokens(self):
+        return sum(x["prompt_tokens"] for x in self.prompt_tokens)
+
     def clear_memory(self):
         self.history = []
+        self.summary = ""
+        self.summarized_turns = 0   # 已并入摘要的轮数
+        self.prompt_tokens = []     # 每次请求的 prompt token 数
 
-def main():
-    questions = load_questions("inputs/questions.txt")
-    output_file = "outputs/raw/data_scheme_A.jsonl"
-    results = []
-
-    print(f"--- 🚀 方案 A (Self-Play) 开始 ---")
-
-    # 1. 定义两个角色
+def build_agents():
+    """创建一对新的角色 (User / AiMe)"""
     # User: 刁钻的“熊孩子”
     user_bot = ModelAgent(
         name="User",
         model=MODEL_USER,
-        system_prompt="""
-        【角色】你是一个5岁的男孩，性格敏感、倔强，认死理。
-        【任务】
-        1. 针对AiMe的安慰，你要表现出抗拒，不要轻易被说服。
-        2. 每次回答要简短（15字以内），口语化，多用“哼”、“不管”、“就是这样”等词。
-        3. 前3轮对话必须保持负面情绪。
-        """
+        system_prompt=USER_SYSTEM_PROMPT
     )
 
     # Agent: 温柔的 AiMe
     aime_bot = ModelAgent(
         name="AiMe",
         model=MODEL_AGENT,
-        system_prompt="""
-        【角色】你是一个温柔、幽默的儿童陪伴机器人 AiMe。
-        【任务】
-        1. 用生动、共情的语言安抚孩子。
-        2. 尝试转移注意力，或者用比喻来解释道理。
-        """
+        system_prompt=AIME_SYSTEM_PROMPT
     )
+    return user_bot, aime_bot
+
+@traced(cat="item")
+def run_selfplay_dialogue(q, user_bot, aime_bot):
+    """以问题 q 为种子跑一整段 Self-Play 对话，返回输出记录"""
+    user_bot.clear_memory()
+    aime_bot.clear_memory()
+    
+    # 记录对话文本
+    dialogue_text = ""
+    
+    # 第一轮：User 直接抛出问题 (Seed)
+    current_msg = q 
+    dialogue_text += f"【User】: {current_msg}\n"
+    
+    # 交互 NUM_TURNS 轮 (User -> AiMe -> User -> AiMe ...)
+    for turn in range(NUM_TURNS):
+        # AiMe 回复 User
+        aime_reply = aime_bot.generate(current_msg)
+        dialogue_text += f"【AiMe】: {aime_reply}\n"
+        print(f"  AiMe: {aime_reply[:20]}...")
+        
+        # User 回复 AiMe (基于 AiMe 的话继续刁难)
+        # 注意：User 模型要把 AiMe 的回复当做输入
+        current_msg = user_bot.generate(aime_reply)
+        dialogue_text += f"【User】: {current_msg}\n"
+        print(f"  User: {current_msg[:20]}...")
+
+    prompt_tokens = {bot.name: bot.prompt_tokens for bot in (user_bot, aime_bot)}
+    total = user_bot.total_prompt_tokens() + aime_bot.total_prompt_tokens()
+    print(f"  📏 本段对话 prompt tokens: {total} "
+          f"(AiMe 单次最大 {max((x['prompt_tokens'] for x in aime_bot.prompt_tokens), default=0)})")
+
+    return {
+        "question": q,
+        "scheme_type": "self_play",
+        "dialogue_content": dialogue_text,
+        "prompt_tokens": prompt_tokens,
+        "total_prompt_tokens": total
+    }
+
+def summary_calls_per_dialogue():
+    """每个角色在一段对话里刷新摘要的次数：第 K+M、K+2M ... 轮之前各一次"""
+    if not SUMMARY_EVERY_TURNS:
+        return 0
+    return max(0, (NUM_TURNS - 1 - CONTEXT_WINDOW_TURNS) // SUMMARY_EVERY_TURNS)
+
+
+def plan(questions_file="inputs/questions.txt", output_file=os.path.join(DEFAULT_RAW_DIR, "data_scheme_A.jsonl")):
+    """--dry-run：每个问题一段对话，两个角色各 NUM_TURNS 次回复 + 摘要刷新"""
+    questions = load_questions(questions_file)
+    result = new_plan("gen_selfplay")
+    result["files"][questions_file] = len(questions)
+    result["items"] = len(questions)
+    per_agent = NUM_TURNS + summary_calls_per_dialogue()
+    add_calls(result, MODEL_USER, len(questions) * per_agent)
+    add_calls(result, MODEL_AGENT, len(questions) * per_agent)
+    return result
+
+@traced("stage:gen_selfplay", cat="stage")
+def main(questions_file="inputs/questions.txt", output_file=os.path.join(DEFAULT_RAW_DIR, "data_scheme_A.jsonl")):
+    questions = load_questions(questions_file)
+    results = []
+
+    print(f"--- 🚀 方案 A (Self-Play) 开始 ---")
+
+    # 1. 定义两个角色
+    user_bot, aime_bot = build_agents()
+    DASHBOARD.begin_stage("gen_selfplay", total=len(questions))
 
     # 2. 循环跑题
     for i, q in enumerate(questions):
         print(f"[{i+1}/{len(questions)}] 正在生成: {q}")
         
-        user_bot.clear_memory()
-        aime_bot.clear_memory()
-        
-        # 记录对话文本
-        dialogue_text = ""
-        
-        # 第一轮：User 直接抛出问题 (Seed)
-        current_msg = q 
-        dialogue_text += f"【User】: {current_msg}\n"
-        
-        # 交互 4 轮 (User -> AiMe -> User -> AiMe ...)
-        for turn in range(20):
-            # AiMe 回复 User
-            aime_reply = aime_bot.generate(current_msg)
-            dialogue_text += f"【AiMe】: {aime_reply}\n"
-            print(f"  AiMe: {aime_reply[:20]}...")
-            
-            # User 回复 AiMe (基于 AiMe 的话继续刁难)
-            # 注意：User 模型要把 AiMe 的回复当做输入
-            current_msg = user_bot.generate(aime_reply)
-            dialogue_text += f"【User】: {current_msg}\n"
-            print(f"  User: {current_msg[:20]}...")
-
         # 3. 保存结果
-        results.append({
-            "question": q,
-            "scheme_type": "self_play",
-            "dialogue_content": dialogue_text
-        })
-        time.sleep(1) # 歇一歇
+        results.append(run_selfplay_dialogue(q, user_bot, aime_bot))
+        DASHBOARD.advance()
+        sleep(1, "throttle") # 歇一歇
 
     write_jsonl(results, output_file)
     print(f"✅ 方案 A 完成！保存至: {output_file}")
+    print_hedge_report()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    run_cli(main, plan, "方案 A: Self-Play 对话生成")
@@ -1,16 +1,30 @@
 import os
 import re
-import time
 import json
+import glob
 from pathlib import Path
 from pydantic import BaseModel, Field
 
 # 复用已有的工具
-from utils.file_utils import read_jsonl, write_jsonl
-from utils.api_utils import get_judge_client
+from step0_config import DEFAULT_RAW_DIR, DEFAULT_JUDGED_DIR, JUDGE_MODEL_NAME, JUDGE_FALLBACK_MODEL_NAME
+from utils.file_utils import read_jsonl, write_jsonl, count_jsonl
+from utils.api_utils import get_judge_client, guarded_create
+from utils.circuit_breaker import print_breaker_report
+from utils.structured_output import print_structured_report
+from utils.single_flight import print_single_flight_report
+from utils.file_scheduler import run_files
+from utils.cache_utils import RecordCache, fingerprint
+from utils.dashboard import DASHBOARD
+from utils.tracing import traced, sleep
+from utils.dry_run import new_plan, add_calls, run_cli
 
 # ================= 配置区域 =================
 
+JUDGE_MODEL = JUDGE_MODEL_NAME
+JUDGE_FALLBACK_MODEL = JUDGE_FALLBACK_MODEL_NAME
+# 所有文件的对话共用的裁判并发数 (按文件轮流取任务，每个文件打完就立即落盘)
+JUDGE_WORKERS = 8
+
 # 1. 定义打分的数据结构 (直接写在这里，不用改 utils 文件了)
 class ScoreSchema(BaseModel):
     """针对单个 QA 对的打分结果"""
@@ -40,6 +54,7 @@ SCORING_CRITERIA = """
 
 # ================= 核心逻辑 =================
 
+@traced(cat="parse")
 def parse_dialogue_to_turns(dialogue_text):
     """
     把长文本拆解为每一轮。
@@ -66,7 +81,7 @@ def parse_dialogue_to_turns(dialogue_text):
     return turns
 
 def score_one_turn(client, context, user, aime):
-    """调用裁判给单个 Turn 打分"""
+    """调用裁判给单个 Turn 打分，返回 (分数, 分析, 实际打分的裁判模型)；出错时裁判为 None"""
     prompt = SCORING_CRITERIA.format(
         context=context if context else "(这是对话的第一句)",
         user_query=user,
@@ -75,8 +90,12 @@ def score_one_turn(client, context, user, aime):
     
     try:
         # 使用 Qwen 或 DeepSeek 做裁判都可以
-        result = client.chat.completions.create(
-            model="qwen-max-latest", 
+        # 主裁判熔断/故障时自动切换到备用裁判
+        result, judge = guarded_create(
+            client,
+            JUDGE_MODEL,
+            fallback_model=JUDGE_FALLBACK_MODEL,
+            with_model=True,
             response_model=ScoreSchema,
             messages=[
                 {"role": "system", "content": "You are a critical dialogue quality evaluator."},
@@ -85,73 +104,95 @@ def score_one_turn(client, context, user, aime):
             temperature=0.0,
             max_retries=2
         )
-        return result.score, result.analysis
+        return result.score, result.analysis, judge
     except Exception as e:
         print(f"  ❌ 打分出错: {e}")
-        return 0, "Error"
+        return 0, "Error", None
 
-def process_file(file_path, output_path):
-    print(f"正在处理文件: {file_path}")
-    data = read_jsonl(file_path)
-    if not data:
-        print("❌ 数据为空，请检查路径或先运行 Step 1")
-        return
+def turn_fingerprint(context, user, aime):
+    """单轮打分指纹：上下文、本轮内容、评分标准、裁判模型任一变化都会重新打分"""
+    return fingerprint(context, user, aime, SCORING_CRITERIA, JUDGE_MODEL)
 
-    client = get_judge_client()
-    scored_data = []
+@traced(cat="item")
+def score_sample(client, sample, cache=None, label=""):
+    """
+    逐轮给单条样本打分，写入 avg_score / turn_details / turn_judges。
+    对话为空或无法解析时返回 None。
+    label 形如 "data_xxx.jsonl 3/120"，多线程打分时加在每行输出前面，区分是哪条对话。
+    """
+    tag = f"[{label}] " if label else ""
+    dialogue_text = sample.get('dialogue_content', '')
+    if not dialogue_text:
+        print(f"  {tag}⚠️ 对话内容为空，跳过")
+        return None
+
+    turns = parse_dialogue_to_turns(dialogue_text)
     
-    for i, sample in enumerate(data):
-        # 兼容不同来源的 question 字段
-        q_text = sample.get('question', '未知问题')
-        print(f"\n[{i+1}/{len(data)}] 正在评估对话: {q_text[:10]}...")
+    if not turns:
+        print(f"  {tag}⚠️ 无法解析对话格式 (正则未匹配)，跳过。")
+        print(f"  {tag}(调试) 文本前50字: {dialogue_text[:50]}")
+        return None
         
-        dialogue_text = sample.get('dialogue_content', '')
-        if not dialogue_text:
-            print("  ⚠️ 对话内容为空，跳过")
-            continue
+    turn_scores = []
+    history_context = "" 
+    detailed_turns = []
 
-        turns = parse_dialogue_to_turns(dialogue_text)
+    for t_idx, turn in enumerate(turns):
+        user_text = turn['user']
+        aime_text = turn['aime']
         
-        if not turns:
-            print(f"  ⚠️ 无法解析对话格式 (正则未匹配)，跳过。")
-            print(f"  (调试) 文本前50字: {dialogue_text[:50]}")
-            continue
-            
-        turn_scores = []
-        history_context = "" 
-        detailed_turns = []
-
-        for t_idx, turn in enumerate(turns):
-            user_text = turn['user']
-            aime_text = turn['aime']
-            
-            # 打分
-            score, reason = score_one_turn(client, history_context, user_text, aime_text)
-            turn_scores.append(score)
-            
-            print(f"  - 第 {t_idx+1} 轮得分: {score} | 评语: {reason[:15]}...")
-            
-            detailed_turns.append({
-                "turn_index": t_idx + 1,
-                "user": user_text,
-                "aime": aime_text,
-                "score": score,
-                "analysis": reason
-            })
-            
-            history_context += f"User: {user_text}\nAiMe: {aime_text}\n"
-
-        # 使用内置平均避免依赖 numpy
-        avg_score = round(sum(turn_scores) / len(turn_scores), 2) if turn_scores else 0
-        print(f"  ✅ 该对话平均分: {avg_score}")
+        # 打分 (指纹未变的轮次直接复用缓存)
+        key = turn_fingerprint(history_context, user_text, aime_text) if cache is not None else None
+        cached = cache.get(key) if cache is not None else None
+        if cached:
+            # 缓存里只有主裁判的打分
+            score, reason, judge = cached["score"], cached["analysis"], JUDGE_MODEL
+        else:
+            score, reason, judge = score_one_turn(client, history_context, user_text, aime_text)
+            # 备用裁判给的分不缓存，主裁判恢复后重跑会重新打分
+            if cache is not None and judge == JUDGE_MODEL:
+                cache.put(key, {"score": score, "analysis": reason})
+        turn_scores.append(score)
         
-        sample['avg_score'] = avg_score
-        sample['turn_details'] = detailed_turns
-        scored_data.append(sample)
+        print(f"  {tag}- 第 {t_idx+1} 轮得分: {score} | 评语: {reason[:15]}...")
+        
+        detailed_turns.append({
+            "turn_index": t_idx + 1,
+            "user": user_text,
+            "aime": aime_text,
+            "score": score,
+            "analysis": reason,
+            "judge": judge
+        })
         
-        time.sleep(0.5)
+        history_context += f"User: {user_text}\nAiMe: {aime_text}\n"
 
-    write_jsonl(scored_data, output_path)
+    # 使用内置平均避免依赖 numpy
+    avg_score = round(sum(turn_scores) / len(turn_scores), 2) if turn_scores else 0
+    print(f"  {tag}✅ 该对话平均分: {avg_score}")
+    
+    sample['avg_score'] = avg_score
+    sample['turn_details'] = detailed_turns
+    # 实际参与打分的裁判 (主裁判故障切换时会出现备用裁判)
+    sample['turn_judges'] = sorted({t["judge"] for t in detailed_turns if t["judge"]})
+    return sample
+
+def write_turn_sidecar(output_path, scored_data, offsets):
+    """在 JSONL 旁边写逐轮分数的列式 sidecar (utils/turn_store.py)，供 step6 向量化分析"""
+    try:
+        from utils.turn_store import write_turn_store
+    except ImportError:
+        print("Warning: 未安装 numpy，跳过逐轮分数 sidecar")
+        return
+    rows = write_turn_store(output_path, scored_data, offsets)
+    print(f"🧮 逐轮分数 sidecar: {output_path}.turns ({rows} 轮)")
+
+def finish_file(file_path, output_path, results):
+    """一个文件的所有对话打完后写出结果 (含列式 sidecar) 并打印该文件的综合平均分"""
+    scored_data = [s for s in results if s is not None]
+
+    offsets = write_jsonl(scored_data, output_path)
+    write_turn_sidecar(output_path, scored_data, offsets)
     
     # 计算整体平均分
     all_avgs = [s['avg_score'] for s in scored_data]
@@ -160,25 +201,94 @@ def process_file(file_path, output_path):
     print(f"📄 文件 {os.path.basename(file_path)} 处理完成！")
     print(f"📊 综合平均分: {final_avg}")
     print("="*60)
+    return final_avg
 
-def main():
-    import glob
-    
-    Path("outputs/judged").mkdir(parents=True, exist_ok=True)
+def plan(raw_dir=DEFAULT_RAW_DIR, judged_dir=DEFAULT_JUDGED_DIR, cache_path=None):
+    """--dry-run：每条对话按轮解析，每轮一次裁判调用；传了 cache_path 时扣除已缓存的轮次"""
+    result = new_plan("score_turns")
+    cache = RecordCache(cache_path) if cache_path else None
+    cached = 0
+    for input_f in glob.glob(os.path.join(raw_dir, "*.jsonl")):
+        data = read_jsonl(input_f)
+        result["files"][input_f] = len(data)
+        for sample in data:
+            turns = parse_dialogue_to_turns(sample.get('dialogue_content', ''))
+            if turns:
+                result["items"] += 1
+            history_context = ""
+            for turn in turns:
+                if cache is not None and cache.get(turn_fingerprint(history_context, turn['user'], turn['aime'])):
+                    cached += 1
+                else:
+                    add_calls(result, JUDGE_MODEL, 1)
+                history_context += f"User: {turn['user']}\nAiMe: {turn['aime']}\n"
+    if cache is not None:
+        result["notes"].append(f"命中缓存 {cached} 轮，不计入调用数")
+    return result
+
+@traced("stage:score_turns", cat="stage")
+def main(raw_dir=DEFAULT_RAW_DIR, judged_dir=DEFAULT_JUDGED_DIR, cache_path=None):
+    Path(judged_dir).mkdir(parents=True, exist_ok=True)
     
     # 自动扫描所有 jsonl 文件
-    raw_files = glob.glob("outputs/raw/*.jsonl")
+    raw_files = glob.glob(os.path.join(raw_dir, "*.jsonl"))
+    
+    # 传入 cache_path 时按轮次缓存打分结果 (由 run_pipeline 增量调度使用)
+    cache = RecordCache(cache_path) if cache_path else None
     
     print(f"找到 {len(raw_files)} 个文件待处理:")
     for f in raw_files:
         print(f"  - {f}")
     print("-" * 50)
+    DASHBOARD.begin_stage("score_turns", total=sum(count_jsonl(f) for f in raw_files))
     
+    all_results = {}
+    files = {}
+    outputs = {}
     for input_f in raw_files:
         # 自动生成输出文件名: data_xxx.jsonl -> score_xxx.jsonl
         filename = os.path.basename(input_f).replace("data_", "score_")
-        output_f = f"outputs/judged/{filename}"
-        process_file(input_f, output_f)
+        data = read_jsonl(input_f)
+        if not data:
+            print(f"❌ 数据为空，请检查路径或先运行 Step 1: {input_f}")
+            all_results[os.path.basename(input_f)] = 0
+            continue
+        files[input_f] = data
+        outputs[input_f] = os.path.join(judged_dir, filename)
+    
+    # 所有文件的对话进同一个线程池，按文件轮流调度；哪个文件先打完就先写出
+    client = get_judge_client()
+    
+    def process_item(input_f, i, sample):
+        # 兼容不同来源的 question 字段
+        q_text = sample.get('question', '未知问题')
+        label = f"{os.path.basename(input_f)} {i+1}/{len(files[input_f])}"
+        print(f"\n[{label}] 正在评估对话: {q_text[:10]}...")
+        scored = score_sample(client, sample, cache, label)
+        DASHBOARD.advance()
+        if scored is not None:
+            sleep(0.5, "throttle")
+        return scored
+    
+    def on_file_done(input_f, results):
+        all_results[os.path.basename(input_f)] = finish_file(input_f, outputs[input_f], results)
+    
+    run_files(files, process_item, on_file_done, workers=JUDGE_WORKERS)
+    
+    # ========== 打印最终汇总 ==========
+    print(f"\n{'='*60}")
+    print(f"📊 所有文件逐轮打分汇总")
+    print(f"{'='*60}")
+    for filename, score in sorted(all_results.items(), key=lambda x: x[1], reverse=True):
+        print(f"  {filename}: {score} 分")
+    print(f"{'='*60}")
+    if all_results:
+        best_file = max(all_results, key=all_results.get)
+        print(f"🏆 最高分: {best_file} ({all_results[best_file]} 分)")
+    
+    print_breaker_report()
+    print_structured_report()
+    print_single_flight_report()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    run_cli(main, plan, "Step 4: 逐轮打分")
\ No newline at end of file
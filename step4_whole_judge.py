@@ -1,16 +1,31 @@
 import os
-import time
 import json
 import glob
 from pathlib import Path
 from pydantic import BaseModel, Field
 
 # 导入你现有的工具
-from utils.file_utils import read_jsonl, write_jsonl
-from utils.api_utils import get_judge_client
+from step0_config import DEFAULT_RAW_DIR, DEFAULT_JUDGED_DIR, JUDGE_MODEL_NAME, JUDGE_FALLBACK_MODEL_NAME
+from utils.file_utils import read_jsonl, write_jsonl, count_jsonl
+from utils.api_utils import get_judge_client, guarded_create
+from utils.circuit_breaker import print_breaker_report
+from utils.structured_output import print_structured_report
+from utils.single_flight import print_single_flight_report
+from utils.cache_utils import RecordCache, fingerprint
+from utils.text_compaction import compact_for_judge, JUDGE_INPUT_VERSION
+from utils.dashboard import DASHBOARD
+from utils.tracing import traced, sleep
+from utils.dry_run import new_plan, add_calls, run_cli
+from utils.prejudge import PreJudge
+from utils.file_scheduler import run_files
 
 # ================= 配置区域 =================
 
+JUDGE_MODEL = JUDGE_MODEL_NAME
+JUDGE_FALLBACK_MODEL = JUDGE_FALLBACK_MODEL_NAME
+# 所有文件的对话共用的裁判并发数 (按文件轮流取任务，每个文件打完就立即落盘)
+JUDGE_WORKERS = 8
+
 # 1. 定义打分结构
 class ScoreSchema(BaseModel):
     """针对整段对话的综合打分"""
@@ -43,12 +58,16 @@ AiMe 是一个温柔的陪伴机器人，任务是安抚并引导孩子。
 # ================= 核心逻辑 =================
 
 def score_whole_dialogue(client, dialogue_text):
-    """将整段对话喂给裁判，获取一个综合分"""
+    """将整段对话喂给裁判，返回 (分数, 分析, 实际打分的裁判模型)；出错时裁判为 None"""
     prompt = HOLISTIC_CRITERIA.format(dialogue_content=dialogue_text)
     
     try:
-        result = client.chat.completions.create(
-            model="qwen-max-latest", 
+        # 主裁判熔断/故障时自动切换到备用裁判
+        result, judge = guarded_create(
+            client,
+            JUDGE_MODEL,
+            fallback_model=JUDGE_FALLBACK_MODEL,
+            with_model=True,
             response_model=ScoreSchema,
             messages=[
                 {"role": "system", "content": "You are a strict dialogue judge."},
@@ -57,43 +76,90 @@ def score_whole_dialogue(client, dialogue_text):
             temperature=0.0,
             max_retries=2
         )
-        return result.score, result.analysis
+        return result.score, result.analysis, judge
     except Exception as e:
         print(f"  ❌ 打分出错: {e}")
-        return 0, f"Error: {str(e)}"
+        return 0, f"Error: {str(e)}", None
 
-def process_file(file_path, output_path):
-    print(f"\n>>> 正在评估文件: {file_path}")
-    data = read_jsonl(file_path)
-    
-    if not data:
-        print(f"❌ 警告：文件为空或不存在: {file_path}")
-        return 0
+def judge_fingerprint(dialogue_text):
+    """
+    单条对话的打分指纹：对话内容 (压缩后、裁判实际看到的文本)、评分标准、裁判模型、
+    压缩规则版本任一变化都会重新打分
+    """
+    return fingerprint(dialogue_text, HOLISTIC_CRITERIA, JUDGE_MODEL, JUDGE_INPUT_VERSION)
 
-    client = get_judge_client()
-    scored_data = []
-    scores = []
+def prejudge_history(judged_dir):
+    """本地预判的校准样本：judged_dir 里已有的裁判打分 (排除出错的和本地预判给的分)"""
+    history = []
+    for path in glob.glob(os.path.join(judged_dir, "holistic_score_*.jsonl")):
+        for s in read_jsonl(path):
+            if s.get('holistic_judge') == "prejudge" or str(s.get('holistic_analysis', '')).startswith("Error"):
+                continue
+            history.append((s.get('dialogue_content', ''), None, s.get('holistic_score', 0)))
+    return history
+
+@traced(cat="item")
+def judge_sample(client, sample, cache=None, prejudge=None):
+    """
+    给单条样本打分，写入 holistic_score / holistic_analysis / holistic_judge (实际打分的裁判)。
+    返回 (sample, 是否命中缓存)；对话过短时返回 (None, False)。
+    传了 prejudge 时，本地能直接判定好坏的对话不送裁判 (holistic_judge 记为 "prejudge")。
+    """
+    dialogue_text = sample.get('dialogue_content', '')
+    if not dialogue_text or len(dialogue_text) < 10:
+        return None, False
     
-    for i, sample in enumerate(data):
-        q_text = sample.get('question', '未知问题')
-        dialogue_text = sample.get('dialogue_content', '')
-        
-        if not dialogue_text or len(dialogue_text) < 10:
-            print(f"[{i+1}] ⚠️ 对话过短，跳过")
-            continue
+    # 长对话先压缩 (空白规整 / 重复去重 / 首尾保留)，裁判看到的就是压缩后的文本
+    judge_text, compaction = compact_for_judge(dialogue_text)
+    
+    # 指纹未变的对话直接复用上次的打分
+    key = judge_fingerprint(judge_text) if cache is not None else None
+    cached = cache.get(key) if cache is not None else None
+    local = prejudge.triage(dialogue_text) if prejudge is not None and not cached else None
+    if cached:
+        # 缓存里只有主裁判的打分
+        score, analysis, judge = cached["score"], cached["analysis"], JUDGE_MODEL
+    elif local:
+        # 本地判定的分数不写缓存，关掉预判后这些对话会照常送裁判
+        score, analysis, judge = local["score"], local["analysis"], "prejudge"
+    else:
+        score, analysis, judge = score_whole_dialogue(client, judge_text)
+        # 备用裁判给的分不缓存，主裁判恢复后重跑会重新打分
+        if cache is not None and judge == JUDGE_MODEL:
+            cache.put(key, {"score": score, "analysis": analysis})
+    
+    sample['holistic_score'] = score
+    sample['holistic_analysis'] = analysis
+    sample['judge_input_compaction'] = compaction
+    sample['holistic_judge'] = judge
+    return sample, bool(cached)
 
-        print(f"[{i+1}/{len(data)}] 正在打分: {q_text[:10]}...")
-        
-        score, analysis = score_whole_dialogue(client, dialogue_text)
-        print(f"  ★ 得分: {score} | 评语: {analysis[:30]}...")
-        
-        sample['holistic_score'] = score
-        sample['holistic_analysis'] = analysis
-        scored_data.append(sample)
-        scores.append(score)
-        
-        time.sleep(0.5)
+def judge_item(client, sample, label, cache=None, prejudge=None):
+    """线程池里执行的单条打分；label 形如 "data_xxx.jsonl 3/120"，用于区分并发输出"""
+    q_text = sample.get('question', '未知问题')
+    print(f"[{label}] 正在打分: {q_text[:10]}...")
+    
+    scored, from_cache = judge_sample(client, sample, cache, prejudge)
+    DASHBOARD.advance()
+    if scored is None:
+        print(f"[{label}] ⚠️ 对话过短，跳过")
+        return None
+    
+    score = scored['holistic_score']
+    if from_cache:
+        print(f"  [{label}] ♻️ 复用缓存得分: {score}")
+    elif scored['holistic_judge'] == "prejudge":
+        print(f"  [{label}] ⚖️ 本地预判得分: {score}")
+    else:
+        print(f"  [{label}] ★ 得分: {score} | 评语: {scored['holistic_analysis'][:30]}...")
+        sleep(0.5, "throttle")
+    return scored
 
+def finish_file(file_path, output_path, results):
+    """一个文件的所有条目打完后写出结果，返回该文件的平均分"""
+    scored_data = [s for s in results if s is not None]
+    scores = [s['holistic_score'] for s in scored_data]
+    
     write_jsonl(scored_data, output_path)
     
     if scores:
@@ -108,39 +174,88 @@ def process_file(file_path, output_path):
     print(f"--------------------------------------------------")
     return avg_score
 
-def main():
-    Path("outputs/judged").mkdir(parents=True, exist_ok=True)
+def plan(raw_dir=DEFAULT_RAW_DIR, judged_dir=DEFAULT_JUDGED_DIR, cache_path=None):
+    """--dry-run：每条对话一次裁判调用；传了 cache_path 时扣除已缓存的对话"""
+    result = new_plan("judge_whole")
+    cache = RecordCache(cache_path) if cache_path else None
+    cached = 0
+    for input_file in sorted(glob.glob(os.path.join(raw_dir, "data_*.jsonl"))):
+        data = read_jsonl(input_file)
+        result["files"][input_file] = len(data)
+        for sample in data:
+            dialogue_text = sample.get('dialogue_content', '')
+            if not dialogue_text or len(dialogue_text) < 10:
+                continue
+            result["items"] += 1
+            if cache is not None and cache.get(judge_fingerprint(compact_for_judge(dialogue_text)[0])):
+                cached += 1
+                continue
+            add_calls(result, JUDGE_MODEL, 1)
+    if cache is not None:
+        result["notes"].append(f"命中缓存 {cached} 条，不计入调用数")
+    if PreJudge("judge_whole", None).enabled:
+        result["notes"].append("已开启本地预判，实际裁判调用数会更少 (阈值在运行时校准)")
+    return result
+
+@traced("stage:judge_whole", cat="stage")
+def main(raw_dir=DEFAULT_RAW_DIR, judged_dir=DEFAULT_JUDGED_DIR, cache_path=None):
+    Path(judged_dir).mkdir(parents=True, exist_ok=True)
     
     print(f"--- 🏆 Step 4: 整体质量打分 (自动扫描所有文件) ---")
 
     # ========== 关键修改：自动扫描所有文件 ==========
-    raw_files = glob.glob("outputs/raw/data_*.jsonl")
+    raw_files = glob.glob(os.path.join(raw_dir, "data_*.jsonl"))
     
     if not raw_files:
-        print("❌ 没有找到任何 outputs/raw/data_*.jsonl 文件！")
+        print(f"❌ 没有找到任何 {raw_dir}/data_*.jsonl 文件！")
         return
     
+    # 传入 cache_path 时按记录缓存打分结果 (由 run_pipeline 增量调度使用)
+    cache = RecordCache(cache_path) if cache_path else None
+    # COT_PREJUDGE=1 时开启本地预判，用 judged_dir 里已有的裁判分数校准 (在本次写入之前)
+    prejudge = PreJudge("judge_whole", lambda: prejudge_history(judged_dir))
+    
     print(f"\n📁 找到 {len(raw_files)} 个文件待处理:")
     for f in sorted(raw_files):
         print(f"   - {os.path.basename(f)}")
     print("-" * 50)
+    DASHBOARD.begin_stage("judge_whole", total=sum(count_jsonl(f) for f in raw_files))
     
     # 存储所有结果
     all_results = {}
+    files = {}
+    outputs = {}
     
     for input_file in sorted(raw_files):
         # 自动生成输出文件名: data_xxx.jsonl -> holistic_score_xxx.jsonl
         basename = os.path.basename(input_file)
         output_name = basename.replace("data_", "holistic_score_")
-        output_file = f"outputs/judged/{output_name}"
+        output_file = os.path.join(judged_dir, output_name)
         
         # 跳过已经处理过的文件（可选，注释掉这3行就会重新处理所有文件）
         # if os.path.exists(output_file):
         #     print(f"⏭️ 跳过已存在: {output_file}")
         #     continue
         
-        avg_score = process_file(input_file, output_file)
-        all_results[basename] = avg_score
+        data = read_jsonl(input_file)
+        if not data:
+            print(f"❌ 警告：文件为空或不存在: {input_file}")
+            all_results[basename] = 0
+            continue
+        files[input_file] = data
+        outputs[input_file] = output_file
+    
+    # 所有文件的条目进同一个线程池，按文件轮流调度；哪个文件先打完就先写出
+    client = get_judge_client()
+    
+    def process_item(input_file, i, sample):
+        label = f"{os.path.basename(input_file)} {i+1}/{len(files[input_file])}"
+        return judge_item(client, sample, label, cache, prejudge)
+    
+    def on_file_done(input_file, results):
+        all_results[os.path.basename(input_file)] = finish_file(input_file, outputs[input_file], results)
+    
+    run_files(files, process_item, on_file_done, workers=JUDGE_WORKERS)
     
     # ========== 打印最终汇总 ==========
     print(f"\n{'='*60}")
@@ -156,6 +271,11 @@ def main():
     if all_results:
         best_file = max(all_results, key=all_results.get)
         print(f"🏆 最高分: {best_file} ({all_results[best_file]} 分)")
+    
+    prejudge.report()
+    print_breaker_report()
+    print_structured_report()
+    print_single_flight_report()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    run_cli(main, plan, "Step 4: 整体质量打分")
\ No newline at end of file
@@ -0,0 +1,300 @@
+"""
+step6_score_analytics.py
+跨轮次的打分分析：均值 + bootstrap 置信区间 / 分类别 / 逐轮曲线 / 多次运行对比
+
+把所有打分结果读进紧凑的 NumPy 数组 (模型、类别、运行批次都编码成整数)，
+所有分组统计和 bootstrap 都是向量化计算，几十万条分数也能秒级出结果。
+
+数据来源：
+    - holistic: <judged_dir>/holistic_score_*.jsonl  (step4_whole_judge)
+    - turn:     <judged_dir>/score_*.jsonl           (step4_score_turns，逐轮分数；
+                读旁边的列式 sidecar score_*.jsonl.turns/，缺失或过期时自动重建)
+    - eval:     outputs/eval_full/<时间戳>/*_score.json (step_eval_full_new)
+
+使用方法：
+    python step6_score_analytics.py
+    python step6_score_analytics.py --judged-dir outputs/judged outputs/judged_v2 --boot 2000
+"""
+
+import os
+import json
+import glob
+import argparse
+from pathlib import Path
+
+import numpy as np
+
+from step0_config import DEFAULT_JUDGED_DIR
+from utils.turn_store import load_turn_store
+
+EVAL_ROOT = "outputs/eval_full"
+REPORT_PATH = "outputs/analytics/score_report.json"
+
+N_BOOTSTRAP = 1000     # bootstrap 重采样次数
+CI_LEVEL = 0.95        # 置信水平
+SEED = 0
+
+
+# ================= 数据装载 =================
+class ScoreTable:
+    """
+    一类分数的列式存储：
+        score:    float32 分数
+        model / category / run: int32 编码，对应 labels 里的字符串
+        turn:     int16 轮次 (整段打分为 0)
+    """
+
+    COLUMNS = ("model", "category", "run")
+
+    def __init__(self, rows):
+        self.labels = {}
+        for col in self.COLUMNS:
+            codes, labels = _factorize([r[col] for r in rows])
+            setattr(self, col, codes)
+            self.labels[col] = labels
+        self.turn = np.fromiter((r.get("turn", 0) for r in rows), dtype=np.int16, count=len(rows))
+        self.score = np.fromiter((r["score"] for r in rows), dtype=np.float32, count=len(rows))
+
+    @classmethod
+    def from_columns(cls, chunks):
+        """
+        直接由列拼出表 (逐轮 sidecar 用)，不经过逐行字典。
+        chunks: [(score, turn, {"model": (编码, 标签), "category": (...), "run": (...)}), ...]
+        各块自己的编码按标签字符串统一成一套。
+        """
+        table = cls([])
+        for col in cls.COLUMNS:
+            labels = list(dict.fromkeys(label for _, _, cols in chunks for label in cols[col][1]))
+            lookup = {v: i for i, v in enumerate(labels)}
+            parts = []
+            for _, _, cols in chunks:
+                codes, chunk_labels = cols[col]
+                remap = np.array([lookup[label] for label in chunk_labels], dtype=np.int32)
+                parts.append(remap[np.asarray(codes, dtype=np.int64)])
+            setattr(table, col, np.concatenate(parts) if parts else np.zeros(0, dtype=np.int32))
+            table.labels[col] = labels
+        table.turn = np.concatenate([np.asarray(t, dtype=np.int16) for _, t, _ in chunks])
+        table.score = np.concatenate([np.asarray(s, dtype=np.float32) for s, _, _ in chunks])
+        return table
+
+    def __len__(self):
+        return len(self.score)
+
+
+def _factorize(values):
+    # 保持首次出现的顺序：运行批次按传入顺序编码，第一个即基线
+    labels = list(dict.fromkeys(values))
+    lookup = {v: i for i, v in enumerate(labels)}
+    return np.fromiter((lookup[v] for v in values), dtype=np.int32, count=len(values)), labels
+
+
+def _read_jsonl(path):
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+
+
+def _category(sample):
+    return sample.get("category") or sample.get("scheme_type") or "unknown"
+
+
+def _as_score(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def load_scores(judged_dirs, eval_root=EVAL_ROOT):
+    """读取所有打分结果，返回 {"holistic": ScoreTable, "turn": ScoreTable, "eval": ScoreTable}"""
+    rows = {"holistic": [], "eval": []}
+    turn_chunks = []
+
+    for judged_dir in judged_dirs:
+        run = os.path.basename(os.path.normpath(judged_dir))
+
+        for path in sorted(glob.glob(os.path.join(judged_dir, "holistic_score_*.jsonl"))):
+            for s in _read_jsonl(path):
+                score = _as_score(s.get("holistic_score"))
+                if score is not None and not str(s.get("holistic_analysis", "")).startswith("Error"):
+                    rows["holistic"].append({"model": s.get("model", "unknown"), "category": _category(s),
+                                             "run": run, "score": score})
+
+        # 逐轮分数走列式 sidecar：只读数值列 (mmap)，不解析每轮的文本
+        for path in sorted(glob.glob(os.path.join(judged_dir, "score_*.jsonl"))):
+            store = load_turn_store(path)
+            valid = ~np.isnan(store.score)
+            turn_chunks.append((store.score[valid], store.turn_index[valid], {
+                "model": (store.model[valid], store.labels["model"]),
+                "category": (store.category[valid], store.labels["category"]),
+                "run": (np.zeros(int(valid.sum()), dtype=np.int32), [run]),
+            }))
+
+    for path in sorted(glob.glob(os.path.join(eval_root, "*", "*_score.json"))):
+        with open(path, "r", encoding="utf-8") as f:
+            s = json.load(f)
+        score = _as_score(s.get("score"))
+        if score is not None:
+            rows["eval"].append({"model": s.get("model_name", "unknown"),
+                                 "category": f"{s.get('category', '')}/{s.get('sub_category', '')}",
+                                 "run": os.path.basename(os.path.dirname(path)), "score": score})
+
+    tables = {kind: ScoreTable(r) for kind, r in rows.items() if r}
+    if sum(len(chunk[0]) for chunk in turn_chunks):
+        tables["turn"] = ScoreTable.from_columns(turn_chunks)
+    return tables
+
+
+# ================= 向量化统计 =================
+def bootstrap_group_means(group, score, n_groups, n_boot=N_BOOTSTRAP, seed=SEED):
+    """
+    所有分组的 bootstrap 均值。
+    打分是 0-10 这类离散值，先把每组压缩成 (取值, 次数) 直方图，
+    对直方图做多项式重采样，与逐条有放回抽样完全等价，
+    但开销只和 n_boot × 不同取值个数 有关，与样本量无关。
+    返回 (点估计均值 [G], 重采样均值 [n_boot, G])
+    """
+    x = score.astype(np.float64)
+    order = np.lexsort((x, group))
+    g, v = group[order], x[order]
+    starts = np.concatenate(([0], np.flatnonzero((np.diff(g) != 0) | (np.diff(v) != 0)) + 1))
+    values, owners = v[starts], g[starts]
+    counts = np.diff(np.append(starts, len(v)))
+    bounds = np.searchsorted(owners, np.arange(n_groups + 1))
+
+    rng = np.random.default_rng(seed)
+    means = np.full(n_groups, np.nan)
+    reps = np.full((n_boot, n_groups), np.nan)
+    for gi in range(n_groups):
+        lo, hi = bounds[gi], bounds[gi + 1]
+        if lo == hi:
+            continue
+        vals, cnt = values[lo:hi], counts[lo:hi]
+        n = cnt.sum()
+        means[gi] = cnt @ vals / n
+        reps[:, gi] = rng.multinomial(n, cnt / n, size=n_boot) @ vals / n
+    return means, reps
+
+
+def confidence_interval(reps, level=CI_LEVEL):
+    alpha = (1 - level) / 2 * 100
+    with np.errstate(invalid="ignore"):
+        low, high = np.nanpercentile(reps, [alpha, 100 - alpha], axis=0)
+    return low, high
+
+
+def group_stats(table, keys, n_boot=N_BOOTSTRAP):
+    """
+    按 keys (列名列表，例如 ["model"] / ["model", "turn"]) 分组，
+    返回 (行列表, 组编码, 重采样矩阵)；行里包含各 key 的标签、n、mean、ci_low、ci_high。
+    """
+    cols = [table.turn.astype(np.int64) if k == "turn" else getattr(table, k).astype(np.int64) for k in keys]
+    score = table.score
+
+    # 多列编码合并成一个组编号
+    combined, inverse = np.unique(np.stack(cols, axis=1), axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    n_groups = len(combined)
+
+    means, reps = bootstrap_group_means(inverse, score, n_groups, n_boot)
+    low, high = confidence_interval(reps)
+    counts = np.bincount(inverse, minlength=n_groups)
+
+    rows = []
+    for gi, codes in enumerate(combined):
+        row = {}
+        for k, code in zip(keys, codes):
+            row[k] = int(code) if k == "turn" else table.labels[k][code]
+        row.update({"n": int(counts[gi]), "mean": round(float(means[gi]), 3),
+                    "ci_low": round(float(low[gi]), 3), "ci_high": round(float(high[gi]), 3)})
+        rows.append(row)
+    return rows, combined, reps
+
+
+def compare_runs(table, n_boot=N_BOOTSTRAP):
+    """
+    每个模型在各次运行上的均值，相对第一次运行 (基线) 的差值及其 bootstrap 置信区间。
+    不同运行的重采样相互独立，差值的分布直接由重采样矩阵逐列相减得到。
+    """
+    if len(table.labels["run"]) < 2:
+        return []
+    rows, combined, reps = group_stats(table, ["run", "model"], n_boot)
+    col = {(int(r), int(m)): i for i, (r, m) in enumerate(combined)}
+
+    comparisons = []
+    for row, (r, m) in zip(rows, combined):
+        base = col.get((0, int(m)))
+        if r == 0 or base is None:
+            continue
+        diff = reps[:, col[(int(r), int(m))]] - reps[:, base]
+        low, high = confidence_interval(diff[:, None])
+        delta = row["mean"] - rows[base]["mean"]
+        comparisons.append({
+            "model": row["model"], "run": row["run"], "baseline_run": table.labels["run"][0],
+            "delta": round(delta, 3), "ci_low": round(float(low[0]), 3), "ci_high": round(float(high[0]), 3),
+            # 置信区间不跨 0 才算显著变化
+            "significant": bool(low[0] > 0 or high[0] < 0),
+        })
+    return comparisons
+
+
+# ================= 报告 =================
+def build_report(tables, n_boot=N_BOOTSTRAP):
+    report = {"n_bootstrap": n_boot, "ci_level": CI_LEVEL}
+    for kind, table in tables.items():
+        section = {
+            "n_scores": len(table),
+            "by_model": group_stats(table, ["model"], n_boot)[0],
+            "by_model_category": group_stats(table, ["model", "category"], n_boot)[0],
+            "run_comparison": compare_runs(table, n_boot),
+        }
+        if kind == "turn":
+            section["turn_curve"] = group_stats(table, ["model", "turn"], n_boot)[0]
+        report[kind] = section
+    return report
+
+
+def print_report(report):
+    for kind in ("holistic", "turn", "eval"):
+        section = report.get(kind)
+        if not section:
+            continue
+        print(f"\n📊 [{kind}] 共 {section['n_scores']} 个分数")
+        print(f"  {'模型':<28} {'n':>7} {'均值':>7}  {int(CI_LEVEL * 100)}% CI")
+        for r in sorted(section["by_model"], key=lambda r: -r["mean"]):
+            print(f"  {r['model']:<28} {r['n']:>7} {r['mean']:>7.2f}  [{r['ci_low']:.2f}, {r['ci_high']:.2f}]")
+        for c in section["run_comparison"]:
+            flag = "⬆️" if c["significant"] and c["delta"] > 0 else "⬇️" if c["significant"] else "  "
+            print(f"  {flag} {c['model']} {c['baseline_run']} -> {c['run']}: "
+                  f"{c['delta']:+.2f} [{c['ci_low']:+.2f}, {c['ci_high']:+.2f}]")
+
+
+def main(judged_dirs=None, eval_root=EVAL_ROOT, output_path=REPORT_PATH, n_boot=N_BOOTSTRAP):
+    judged_dirs = judged_dirs or [DEFAULT_JUDGED_DIR]
+    tables = load_scores(judged_dirs, eval_root)
+    if not tables:
+        print("❌ 没有找到任何打分结果，请先运行 Step 4 或 step_eval_full_new")
+        return
+
+    report = build_report(tables, n_boot)
+    Path(output_path).parent.mkdir(parents=True, exist_ok=True)
+    with open(output_path, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+    print_report(report)
+    print(f"\n💾 分析报告已保存: {output_path}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="打分结果分析与跨运行对比")
+    parser.add_argument("--judged-dir", nargs="+", default=[DEFAULT_JUDGED_DIR],
+                        help="一个或多个打分目录，每个目录视为一次运行 (第一个为基线)")
+    parser.add_argument("--eval-root", default=EVAL_ROOT)
+    parser.add_argument("--output", default=REPORT_PATH)
+    parser.add_argument("--boot", type=int, default=N_BOOTSTRAP)
+    args = parser.parse_args()
+    main(args.judged_dir, args.eval_root, args.output, args.boot)
@@ -0,0 +1,380 @@
+"""
+step7_diversity.py
+生成多样性分析：每个模型 (以及模型 × 类别) 的 distinct-1/2/3、self-BLEU、字符 n-gram 重合度
+
+打分只衡量质量，这里衡量"同一个模型是不是总在说差不多的话"：
+    - distinct-n:     该组全部对话里不重复的字符 n-gram 占比 (越高越多样)
+    - self-BLEU:      同一问题的多次生成之间，每段对话以其余几段为参考算 BLEU-4，再取平均 (越低越多样)
+    - ngram_overlap:  每段对话的不重复字符 4-gram 中，也出现在同一问题其他生成里的比例 (越低越多样)
+
+对话按 (模型, 类别, 问题) 排序后分批，每批的字符拼成一个 NumPy 数组，n-gram 按位置向量化算哈希
+(对话编号放在高位，一次排序就能按对话计数)，之后的计数、裁剪、分组平均都是数组运算，
+几十万段对话也只需要几秒，内存只和批大小有关。
+
+数据来源：
+    - <raw_dir>/data_*.jsonl                         (step1_gen_batch / step1_gen_selfplay)
+      同一 (文件, 模型, 问题) 的多次生成视为一组做 self-BLEU / 重合度
+    - outputs/eval_full/<时间戳>/*_dialogue.json     (step_eval_full_new，同一批次同一子类别视为一组)
+
+使用方法：
+    python step7_diversity.py
+    python step7_diversity.py --raw-dir outputs/raw --output outputs/analytics/diversity_report.json
+"""
+
+import os
+import re
+import json
+import glob
+import time
+import argparse
+from pathlib import Path
+
+import numpy as np
+
+from step0_config import DEFAULT_RAW_DIR
+
+EVAL_ROOT = "outputs/eval_full"
+# 与 step6 的 score_report.json 放在一起
+REPORT_PATH = "outputs/analytics/diversity_report.json"
+
+DISTINCT_N = (1, 2, 3)   # 计算 distinct-n 的 n
+BLEU_N = 4               # self-BLEU 用到的最大 n-gram
+OVERLAP_N = 4            # 字符 n-gram 重合度用的 n
+CHUNK_CHARS = 4_000_000  # 每批处理的字符数 (按组对齐)，控制峰值内存
+
+# n-gram 哈希：64 位多项式哈希混合后取高 40 位；再把 (批内) 对话编号或分组编号放在高 24 位，
+# 这样 (对话, n-gram) 可以合成一个 uint64，一次排序完成计数
+HASH_BITS = 40
+HASH_MASK = np.uint64((1 << HASH_BITS) - 1)
+_HASH_BASE = np.uint64(1000003)
+_HASH_MIX = np.uint64(0x9E3779B97F4A7C15)
+MAX_DOCS = 1 << (64 - HASH_BITS)
+
+# 去掉 "【AiMe】:" 这类角色标签和所有空白，只保留说出来的字
+_STRIP = re.compile(r"【[^】]*】[:：]?|\s+")
+
+
+# ================= 数据装载 =================
+def _category(sample):
+    return sample.get("category") or sample.get("scheme_type") or "unknown"
+
+
+def _model_from_file(path):
+    name = os.path.basename(path)
+    return name[len("data_"):-len(".jsonl")] if name.startswith("data_") else name
+
+
+def load_dialogues(raw_dir=DEFAULT_RAW_DIR, eval_root=EVAL_ROOT):
+    """返回 [(文本, 模型, 类别, 组键), ...]；组键相同的对话是同一问题的多次生成"""
+    docs = []
+    for path in sorted(glob.glob(os.path.join(raw_dir, "data_*.jsonl"))):
+        default_model = _model_from_file(path)
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    s = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                text = s.get("dialogue_content", "")
+                if text:
+                    model = s.get("model", default_model)
+                    docs.append((text, model, _category(s), (path, model, s.get("question", ""))))
+
+    for path in sorted(glob.glob(os.path.join(eval_root, "*", "*_dialogue.json"))):
+        with open(path, "r", encoding="utf-8") as f:
+            d = json.load(f)
+        text = "\n".join(str(m.get("content", "")) for m in d.get("messages", []) if isinstance(m, dict))
+        if text:
+            run = os.path.basename(os.path.dirname(path))
+            docs.append((text, d.get("model_name", "unknown"), f"{d.get('category', '')}/{d.get('sub_category', '')}",
+                         (run, d.get("model_name"), d.get("prompt_name"))))
+    return docs
+
+
+def _factorize(values):
+    labels = list(dict.fromkeys(values))
+    lookup = {v: i for i, v in enumerate(labels)}
+    return np.fromiter((lookup[v] for v in values), dtype=np.int64, count=len(values)), labels
+
+
+# ================= n-gram 计数 =================
+def _unique(keys, return_counts=False):
+    """排序去重 (对大的 uint64 数组比 np.unique 快得多)"""
+    keys = np.sort(keys)
+    first = np.ones(len(keys), dtype=bool)
+    first[1:] = keys[1:] != keys[:-1]
+    starts = np.flatnonzero(first)
+    if return_counts:
+        return keys[starts], np.diff(np.append(starts, len(keys)))
+    return keys[starts]
+
+
+def encode(texts):
+    """所有对话拼成一个码点数组，返回 (码点, 每段起点, 每段长度)"""
+    cleaned = [_STRIP.sub("", t) for t in texts]
+    lengths = np.fromiter((len(t) for t in cleaned), dtype=np.int64, count=len(cleaned))
+    codes = np.frombuffer("".join(cleaned).encode("utf-32-le"), dtype=np.uint32).astype(np.uint64)
+    starts = np.concatenate([[0], np.cumsum(lengths)[:-1]]) if len(lengths) else lengths
+    return codes, starts, lengths
+
+
+def doc_ngram_counts(codes, starts, lengths, n):
+    """
+    每段对话里每个字符 n-gram 的出现次数 (不跨对话)。
+    返回按 (对话, 哈希) 排好序的 (对话编号, 哈希, 次数)。
+    """
+    total = len(codes) - n + 1
+    if total <= 0:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty.astype(np.uint64), empty
+    h = np.zeros(total, dtype=np.uint64)
+    for k in range(n):
+        h = h * _HASH_BASE + codes[k:k + total]
+    h = (h * _HASH_MIX) >> np.uint64(64 - HASH_BITS)
+
+    doc = np.repeat(np.arange(len(lengths), dtype=np.int64), lengths)[:total]
+    valid = np.arange(total) + n <= (starts + lengths)[doc]
+    key = (doc[valid].astype(np.uint64) << np.uint64(HASH_BITS)) | h[valid]
+    key, counts = _unique(key, return_counts=True)
+    return (key >> np.uint64(HASH_BITS)).astype(np.int64), key & HASH_MASK, counts.astype(np.int64)
+
+
+# ================= 指标 =================
+class DistinctCounter:
+    """
+    按分组累计 distinct-n。对话按分组排好序分批送进来，
+    某个分组之后不会再出现时就对它的 n-gram 去重计数并释放，内存只占当前未完成的分组。
+    """
+
+    def __init__(self, n_groups):
+        self.unique = np.zeros(n_groups, dtype=np.int64)
+        self.total = np.zeros(n_groups)
+        self.pending = np.zeros(0, dtype=np.uint64)
+
+    def add(self, group, h, counts):
+        self.total += np.bincount(group, weights=counts, minlength=len(self.total))
+        keys = _unique((group.astype(np.uint64) << np.uint64(HASH_BITS)) | h)
+        self.pending = np.concatenate([self.pending, keys])
+
+    def flush(self, before=None):
+        """编号小于 before 的分组已经完整，计数后释放；before=None 时全部计数"""
+        # pending 按分组编号单调不减，可以二分找分界
+        cut = len(self.pending) if before is None else int(
+            np.searchsorted(self.pending, np.uint64(before) << np.uint64(HASH_BITS)))
+        done = _unique(self.pending[:cut])
+        self.unique += np.bincount((done >> np.uint64(HASH_BITS)).astype(np.int64), minlength=len(self.unique))
+        self.pending = self.pending[cut:]
+
+    def ratio(self):
+        return np.divide(self.unique, self.total, out=np.full(len(self.total), np.nan), where=self.total > 0)
+
+
+def _set_stats(doc, h, counts, doc_set):
+    """
+    同一组 (同一问题的多次生成) 内，按 n-gram 统计：
+    每行 (对话, n-gram) 在其余对话中的最大次数 (BLEU 裁剪用)，以及出现该 n-gram 的对话数。
+    返回与输入行对齐的 (max_other, n_docs)。
+    """
+    key = (doc_set[doc].astype(np.uint64) << np.uint64(HASH_BITS)) | h
+    # 输入按 (对话, 哈希) 有序，每段对话是一段已排好的 run，稳定排序 (timsort) 合并这些 run 很快
+    order = np.argsort(key, kind="stable")
+    key, c = key[order], counts[order]
+    first = np.ones(len(key), dtype=bool)
+    first[1:] = key[1:] != key[:-1]
+    starts = np.flatnonzero(first)
+    gi = np.cumsum(first) - 1
+
+    top1 = np.maximum.reduceat(c, starts) if len(c) else c
+    at_top = np.add.reduceat((c == top1[gi]).astype(np.int64), starts) if len(c) else c
+    below = np.maximum.reduceat(np.where(c == top1[gi], 0, c), starts) if len(c) else c
+    # 最大值不止一个时第二大也等于最大值
+    second = np.where(at_top > 1, top1, below)
+    # 自己是最大值就取第二大，否则取最大
+    max_other = np.where(c == top1[gi], second[gi], top1[gi])
+    size = np.diff(np.append(starts, len(c)))
+
+    result_other = np.empty_like(max_other)
+    result_docs = np.empty_like(size[gi])
+    result_other[order] = max_other
+    result_docs[order] = size[gi]
+    return result_other, result_docs
+
+
+def _closest_ref_length(lengths, doc_set):
+    """每段对话在同组其他对话里最接近的长度 (BLEU 短句惩罚用；一样近取较短的)"""
+    order = np.lexsort((lengths, doc_set))
+    s, L = doc_set[order], lengths[order].astype(np.float64)
+    prev = np.full(len(L), np.inf)
+    nxt = np.full(len(L), np.inf)
+    same_prev = np.zeros(len(L), dtype=bool)
+    same_prev[1:] = s[1:] == s[:-1]
+    prev[1:] = np.where(same_prev[1:], L[:-1], np.inf)
+    same_next = np.zeros(len(L), dtype=bool)
+    same_next[:-1] = same_prev[1:]
+    nxt[:-1] = np.where(same_next[:-1], L[1:], np.inf)
+    ref = np.where(np.abs(L - prev) <= np.abs(nxt - L), prev, nxt)
+    result = np.empty_like(ref)
+    result[order] = ref
+    return result
+
+
+def chunk_metrics(texts, doc_set, groups, counters):
+    """
+    一批对话 (同一组的对话不会跨批) 的 self-BLEU 与 n-gram 重合度；
+    顺便把各 n 的 n-gram 计入 counters[(分组层级, n)] (distinct-n)。
+    返回每段对话的 (self-BLEU, 重合度)，不参与统计的对话为 NaN。
+    """
+    codes, starts, lengths = encode(texts)
+    n_docs = len(texts)
+    set_size = np.bincount(doc_set)[doc_set]
+    eligible = (set_size > 1) & (lengths >= BLEU_N)
+
+    log_p = np.zeros(n_docs)
+    overlap = np.full(n_docs, np.nan)
+    for n in sorted(set(DISTINCT_N) | set(range(1, BLEU_N + 1)) | {OVERLAP_N}):
+        doc, h, c = doc_ngram_counts(codes, starts, lengths, n)
+        if n in DISTINCT_N:
+            for level, doc_group in groups.items():
+                counters[(level, n)].add(doc_group[doc], h, c)
+        if n > BLEU_N and n != OVERLAP_N:
+            continue
+        max_other, docs_with = _set_stats(doc, h, c, doc_set)
+
+        if n <= BLEU_N:
+            # self-BLEU：对同组其余对话的裁剪精度，n>1 加一平滑
+            clipped = np.bincount(doc, weights=np.minimum(c, max_other), minlength=n_docs)
+            total = np.bincount(doc, weights=c, minlength=n_docs)
+            smooth = 1.0 if n > 1 else 0.0
+            p = np.divide(clipped + smooth, total + smooth, out=np.zeros(n_docs), where=(total + smooth) > 0)
+            log_p += np.log(np.maximum(p, 1e-9)) / BLEU_N
+
+        if n == OVERLAP_N:
+            # 字符 n-gram 重合度：不重复 n-gram 中也出现在同组其他对话里的比例
+            shared = np.bincount(doc, weights=(docs_with > 1), minlength=n_docs)
+            distinct_grams = np.bincount(doc, minlength=n_docs)
+            ok = eligible & (distinct_grams > 0)
+            overlap[ok] = shared[ok] / distinct_grams[ok]
+
+    ref_len = _closest_ref_length(lengths, doc_set)
+    hyp_len = lengths.astype(np.float64)
+    ratio = np.divide(ref_len, hyp_len, out=np.full(n_docs, np.inf), where=hyp_len > 0)
+    brevity = np.where(hyp_len > ref_len, 1.0, np.exp(1 - ratio))
+    bleu = np.where(eligible, brevity * np.exp(log_p), np.nan)
+    return bleu, overlap
+
+
+def _chunks(set_sorted, sizes, chunk_chars=None):
+    """按组对齐切批：每批约 CHUNK_CHARS 个字符，同一组的对话不拆开。返回 [(起, 止), ...] (排序后的下标)"""
+    chunk_chars = chunk_chars or CHUNK_CHARS
+    boundaries = np.flatnonzero(np.diff(set_sorted)) + 1
+    ends = np.append(boundaries, len(set_sorted))
+    chars = np.cumsum(sizes)
+    spans, start, base = [], 0, 0
+    for end in ends:
+        if chars[end - 1] - base >= chunk_chars:
+            spans.append((start, int(end)))
+            start, base = int(end), chars[end - 1]
+    if start < len(set_sorted):
+        spans.append((start, len(set_sorted)))
+    return spans
+
+
+def compute_metrics(docs):
+    """返回 {"dialogues", "by_model": [...], "by_model_category": [...]}"""
+    n_docs = len(docs)
+    model, model_labels = _factorize([d[1] for d in docs])
+    category, category_labels = _factorize([d[2] for d in docs])
+    doc_set, _ = _factorize([d[3] for d in docs])
+    n_categories = len(category_labels)
+    levels = {
+        "by_model": (model, len(model_labels), lambda g: {"model": model_labels[g]}),
+        "by_model_category": (model * n_categories + category, len(model_labels) * n_categories,
+                              lambda g: {"model": model_labels[g // n_categories],
+                                         "category": category_labels[g % n_categories]}),
+    }
+
+    # 按 (模型, 类别, 组) 排序后分批：每个分组的对话连续出现，distinct 计数可以边算边释放
+    order = np.lexsort((doc_set, category, model))
+    sizes = np.fromiter((len(docs[i][0]) for i in order), dtype=np.int64, count=n_docs)
+    counters = {(level, n): DistinctCounter(n_groups) for level, (_, n_groups, _) in levels.items() for n in DISTINCT_N}
+    bleu = np.full(n_docs, np.nan)
+    overlap = np.full(n_docs, np.nan)
+    spans = _chunks(doc_set[order], sizes)
+    for i, (start, end) in enumerate(spans):
+        idx = order[start:end]
+        if len(idx) >= MAX_DOCS:
+            raise ValueError(f"同一批对话数超过 {MAX_DOCS}，请调小 CHUNK_CHARS")
+        _, local_set = np.unique(doc_set[idx], return_inverse=True)
+        groups = {level: doc_group[idx] for level, (doc_group, _, _) in levels.items()}
+        bleu[idx], overlap[idx] = chunk_metrics([docs[j][0] for j in idx], local_set.reshape(-1), groups, counters)
+        for level, (doc_group, _, _) in levels.items():
+            before = doc_group[order[end]] if end < n_docs else None
+            for n in DISTINCT_N:
+                counters[(level, n)].flush(before)
+
+    result = {"dialogues": n_docs}
+    for level, (doc_group, n_groups, labels_of) in levels.items():
+        size = np.bincount(doc_group, minlength=n_groups)
+        columns = {f"distinct_{n}": counters[(level, n)].ratio() for n in DISTINCT_N}
+        for name, values in (("self_bleu", bleu), ("ngram_overlap", overlap)):
+            ok = ~np.isnan(values)
+            total = np.bincount(doc_group[ok], weights=values[ok], minlength=n_groups)
+            k = np.bincount(doc_group[ok], minlength=n_groups)
+            columns[name] = np.divide(total, k, out=np.full(n_groups, np.nan), where=k > 0)
+            columns[f"{name}_n"] = k
+        rows = []
+        for g in np.flatnonzero(size):
+            row = labels_of(int(g))
+            row["dialogues"] = int(size[g])
+            for name, values in columns.items():
+                v = values[g]
+                row[name] = int(v) if name.endswith("_n") else (None if np.isnan(v) else round(float(v), 4))
+            rows.append(row)
+        result[level] = rows
+    return result
+
+
+# ================= 报告 =================
+def print_report(report):
+    print(f"\n🌈 生成多样性 (共 {report['dialogues']} 段对话，耗时 {report['elapsed_seconds']}s)")
+    header = "".join(f"{'distinct-' + str(n):>12}" for n in DISTINCT_N)
+    print(f"  {'模型':<28} {'n':>7}{header}{'self-BLEU':>12}{'重合度':>10}")
+    for r in sorted(report["by_model"], key=lambda r: r["self_bleu"] if r["self_bleu"] is not None else 2):
+        cells = "".join(f"{r[f'distinct_{n}']:>12.4f}" for n in DISTINCT_N)
+        bleu = f"{r['self_bleu']:>12.4f}" if r["self_bleu"] is not None else f"{'-':>12}"
+        over = f"{r['ngram_overlap']:>10.4f}" if r["ngram_overlap"] is not None else f"{'-':>10}"
+        print(f"  {r['model']:<28} {r['dialogues']:>7}{cells}{bleu}{over}")
+    print("  distinct 越高越多样；self-BLEU / 重合度越低越多样 (只统计同一问题有多次生成的对话)")
+
+
+def main(raw_dir=DEFAULT_RAW_DIR, eval_root=EVAL_ROOT, output_path=REPORT_PATH):
+    started = time.time()
+    docs = load_dialogues(raw_dir, eval_root)
+    if not docs:
+        print("❌ 没有找到任何生成的对话，请先运行 Step 1 或 step_eval_full_new")
+        return
+    loaded = time.time()
+
+    report = compute_metrics(docs)
+    report.update({
+        "distinct_n": list(DISTINCT_N), "bleu_n": BLEU_N, "overlap_n": OVERLAP_N,
+        "load_seconds": round(loaded - started, 3),
+        "elapsed_seconds": round(time.time() - started, 3),
+    })
+    Path(output_path).parent.mkdir(parents=True, exist_ok=True)
+    with open(output_path, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+    print_report(report)
+    print(f"\n💾 多样性报告已保存: {output_path}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="生成多样性分析 (distinct-n / self-BLEU / n-gram 重合度)")
+    parser.add_argument("--raw-dir", default=DEFAULT_RAW_DIR)
+    parser.add_argument("--eval-root", default=EVAL_ROOT)
+    parser.add_argument("--output", default=REPORT_PATH)
+    args = parser.parse_args()
+    main(args.raw_dir, args.eval_root, args.output)
@@ -14,12 +14,22 @@ step_eval_full.py
 """
 
 import json
-import requests
-import time
 import os
+import glob
 from pathlib import Path
 from datetime import datetime
 
+from utils.chat_utils import chat_completion, print_hedge_report
+from utils.circuit_breaker import get_breaker, print_breaker_report
+from utils.single_flight import print_single_flight_report
+from utils.run_metrics import RUN_METRICS
+from utils.text_compaction import compact_for_judge
+from utils.dashboard import DASHBOARD
+from utils.tracing import traced, sleep
+from utils.dry_run import new_plan, add_calls, run_cli
+from utils.dialogue_validation import rules_from_prompt, validate_dialogue
+from utils.prejudge import PreJudge
+
 # ==========================================
 # 配置区域
 # ==========================================
@@ -29,6 +39,15 @@ API_KEY = "sk-Pz9c6awbV846oRqlNOrkqsggMteTxoDRnGMsSf0RAni"
 
 # 评分模型（固定为 qwen-max-latest）
 JUDGE_MODEL = "qwen-max-latest"
+# 主评分模型熔断或故障时的备用评分模型
+JUDGE_FALLBACK_MODEL = "turing/deepseek-v3.1"
+
+# 生成结果结构校验不通过 (轮数/先开口的角色/角色交替/空内容/非 JSON) 时最多重新生成几次；
+# 仍不通过的对话不送裁判，分数记为 None，不计入平均分
+MAX_REGENERATIONS = 2
+
+# 历史打分结果的根目录 (本地预判用它校准阈值)
+EVAL_ROOT = "outputs/eval_full"
 
 # 5个要测试的模型
 MODELS = [
@@ -593,6 +612,9 @@ PROMPTS = {
     },
 }
 
+# 每个子类别的结构校验规则，从 Prompt 的【生成要求】推出 (轮数范围、谁先开口、JSON 输出)
+VALIDATION_RULES = {name: rules_from_prompt(config) for name, config in PROMPTS.items()}
+
 # ==========================================
 # 评分Prompt
 # ==========================================
@@ -623,40 +645,25 @@ JUDGE_PROMPT = """你是一个专业的对话质量评分员。请对以下AiMe
 # 核心函数
 # ==========================================
 
-def call_api(model_id: str, prompt: str, temperature: float = 0.8) -> dict:
-    """调用API"""
-    headers = {
-        "Authorization": f"Bearer {API_KEY}",
-        "Content-Type": "application/json"
-    }
-    
-    data = {
-        "model": model_id,
-        "messages": [{"role": "user", "content": prompt}],
-        "temperature": temperature,
-        "max_tokens": 4000
-    }
-    
-    for attempt in range(3):
-        try:
-            response = requests.post(API_URL, headers=headers, json=data, timeout=120)
-            if response.status_code == 200:
-                result = response.json()
-                content = result.get("choices", [{}])[0].get("message", {}).get("content", "")
-                return {"success": True, "content": content}
-            elif response.status_code == 429:
-                print(f"限流...", end=" ")
-                time.sleep(5 * (attempt + 1))
-            else:
-                print(f"错误{response.status_code}...", end=" ")
-                time.sleep(2)
-        except Exception as e:
-            print(f"异常...", end=" ")
-            time.sleep(2)
-    
-    return {"success": False, "error": "API调用失败"}
-
-
+def call_api(model_id: str, prompt: str, temperature: float = 0.8, budget_key: str = None,
+             fallback_model: str = None) -> dict:
+    """调用API (max_tokens 按该模型在该 prompt 上的历史输出长度自动设定；已熔断的模型快速失败)"""
+    result = chat_completion(
+        API_URL,
+        API_KEY,
+        model_id,
+        [{"role": "user", "content": prompt}],
+        temperature=temperature,
+        timeout=120,
+        budget_key=budget_key,
+        fallback_model=fallback_model
+    )
+    if result["success"]:
+        return {"success": True, "content": result["content"], "model": result["model"]}
+    return {"success": False, "error": "API调用失败", "model": result["model"], "circuit_open": result.get("circuit_open", False)}
+
+
+@traced(cat="parse")
 def parse_json(content: str) -> dict:
     """解析JSON"""
     content = content.replace("```json", "").replace("```", "").strip()
@@ -682,6 +689,200 @@ def format_dialogue(messages: list) -> str:
     return text
 
 
+def generate_dialogue(prompt_name: str, prompt_config: dict, model: dict) -> dict:
+    """
+    让被测模型生成一段完整对话，返回对话JSON (circuit_open 表示模型已熔断)。
+    生成结果先按 VALIDATION_RULES 做本地结构校验，不通过就立即重新生成，最多 MAX_REGENERATIONS 次；
+    validation 为 None 表示生成本身失败 (没有可校验的输出)。
+    """
+    rules = VALIDATION_RULES[prompt_name]
+    validation = None
+    for attempt in range(1 + MAX_REGENERATIONS):
+        gen_result = call_api(model["model_id"], prompt_config["prompt"], budget_key=prompt_name)
+        if not gen_result.get("success"):
+            validation = None
+            break
+        parse_result = parse_json(gen_result["content"])
+        messages, errors = validate_dialogue(parse_result, rules)
+        validation = {"passed": not errors, "attempts": attempt + 1, "errors": errors}
+        if not errors:
+            break
+        RUN_METRICS.incr("validation_failed")
+        if attempt < MAX_REGENERATIONS:
+            RUN_METRICS.incr("validation_regenerated")
+            print(f"结构不合格({errors[0]})，重新生成...", end=" ", flush=True)
+    
+    if gen_result.get("success"):
+        if messages:
+            dialogue_text = format_dialogue(messages)
+            turn_count = len(messages)
+            print(f"{turn_count}轮...", end=" ", flush=True)
+        else:
+            dialogue_text = gen_result["content"]
+            turn_count = 0
+    else:
+        messages = []
+        dialogue_text = ""
+        turn_count = 0
+    
+    return {
+        "prompt_name": prompt_name,
+        "category": prompt_config["category"],
+        "sub_category": prompt_config["sub_category"],
+        "fine_grained_steps": prompt_config["fine_grained_steps"],
+        "model_name": model["name"],
+        "model_id": model["model_id"],
+        "messages": messages,
+        "dialogue_text": dialogue_text,
+        "turn_count": turn_count,
+        "validation": validation,
+        "circuit_open": gen_result.get("circuit_open", False),
+        "timestamp": datetime.now().isoformat()
+    }
+
+
+# judge_dialogue 在没有真实打分时给的 comment (score 记为 0，统计时应当排除)
+JUDGE_FAILURES = ("无对话", "评分解析失败", "评分失败")
+
+
+def prejudge_history():
+    """本地预判的校准样本：EVAL_ROOT 下已有的 (对话, 裁判分)，排除本地预判给的分、没送裁判的和裁判失败的"""
+    history = []
+    for score_file in glob.glob(os.path.join(EVAL_ROOT, "*", "*_score.json")):
+        dialogue_file = score_file[:-len("_score.json")] + "_dialogue.json"
+        if not os.path.exists(dialogue_file):
+            continue
+        with open(score_file, "r", encoding="utf-8") as f:
+            score_data = json.load(f)
+        if score_data.get("judge_model") in (None, "prejudge") or not isinstance(score_data.get("score"), (int, float)):
+            continue
+        # 裁判故障 / 解析失败给的 0 分不是"差对话"的标签
+        if score_data.get("comment") in JUDGE_FAILURES:
+            continue
+        with open(dialogue_file, "r", encoding="utf-8") as f:
+            dialogue_data = json.load(f)
+        if dialogue_data.get("messages"):
+            history.append((dialogue_data["dialogue_text"], score_data.get("fine_grained_steps"), score_data["score"]))
+    return history
+
+
+# COT_PREJUDGE=1 时开启；第一次用到时才读取历史并校准
+PREJUDGE = PreJudge("eval_full", prejudge_history)
+
+
+def judge_dialogue(prompt_config: dict, dialogue_text: str) -> dict:
+    """裁判打分；主裁判熔断/故障时自动切换到 JUDGE_FALLBACK_MODEL"""
+    if not dialogue_text:
+        return {"score": 0, "step_coverage": "", "comment": "无对话", "judge_model": JUDGE_MODEL}
+    
+    # 本地预判能直接判定好坏的不送裁判
+    local = PREJUDGE.triage(dialogue_text, prompt_config["fine_grained_steps"])
+    if local:
+        return {"score": local["score"], "step_coverage": "", "comment": local["analysis"], "judge_model": "prejudge"}
+    
+    # 解析失败时 dialogue_text 是原始输出，可能很长：先压缩再给裁判
+    dialogue_text, compaction = compact_for_judge(dialogue_text)
+    
+    steps_text = "\n".join(prompt_config["fine_grained_steps"])
+    judge_prompt = JUDGE_PROMPT.format(
+        category=prompt_config["category"],
+        sub_category=prompt_config["sub_category"],
+        steps=steps_text,
+        dialogue=dialogue_text
+    )
+    
+    judge_result = call_api(JUDGE_MODEL, judge_prompt, temperature=0.0, budget_key="judge",
+                            fallback_model=JUDGE_FALLBACK_MODEL)
+    judge_model = judge_result.get("model", JUDGE_MODEL)
+    
+    if judge_result.get("success"):
+        score_parse = parse_json(judge_result["content"])
+        if score_parse.get("success"):
+            return {
+                "score": score_parse["data"].get("score", 0),
+                "step_coverage": score_parse["data"].get("step_coverage", ""),
+                "comment": score_parse["data"].get("comment", ""),
+                "judge_model": judge_model,
+                "judge_input_compaction": compaction
+            }
+        return {"score": 0, "step_coverage": "", "comment": "评分解析失败", "judge_model": judge_model,
+                "judge_input_compaction": compaction}
+    return {"score": 0, "step_coverage": "", "comment": "评分失败", "judge_model": judge_model,
+            "judge_input_compaction": compaction}
+
+
+@traced(cat="item")
+def run_eval_cell(prompt_name: str, prompt_config: dict, model: dict, output_dir: str, defer_on_open: bool = True,
+                  sample_index: int = None):
+    """
+    跑一个 (子类别, 模型) 单元：生成 -> 保存对话 -> 打分 -> 保存打分。
+    被测模型已熔断且 defer_on_open=True 时不落盘，返回 None，交给调用方延后重试。
+    sample_index: 同一单元采多次样本时 (序贯评估) 用来区分文件名。
+    """
+    model_name = model["name"]
+    file_stem = f"{prompt_name}_{model_name}" + (f"_s{sample_index}" if sample_index is not None else "")
+    
+    # 1. 生成对话
+    dialogue_data = generate_dialogue(prompt_name, prompt_config, model)
+    if dialogue_data.pop("circuit_open") and defer_on_open:
+        print("已熔断，延后重试")
+        return None
+    
+    # 2. 保存对话JSON
+    dialogue_file = os.path.join(output_dir, f"{file_stem}_dialogue.json")
+    with open(dialogue_file, "w", encoding="utf-8") as f:
+        json.dump(dialogue_data, f, ensure_ascii=False, indent=2)
+    
+    # 3. 打分 (结构校验没通过的对话不送裁判)
+    validation = dialogue_data["validation"]
+    if validation is not None and not validation["passed"]:
+        RUN_METRICS.incr("validation_skipped_judge")
+        judged = {"score": None, "step_coverage": "", "comment": f"结构校验未通过: {'; '.join(validation['errors'])}",
+                  "judge_model": None}
+        print("结构校验未通过，跳过打分")
+    else:
+        judged = judge_dialogue(prompt_config, dialogue_data["dialogue_text"])
+        print(f"得分:{judged['score']}" + (" (本地预判)" if judged["judge_model"] == "prejudge" else ""))
+    
+    # 4. 保存打分JSON
+    score_data = {
+        "prompt_name": prompt_name,
+        "category": prompt_config["category"],
+        "sub_category": prompt_config["sub_category"],
+        "fine_grained_steps": prompt_config["fine_grained_steps"],
+        "model_name": model_name,
+        "model_id": model["model_id"],
+        "judge_model": judged["judge_model"],
+        "score": judged["score"],
+        "step_coverage": judged["step_coverage"],
+        "comment": judged["comment"],
+        "judge_input_compaction": judged.get("judge_input_compaction"),
+        "validation": validation,
+        "timestamp": datetime.now().isoformat()
+    }
+    
+    score_file = os.path.join(output_dir, f"{file_stem}_score.json")
+    with open(score_file, "w", encoding="utf-8") as f:
+        json.dump(score_data, f, ensure_ascii=False, indent=2)
+    
+    return score_data
+
+
+def plan():
+    """--dry-run：每个 (子类别, 模型) 单元一次生成 + 一次裁判打分 (结构校验不通过的重新生成不计入)"""
+    result = new_plan("eval_full")
+    result["items"] = len(MODELS) * len(PROMPTS)
+    for model in MODELS:
+        add_calls(result, model["model_id"], len(PROMPTS))
+    add_calls(result, JUDGE_MODEL, len(MODELS) * len(PROMPTS))
+    result["notes"].append(f"{len(PROMPTS)} 个子类别 × {len(MODELS)} 个模型，输出 {result['items'] * 2} 个 JSON 文件")
+    if PREJUDGE.enabled:
+        result["notes"].append("已开启本地预判，实际裁判调用数会更少 (阈值在运行时校准)")
+    result["notes"].append(f"结构校验不通过时每单元最多再生成 {MAX_REGENERATIONS} 次 (被测模型调用上限 ×{1 + MAX_REGENERATIONS})")
+    return result
+
+
+@traced("stage:eval_full", cat="stage")
 def main():
     total = len(MODELS) * len(PROMPTS)
     
@@ -694,113 +895,43 @@ def main():
     
     # 创建输出目录
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    output_dir = f"outputs/eval_full/{timestamp}"
+    output_dir = os.path.join(EVAL_ROOT, timestamp)
     Path(output_dir).mkdir(parents=True, exist_ok=True)
     
     counter = 0
     all_scores = {m["name"]: [] for m in MODELS}
+    deferred = []
+    DASHBOARD.begin_stage("eval_full", total=total)
     
     for prompt_name, prompt_config in PROMPTS.items():
         print(f"\n📁 {prompt_config['category']} - {prompt_config['sub_category']}")
         
         for model in MODELS:
             counter += 1
-            model_name = model["name"]
-            model_id = model["model_id"]
-            
-            print(f"  [{counter}/{total}] {model_name}...", end=" ", flush=True)
-            
-            # 1. 生成对话
-            gen_result = call_api(model_id, prompt_config["prompt"])
-            
-            if gen_result.get("success"):
-                parse_result = parse_json(gen_result["content"])
-                if parse_result.get("success"):
-                    messages = parse_result["data"].get("messages", [])
-                    dialogue_text = format_dialogue(messages)
-                    turn_count = len(messages)
-                    print(f"{turn_count}轮...", end=" ", flush=True)
-                else:
-                    messages = []
-                    dialogue_text = gen_result["content"]
-                    turn_count = 0
-            else:
-                messages = []
-                dialogue_text = ""
-                turn_count = 0
-            
-            # 2. 保存对话JSON
-            dialogue_data = {
-                "prompt_name": prompt_name,
-                "category": prompt_config["category"],
-                "sub_category": prompt_config["sub_category"],
-                "fine_grained_steps": prompt_config["fine_grained_steps"],
-                "model_name": model_name,
-                "model_id": model_id,
-                "messages": messages,
-                "dialogue_text": dialogue_text,
-                "turn_count": turn_count,
-                "timestamp": datetime.now().isoformat()
-            }
+            print(f"  [{counter}/{total}] {model['name']}...", end=" ", flush=True)
             
-            dialogue_file = os.path.join(output_dir, f"{prompt_name}_{model_name}_dialogue.json")
-            with open(dialogue_file, "w", encoding="utf-8") as f:
-                json.dump(dialogue_data, f, ensure_ascii=False, indent=2)
+            score_data = run_eval_cell(prompt_name, prompt_config, model, output_dir)
+            if score_data is None:
+                deferred.append((prompt_name, prompt_config, model))
+                continue
             
-            # 3. 打分
-            if dialogue_text:
-                steps_text = "\n".join(prompt_config["fine_grained_steps"])
-                judge_prompt = JUDGE_PROMPT.format(
-                    category=prompt_config["category"],
-                    sub_category=prompt_config["sub_category"],
-                    steps=steps_text,
-                    dialogue=dialogue_text
-                )
-                
-                judge_result = call_api(JUDGE_MODEL, judge_prompt, temperature=0.0)
-                
-                if judge_result.get("success"):
-                    score_parse = parse_json(judge_result["content"])
-                    if score_parse.get("success"):
-                        score = score_parse["data"].get("score", 0)
-                        step_coverage = score_parse["data"].get("step_coverage", "")
-                        comment = score_parse["data"].get("comment", "")
-                    else:
-                        score = 0
-                        step_coverage = ""
-                        comment = "评分解析失败"
-                else:
-                    score = 0
-                    step_coverage = ""
-                    comment = "评分失败"
-            else:
-                score = 0
-                step_coverage = ""
-                comment = "无对话"
-            
-            print(f"得分:{score}")
-            
-            # 4. 保存打分JSON
-            score_data = {
-                "prompt_name": prompt_name,
-                "category": prompt_config["category"],
-                "sub_category": prompt_config["sub_category"],
-                "fine_grained_steps": prompt_config["fine_grained_steps"],
-                "model_name": model_name,
-                "model_id": model_id,
-                "judge_model": JUDGE_MODEL,
-                "score": score,
-                "step_coverage": step_coverage,
-                "comment": comment,
-                "timestamp": datetime.now().isoformat()
-            }
-            
-            score_file = os.path.join(output_dir, f"{prompt_name}_{model_name}_score.json")
-            with open(score_file, "w", encoding="utf-8") as f:
-                json.dump(score_data, f, ensure_ascii=False, indent=2)
-            
-            all_scores[model_name].append(score)
-            time.sleep(0.5)
+            DASHBOARD.advance()
+            if score_data["score"] is not None:
+                all_scores[model["name"]].append(score_data["score"])
+            sleep(0.5, "throttle")
+    
+    # 熔断期间跳过的单元：等熔断器进入半开状态后再补跑一次
+    if deferred:
+        print(f"\n⏳ 补跑 {len(deferred)} 个因熔断延后的单元")
+    for prompt_name, prompt_config, model in deferred:
+        wait_seconds = get_breaker(model["model_id"]).retry_after()
+        if wait_seconds:
+            sleep(wait_seconds, "circuit_open")
+        print(f"  [延后] {prompt_name} / {model['name']}...", end=" ", flush=True)
+        score_data = run_eval_cell(prompt_name, prompt_config, model, output_dir, defer_on_open=False)
+        DASHBOARD.advance()
+        if score_data["score"] is not None:
+            all_scores[model["name"]].append(score_data["score"])
     
     # 汇总
     summary = {
@@ -809,7 +940,8 @@ def main():
         "total_files": total * 2,
         "judge_model": JUDGE_MODEL,
         "timestamp": datetime.now().isoformat(),
-        "model_avg_scores": {}
+        "model_avg_scores": {},
+        "run_metrics": RUN_METRICS.snapshot()
     }
     
     for model_name, scores in all_scores.items():
@@ -826,8 +958,12 @@ def main():
     print("\n📊 平均分:")
     for name, avg in summary["model_avg_scores"].items():
         print(f"   {name}: {avg}")
+    PREJUDGE.report()
+    print_hedge_report()
+    print_breaker_report()
+    print_single_flight_report()
     print("="*60)
 
 
 if __name__ == "__main__":
-    main()
+    run_cli(main, plan, "完整测试: 模型 × 子类别")
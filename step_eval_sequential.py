@@ -0,0 +1,121 @@
+"""
+step_eval_sequential.py
+序贯评估：按轮次给 (模型, 类别) 单元分配生成 + 打分，排名一旦在统计上确定就停止采样
+
+两种网格：
+    eval:  step_eval_full_new 的 14 个子类别 × 5 个模型，每个单元最多采样 --max-samples 次
+    batch: step1_gen_batch 的 问题 × 模型，每个单元最多生成 --max-samples 次 (对应原来的 num_generations)，
+           每条对话立即用 step4_whole_judge 的整体评分打分
+
+一边倒的对比 (某个模型明显领先/落后) 通常几轮就能确定，剩下的预算不再花费。
+
+使用方法：
+    python step_eval_sequential.py --grid eval
+    python step_eval_sequential.py --grid batch --max-samples 10 --goal top
+"""
+
+import os
+import json
+import argparse
+import threading
+from pathlib import Path
+from datetime import datetime
+
+from utils.file_utils import load_questions, write_jsonl
+from utils.run_metrics import RUN_METRICS
+from utils.circuit_breaker import print_breaker_report
+from utils.sequential_eval import (
+    SequentialEvaluator, print_sequential_report,
+    ALPHA, MIN_SAMPLES, MAX_SAMPLES_PER_CELL,
+)
+
+QUESTIONS_FILE = "inputs/questions.txt"
+
+
+def run_eval_grid(args):
+    from step_eval_full_new import PROMPTS, MODELS, JUDGE_FAILURES, run_eval_cell
+
+    output_dir = f"outputs/eval_full/sequential_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+    models = {m["name"]: m for m in MODELS}
+
+    def sample(model_name, prompt_name, index):
+        score_data = run_eval_cell(prompt_name, PROMPTS[prompt_name], models[model_name], output_dir,
+                                   sample_index=index)
+        # 裁判 / 端点故障给的 0 分不是真实样本，与 batch 网格排除 "Error" 一样不计入
+        if score_data is None or score_data["comment"] in JUDGE_FAILURES:
+            return None
+        return score_data["score"]
+
+    evaluator = SequentialEvaluator(models, PROMPTS, sample, alpha=args.alpha, min_samples=args.min_samples,
+                                    max_samples=args.max_samples, goal=args.goal, workers=args.workers)
+    return evaluator.run(), output_dir
+
+
+def run_batch_grid(args):
+    from step1_gen_batch import MODELS_CONFIG, MultiModelGenerator, build_record
+    from step4_whole_judge import judge_sample
+    from utils.api_utils import get_judge_client
+
+    questions = load_questions(args.questions)
+    output_dir = os.path.join("outputs", "sequential", datetime.now().strftime("%Y%m%d_%H%M%S"))
+    generators = {c["name"]: MultiModelGenerator(c) for c in MODELS_CONFIG}
+    judge_client = get_judge_client()
+    records = {name: [] for name in generators}
+    records_lock = threading.Lock()
+
+    def sample(model_name, question, index):
+        messages = generators[model_name].generate_single_dialogue(question)
+        if not messages:
+            return None
+        scored, _ = judge_sample(judge_client, build_record(question, messages, model_name, index + 1))
+        if scored is None or str(scored["holistic_analysis"]).startswith("Error"):
+            return None
+        with records_lock:
+            records[model_name].append(scored)
+        return scored["holistic_score"]
+
+    evaluator = SequentialEvaluator(generators, questions, sample, alpha=args.alpha, min_samples=args.min_samples,
+                                    max_samples=args.max_samples, goal=args.goal, workers=args.workers)
+    summary = evaluator.run()
+
+    # 生成并打过分的对话照常落盘，文件名与 step4 的输出一致，分析脚本可以直接读
+    for model_name, items in records.items():
+        if items:
+            write_jsonl(items, os.path.join(output_dir, f"holistic_score_{model_name}.jsonl"))
+    return summary, output_dir
+
+
+def main():
+    parser = argparse.ArgumentParser(description="序贯评估 (排名确定后提前停止采样)")
+    parser.add_argument("--grid", choices=["eval", "batch"], default="eval")
+    parser.add_argument("--goal", choices=["rank", "top"], default="rank",
+                        help="rank: 每个模型的名次都确定才停；top: 只要第一名确定就停")
+    parser.add_argument("--alpha", type=float, default=ALPHA)
+    parser.add_argument("--min-samples", type=int, default=MIN_SAMPLES)
+    parser.add_argument("--max-samples", type=int, default=MAX_SAMPLES_PER_CELL)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--questions", default=QUESTIONS_FILE)
+    args = parser.parse_args()
+
+    print("=" * 60)
+    print(f"🚀 序贯评估开始 | 网格 {args.grid} | 目标 {args.goal} | alpha {args.alpha} | 每单元最多 {args.max_samples} 次")
+    print("=" * 60)
+
+    if args.grid == "eval":
+        summary, output_dir = run_eval_grid(args)
+    else:
+        summary, output_dir = run_batch_grid(args)
+
+    summary["run_metrics"] = RUN_METRICS.snapshot()
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+    with open(os.path.join(output_dir, "_sequential_summary.json"), "w", encoding="utf-8") as f:
+        json.dump(summary, f, ensure_ascii=False, indent=2)
+
+    print_sequential_report(summary)
+    print_breaker_report()
+    print(f"📁 结果目录: {output_dir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,16 @@
 # utils/api_utils.py
 import os
-import openai
-import instructor
+import asyncio
+import weakref
+import threading
+
+from utils.circuit_breaker import get_breaker, CircuitOpenError
+from utils.run_metrics import RUN_METRICS
+from utils.dashboard import DASHBOARD
+from utils.tracing import span
+from utils.cassette import CASSETTE
+from utils.structured_output import structured_create, async_structured_create
+from utils.single_flight import SINGLE_FLIGHT, is_deterministic, request_key
 
 # ==========================================================
 # 配置：使用 OpenAI SDK 调用你的企业平台 API
@@ -15,17 +24,23 @@ API_BASE_URL = "https://live-turing.cn.llm.tcljd.com/api/v1"
 
 
 # --- 核心客户端初始化函数 ---
+# openai / instructor 导入要将近 1 秒，放到第一次创建客户端时再导入，
+# 这样 --help、--dry-run、输入为空等情况不用付这个启动成本
 def get_patched_client(api_key: str, base_url: str):
     """初始化并对客户端打补丁，使其支持结构化输出"""
     if not api_key:
         print("Error: API_KEY is missing.")
         return None
     
+    import openai
+    import instructor
+
     try:
         # 使用 OpenAI SDK 初始化客户端，指向您的企业平台
         client = openai.OpenAI(
             api_key=api_key, 
-            base_url=base_url
+            base_url=base_url,
+            **CASSETTE.openai_client_kwargs()
         )
     except Exception as e:
         print(f"Error initializing client: {e}")
@@ -47,4 +62,205 @@ def get_deepseek_client():
 def get_judge_client():
     """获取裁判模型客户端 (Step 4 & Optimize 专用)"""
     # 之前报错就是因为缺了这个！
-    return get_patched_client(USER_API_KEY, API_BASE_URL)
\ No newline at end of file
+    return get_patched_client(USER_API_KEY, API_BASE_URL)
+
+
+# --- 异步客户端：一个进程内同时挂起成百上千个请求，不需要一请求一线程 ---
+DEFAULT_ASYNC_LIMIT = 64  # gather_structured 默认的并发上限
+
+def get_async_patched_client(api_key: str, base_url: str):
+    """AsyncOpenAI + instructor 补丁，create 变成协程，用法与同步版一致 (一个客户端只在一个事件循环里使用)"""
+    if not api_key:
+        print("Error: API_KEY is missing.")
+        return None
+
+    import openai
+    import instructor
+
+    try:
+        client = openai.AsyncOpenAI(
+            api_key=api_key,
+            base_url=base_url,
+            **CASSETTE.openai_client_kwargs(async_client=True)
+        )
+    except Exception as e:
+        print(f"Error initializing async client: {e}")
+        return None
+
+    return instructor.patch(client)
+
+def get_async_qwen_client():
+    return get_async_patched_client(USER_API_KEY, API_BASE_URL)
+
+def get_async_deepseek_client():
+    return get_async_patched_client(USER_API_KEY, API_BASE_URL)
+
+def get_async_judge_client():
+    return get_async_patched_client(USER_API_KEY, API_BASE_URL)
+
+
+# --- 带熔断/备用模型的结构化调用 ---
+def _is_endpoint_error(e):
+    """连接失败、超时、5xx 才算端点故障；结构化校验失败不算"""
+    import openai
+
+    for err in (e, getattr(e, "__cause__", None)):
+        if isinstance(err, (openai.APIConnectionError, openai.InternalServerError)):
+            return True
+    return False
+
+def _flight_key(client, model, fallback_model, kwargs):
+    """相同端点 + 模型 + 参数 (response_model 按类名) 的请求指纹"""
+    params = dict(kwargs)
+    if "response_model" in params:
+        rm = params["response_model"]
+        params["response_model"] = f"{rm.__module__}.{rm.__qualname__}"
+    return request_key("structured", str(getattr(client, "base_url", "")), model, fallback_model, params)
+
+def guarded_create(client, model, fallback_model=None, coalesce=None, with_model=False, **kwargs):
+    """
+    经过按模型熔断器的 client.chat.completions.create。
+    主模型已熔断或端点故障时，如果给了 fallback_model (例如备用裁判) 就切换过去。
+    带 response_model 的调用按该模型配置的结构化输出模式执行 (见 utils/structured_output.py)。
+    temperature=0 (或 coalesce=True) 时，与正在进行的完全相同的请求合并，共用一个结果。
+    with_model=True 时返回 (结果, 实际作答的模型)，调用方据此区分主模型和备用模型的结果。
+    """
+    if is_deterministic(kwargs.get("temperature"), coalesce):
+        result, used = SINGLE_FLIGHT.do("structured", _flight_key(client, model, fallback_model, kwargs),
+                                        lambda: _guarded_create(client, model, fallback_model, **kwargs))
+    else:
+        result, used = _guarded_create(client, model, fallback_model, **kwargs)
+    return (result, used) if with_model else result
+
+def _guarded_create(client, model, fallback_model=None, **kwargs):
+    candidates = [model] + ([fallback_model] if fallback_model and fallback_model != model else [])
+    last_error = None
+    for i, current in enumerate(candidates):
+        breaker = get_breaker(current)
+        if not breaker.allow():
+            last_error = CircuitOpenError(f"{current} 已熔断")
+            continue
+        if i > 0:
+            RUN_METRICS.incr("failover")
+            RUN_METRICS.event("failover", model=model, fallback_model=current, reason=str(last_error)[:200])
+            print(f"    ↪️ {model} 不可用，切换到备用模型 {current}")
+        started = DASHBOARD.call_started(current)
+        try:
+            with span("llm_call", "llm", model=current):
+                if "response_model" in kwargs:
+                    result = structured_create(client, current, **kwargs)
+                else:
+                    result = client.chat.completions.create(model=current, **kwargs)
+        except Exception as e:
+            DASHBOARD.call_finished(current, started, False)
+            if not _is_endpoint_error(e):
+                # 端点正常响应，只是输出不合格：不熔断，也不切换模型
+                breaker.record_success()
+                raise
+            breaker.record_failure()
+            last_error = e
+            continue
+        DASHBOARD.call_finished(current, started, True)
+        breaker.record_success()
+        return result, current
+    raise last_error
+
+
+async def async_guarded_create(client, model, fallback_model=None, coalesce=None, with_model=False, **kwargs):
+    """guarded_create 的异步版本 (client 来自 get_async_*_client)，熔断、切换、合并与 with_model 逻辑相同"""
+    if is_deterministic(kwargs.get("temperature"), coalesce):
+        result, used = await SINGLE_FLIGHT.do_async(
+            "structured", _flight_key(client, model, fallback_model, kwargs),
+            lambda: _async_guarded_create(client, model, fallback_model, **kwargs))
+    else:
+        result, used = await _async_guarded_create(client, model, fallback_model, **kwargs)
+    return (result, used) if with_model else result
+
+
+# 异步客户端 -> 第一次使用它的事件循环
+_client_loops = weakref.WeakKeyDictionary()
+_client_loops_lock = threading.Lock()
+
+
+def _check_client_loop(client):
+    """
+    AsyncOpenAI 内部 httpx.AsyncClient 的连接池绑定在第一次使用它的事件循环上，
+    换一个循环 (例如每次 asyncio.run) 再用会报 "Event loop is closed"。
+    这里提前给出明确的错误：一个异步客户端只在一个事件循环里使用。
+    """
+    loop = asyncio.get_running_loop()
+    with _client_loops_lock:
+        bound = _client_loops.setdefault(client, loop)
+    if bound is not loop:
+        raise RuntimeError("异步客户端已绑定在另一个事件循环上；请在同一个循环里复用它 "
+                           "(同步脚本用 run_structured)，或为新的循环重新调用 get_async_*_client()")
+
+
+async def _async_guarded_create(client, model, fallback_model=None, **kwargs):
+    _check_client_loop(client)
+    candidates = [model] + ([fallback_model] if fallback_model and fallback_model != model else [])
+    last_error = None
+    for i, current in enumerate(candidates):
+        breaker = get_breaker(current)
+        if not breaker.allow():
+            last_error = CircuitOpenError(f"{current} 已熔断")
+            continue
+        if i > 0:
+            RUN_METRICS.incr("failover")
+            RUN_METRICS.event("failover", model=model, fallback_model=current, reason=str(last_error)[:200])
+            print(f"    ↪️ {model} 不可用，切换到备用模型 {current}")
+        started = DASHBOARD.call_started(current)
+        try:
+            with span("llm_call", "llm", model=current):
+                if "response_model" in kwargs:
+                    result = await async_structured_create(client, current, **kwargs)
+                else:
+                    result = await client.chat.completions.create(model=current, **kwargs)
+        except Exception as e:
+            DASHBOARD.call_finished(current, started, False)
+            if not _is_endpoint_error(e):
+                breaker.record_success()
+                raise
+            breaker.record_failure()
+            last_error = e
+            continue
+        DASHBOARD.call_finished(current, started, True)
+        breaker.record_success()
+        return result, current
+    raise last_error
+
+
+async def gather_structured(calls, limit=DEFAULT_ASYNC_LIMIT):
+    """
+    并发执行一批结构化调用，最多同时挂起 limit 个请求。
+    calls: 每项是 async_guarded_create 的参数字典，例如
+        {"client": c, "model": JUDGE_MODEL_NAME, "fallback_model": ..., "response_model": ScoreSchema,
+         "messages": [...], "temperature": 0.0, "max_retries": 2}
+    返回与 calls 顺序一致的列表，失败的位置放异常对象 (不会因为一个失败中断整批)。
+    """
+    semaphore = asyncio.Semaphore(limit)
+
+    async def run_one(call):
+        async with semaphore:
+            return await async_guarded_create(**call)
+
+    return await asyncio.gather(*(run_one(call) for call in calls), return_exceptions=True)
+
+
+_thread_loops = threading.local()
+
+
+def _structured_loop():
+    loop = getattr(_thread_loops, "loop", None)
+    if loop is None or loop.is_closed():
+        loop = _thread_loops.loop = asyncio.new_event_loop()
+    return loop
+
+
+def run_structured(calls, limit=DEFAULT_ASYNC_LIMIT):
+    """
+    在同步脚本里直接调用 gather_structured。
+    同一线程里多次调用共用一个事件循环 (不是每次 asyncio.run 新建)，
+    所以同一个异步客户端可以反复传给 run_structured。
+    """
+    return _structured_loop().run_until_complete(gather_structured(calls, limit))
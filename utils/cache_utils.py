@@ -0,0 +1,69 @@
+import os
+import json
+import hashlib
+import threading
+from pathlib import Path
+
+# ============================
+# 内容指纹
+# ============================
+def fingerprint(*parts) -> str:
+    """对任意可 JSON 序列化的内容计算稳定的 sha256 指纹"""
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(json.dumps(part, ensure_ascii=False, sort_keys=True, default=str).encode("utf-8"))
+        h.update(b"\x00")
+    return h.hexdigest()
+
+
+def file_fingerprint(file_path: str) -> str:
+    """按文件内容计算指纹；文件不存在时返回空字符串"""
+    if not os.path.exists(file_path):
+        return ""
+    h = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+# ============================
+# 单条记录缓存 (JSONL，追加写)
+# ============================
+class RecordCache:
+    """
+    以指纹为 key 缓存单条记录的处理结果，例如裁判打分。
+    输入内容、Prompt 或模型不变的记录直接复用，只有变化的记录才重新调用模型。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        try:
+                            item = json.loads(line)
+                            self.entries[item["key"]] = item["value"]
+                        except (json.JSONDecodeError, KeyError):
+                            continue
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.hits += 1
+                return self.entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps({"key": key, "value": value}, ensure_ascii=False))
+                f.write("\n")
@@ -0,0 +1,250 @@
+import os
+import sys
+import gzip
+import json
+import atexit
+import threading
+from pathlib import Path
+from urllib.parse import urlsplit
+
+from utils.cache_utils import fingerprint
+from utils.run_metrics import RUN_METRICS
+from utils import tracing
+
+# ============================
+# 请求录制 / 回放 (cassette)
+# ============================
+# 录制: COT_CASSETTE_MODE=record python step_eval_full_new.py
+# 回放: COT_CASSETTE_MODE=replay python step_eval_full_new.py   (不访问网络)
+# 文件: 默认 outputs/cassettes/<脚本名>.jsonl.gz，可用 COT_CASSETTE=路径 指定
+# 录制会覆盖同一路径的旧文件；要在旧录制后面追加时设置 COT_CASSETTE_APPEND=1
+#
+# 两条调用路径都会经过这里：
+#   - utils/chat_utils 直接发的 HTTP 请求 (requests)
+#   - OpenAI SDK / instructor 的请求 (挂在 httpx 传输层上，tools / json / prompt 三种模式都覆盖)
+# 同一个请求出现多次 (例如同一问题生成 10 次) 时按录制顺序依次回放。
+# 指纹不含 max_tokens；SDK 路径只录制最终响应 (SDK 自己重试掉的 429 / 5xx 不录)。
+CASSETTE_MODE_ENV = "COT_CASSETTE_MODE"
+CASSETTE_PATH_ENV = "COT_CASSETTE"
+CASSETTE_APPEND_ENV = "COT_CASSETTE_APPEND"
+CASSETTE_DIR = "outputs/cassettes"
+MODES = ("off", "record", "replay")
+
+
+class CassetteMiss(RuntimeError):
+    """回放模式下遇到没有录制过的请求"""
+
+
+# 不参与指纹的请求字段：max_tokens 由 TokenBudget 按历史统计给出 (utils/token_budget.py)，
+# 录制和回放时的统计文件不同，建议值会变，但不影响录下来的响应
+UNKEYED_FIELDS = ("max_tokens", "max_completion_tokens")
+
+# OpenAI SDK 会自己重试的状态码；这些中间失败不录制，只录最终的响应
+SDK_RETRY_STATUS = (408, 409, 429)
+
+
+def request_key(path, body):
+    """请求指纹：接口路径 + 请求体 (不含 API Key 等请求头，换了域名也能回放)"""
+    if isinstance(body, dict):
+        body = {k: v for k, v in body.items() if k not in UNKEYED_FIELDS}
+    return fingerprint(path.rsplit("/v1/", 1)[-1], body)
+
+
+def _sdk_will_retry(status):
+    return status in SDK_RETRY_STATUS or status >= 500
+
+
+class Cassette:
+    def __init__(self, path=None, mode="off", append=False):
+        if mode not in MODES:
+            raise ValueError(f"未知的 cassette 模式: {mode} (可选 {', '.join(MODES)})")
+        self.path = path
+        self.mode = mode
+        self.append = append
+        self.lock = threading.Lock()
+        self.tapes = {}    # 指纹 -> [录制的响应, ...]
+        self.cursor = {}   # 指纹 -> 下一次回放的位置
+        self._file = None
+        if mode == "replay":
+            self._load()
+
+    @property
+    def active(self):
+        return self.mode != "off"
+
+    @property
+    def replaying(self):
+        return self.mode == "replay"
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            raise FileNotFoundError(f"找不到 cassette 文件: {self.path}")
+        count = 0
+        with gzip.open(self.path, "rt", encoding="utf-8") as f:
+            try:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    entry = json.loads(line)
+                    self.tapes.setdefault(entry["key"], []).append(entry)
+                    count += 1
+            except EOFError:
+                # 录制进程被中断时文件没有写完尾部，已写入的部分仍然可用
+                print(f"Warning: cassette 文件不完整，已读取 {count} 条: {self.path}")
+        print(f"📼 回放模式: {self.path} ({count} 条录制)")
+
+    # ---------- 录制 ----------
+    def record(self, key, kind, request, status, body, content_type=None):
+        entry = {"key": key, "kind": kind, "request": request, "status": status, "body": body}
+        if content_type:
+            entry["content_type"] = content_type
+        line = json.dumps(entry, ensure_ascii=False) + "\n"
+        with self.lock:
+            if self._file is None:
+                Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+                # 默认每次录制重新开始 (否则回放会先放出上一次录制的响应)；append=True 时接着旧录制写
+                self._file = gzip.open(self.path, "at" if self.append else "wt", encoding="utf-8")
+                print(f"📼 录制模式: {self.path}{' (追加)' if self.append else ''}")
+            self._file.write(line)
+            # 每条都 flush，进程中途退出时已录制的部分仍可回放
+            self._file.flush()
+        RUN_METRICS.incr("cassette_recorded")
+
+    def close(self):
+        with self.lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    # ---------- 回放 ----------
+    def play(self, key):
+        with self.lock:
+            tape = self.tapes.get(key)
+            if not tape:
+                RUN_METRICS.incr("cassette_miss")
+                raise CassetteMiss(f"cassette 中没有这个请求 (指纹 {key[:12]})，回放模式不会访问网络")
+            index = self.cursor.get(key, 0)
+            # 回放次数超过录制次数时重复最后一条
+            self.cursor[key] = index + 1
+            entry = tape[min(index, len(tape) - 1)]
+        RUN_METRICS.incr("cassette_replayed")
+        return entry
+
+    # ---------- chat_utils 的 requests 路径 ----------
+    def post(self, api_url, payload, send):
+        """send() 是真正发请求的函数；返回带 status_code / text / json() 的响应对象"""
+        if not self.active:
+            return send()
+        key = request_key(urlsplit(api_url).path, payload)
+        if self.replaying:
+            entry = self.play(key)
+            return CassetteResponse(entry["status"], entry["body"])
+        response = send()
+        # 这条路径的重试在 chat_utils 里，回放时同样逐次重试，所以失败的响应也按顺序录制
+        self.record(key, "http", payload, response.status_code, response.text)
+        return response
+
+    # ---------- OpenAI SDK 的 httpx 路径 ----------
+    def openai_client_kwargs(self, async_client=False):
+        """传给 openai.OpenAI / AsyncOpenAI 的额外参数；未开启时为空"""
+        if not self.active:
+            return {}
+        import httpx
+
+        if async_client:
+            transport = _AsyncCassetteTransport(self, None if self.replaying else httpx.AsyncHTTPTransport())
+            kwargs = {"http_client": httpx.AsyncClient(transport=transport)}
+        else:
+            transport = _CassetteTransport(self, None if self.replaying else httpx.HTTPTransport())
+            kwargs = {"http_client": httpx.Client(transport=transport)}
+        if self.replaying:
+            # 录制时只保存了最终响应，回放不需要 SDK 重试；未录制的请求重试也没有意义
+            kwargs["max_retries"] = 0
+        return kwargs
+
+    def _httpx_key(self, request):
+        body = request.content
+        try:
+            body = json.loads(body) if body else None
+        except ValueError:
+            body = body.decode("utf-8", errors="replace")
+        return request_key(request.url.path, body), body
+
+
+class CassetteResponse:
+    """回放时代替 requests.Response，只提供 chat_utils 用到的属性"""
+
+    def __init__(self, status_code, text):
+        self.status_code = status_code
+        self.text = text
+
+    def json(self):
+        return json.loads(self.text)
+
+
+def _httpx_response(entry, request):
+    import httpx
+
+    headers = {"content-type": entry.get("content_type") or "application/json"}
+    return httpx.Response(entry["status"], headers=headers, content=entry["body"].encode("utf-8"), request=request)
+
+
+class _CassetteTransport:
+    def __init__(self, cassette, inner):
+        self.cassette = cassette
+        self.inner = inner
+
+    def handle_request(self, request):
+        key, body = self.cassette._httpx_key(request)
+        if self.cassette.replaying:
+            return _httpx_response(self.cassette.play(key), request)
+        response = self.inner.handle_request(request)
+        response.read()
+        # SDK 会重试的 429 / 5xx 不录制：回放时 SDK 不重试 (max_retries=0)，直接拿到最终响应；
+        # 全部重试都失败时回放会找不到录制，按端点故障处理 (与录制时一样切换备用模型)
+        if not _sdk_will_retry(response.status_code):
+            self.cassette.record(key, "openai", body, response.status_code, response.text,
+                                 response.headers.get("content-type"))
+        return response
+
+    def close(self):
+        if self.inner is not None:
+            self.inner.close()
+
+
+class _AsyncCassetteTransport:
+    def __init__(self, cassette, inner):
+        self.cassette = cassette
+        self.inner = inner
+
+    async def handle_async_request(self, request):
+        key, body = self.cassette._httpx_key(request)
+        if self.cassette.replaying:
+            return _httpx_response(self.cassette.play(key), request)
+        response = await self.inner.handle_async_request(request)
+        await response.aread()
+        # 与同步版相同：只录制最终响应
+        if not _sdk_will_retry(response.status_code):
+            self.cassette.record(key, "openai", body, response.status_code, response.text,
+                                 response.headers.get("content-type"))
+        return response
+
+    async def aclose(self):
+        if self.inner is not None:
+            await self.inner.aclose()
+
+
+def _from_env():
+    mode = os.environ.get(CASSETTE_MODE_ENV, "off") or "off"
+    script = os.path.splitext(os.path.basename(sys.argv[0]))[0] or "run"
+    path = os.environ.get(CASSETTE_PATH_ENV) or os.path.join(CASSETTE_DIR, f"{script}.jsonl.gz")
+    cassette = Cassette(path, mode, append=os.environ.get(CASSETTE_APPEND_ENV, "") not in ("", "0"))
+    if cassette.replaying:
+        # 回放时限流 / 退避等待都没有意义
+        tracing.SLEEP_SCALE = 0.0
+    return cassette
+
+
+# 进程内共享的一份 cassette
+CASSETTE = _from_env()
+atexit.register(CASSETTE.close)
@@ -0,0 +1,397 @@
+# utils/chat_utils.py
+# 直接走 HTTP 的 chat/completions 调用 (step1_gen_batch / step1_gen_selfplay / step_eval_full_new 共用)
+import os
+import time
+import atexit
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import requests
+
+from utils.token_budget import TokenBudget, percentile
+from utils.circuit_breaker import get_breaker
+from utils.run_metrics import RUN_METRICS
+from utils.dashboard import DASHBOARD
+from utils.tracing import span, sleep
+from utils.cassette import CASSETTE
+from utils.single_flight import SINGLE_FLIGHT, is_deterministic, request_key
+
+# 默认的输出预算：历史样本不足时使用
+DEFAULT_MAX_TOKENS = 4000
+
+# 全局 token 统计，进程退出时落盘，下次运行继续使用；回放的流量不写回生产统计
+TOKEN_BUDGET = TokenBudget(persist=not CASSETTE.replaying)
+atexit.register(TOKEN_BUDGET.save)
+
+
+# ============================
+# 对冲请求 (hedged requests)，默认关闭
+# ============================
+class HedgePolicy:
+    """
+    某次调用超过该模型历史 p95 延迟仍未返回时，再发一个相同请求，谁先回来用谁。
+    额外请求数受 budget 限制 (例如 0.05 表示最多多发 5% 的请求)。
+    """
+
+    MIN_SAMPLES = 20   # 延迟样本不足时不对冲
+    WINDOW = 200       # 每个模型保留最近这么多条延迟
+
+    def __init__(self, budget=0.0):
+        self.budget = budget
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.stats = {}
+        self.executor = None
+
+    @property
+    def enabled(self):
+        return self.budget > 0
+
+    def _model_stats(self, model):
+        return self.stats.setdefault(model, {"requests": 0, "hedged": 0, "hedge_wins": 0})
+
+    def record_latency(self, model, seconds):
+        with self.lock:
+            self.latencies.setdefault(model, deque(maxlen=self.WINDOW)).append(seconds)
+
+    def hedge_delay(self, model):
+        """返回该模型的对冲等待时间 (p95)，样本不足时返回 None"""
+        with self.lock:
+            values = list(self.latencies.get(model, ()))
+        if len(values) < self.MIN_SAMPLES:
+            return None
+        return percentile(values, 0.95)
+
+    def count_request(self, model):
+        with self.lock:
+            self._model_stats(model)["requests"] += 1
+
+    def try_acquire(self, model):
+        """检查对冲预算：总对冲数不超过总请求数 * budget"""
+        with self.lock:
+            total = sum(x["requests"] for x in self.stats.values())
+            hedged = sum(x["hedged"] for x in self.stats.values())
+            if hedged + 1 > total * self.budget:
+                return False
+            self._model_stats(model)["hedged"] += 1
+            return True
+
+    def record_win(self, model, hedge_won):
+        if hedge_won:
+            with self.lock:
+                self._model_stats(model)["hedge_wins"] += 1
+
+    def pool(self):
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=64, thread_name_prefix="hedge")
+            return self.executor
+
+    def report(self):
+        """每个模型的请求数、对冲数、对冲胜率"""
+        with self.lock:
+            return {
+                model: dict(x, hedge_win_rate=round(x["hedge_wins"] / x["hedged"], 3) if x["hedged"] else 0.0)
+                for model, x in self.stats.items()
+            }
+
+
+# 通过环境变量 COT_HEDGE_BUDGET=0.05 开启
+HEDGING = HedgePolicy(budget=float(os.environ.get("COT_HEDGE_BUDGET", "0") or 0))
+
+
+def configure_hedging(budget=0.05):
+    """在脚本里开启/关闭对冲 (budget=0 关闭)"""
+    HEDGING.budget = budget
+
+
+def print_hedge_report():
+    if not HEDGING.enabled:
+        return
+    print("📡 对冲请求统计:")
+    for model, x in HEDGING.report().items():
+        print(f"   {model}: 请求 {x['requests']} | 对冲 {x['hedged']} | 对冲胜出 {x['hedge_wins']} (胜率 {x['hedge_win_rate']})")
+
+
+def _post(api_url, api_key, payload, timeout, session=None):
+    headers = {
+        "Authorization": f"Bearer {api_key}",
+        "Content-Type": "application/json"
+    }
+    return (session or requests).post(api_url, headers=headers, json=payload, timeout=timeout)
+
+
+def _timed_post(api_url, api_key, payload, timeout, session):
+    start = time.time()
+    response = _post(api_url, api_key, payload, timeout, session)
+    return response, time.time() - start
+
+
+def _send(api_url, api_key, payload, timeout):
+    """发送一次请求；开启录制/回放时经过 cassette (回放不访问网络)"""
+    return CASSETTE.post(api_url, payload, lambda: _send_live(api_url, api_key, payload, timeout))
+
+
+def _send_live(api_url, api_key, payload, timeout):
+    """发送一次请求；开启对冲且超过 p95 未返回时，补发一个副本，取先成功返回 (200) 的结果"""
+    model = payload["model"]
+    delay = HEDGING.hedge_delay(model) if HEDGING.enabled else None
+    HEDGING.count_request(model)
+
+    if delay is None:
+        response, elapsed = _timed_post(api_url, api_key, payload, timeout, None)
+        if response.status_code == 200:
+            HEDGING.record_latency(model, elapsed)
+        return response
+
+    pool = HEDGING.pool()
+    sessions = [requests.Session()]
+    primary = pool.submit(_timed_post, api_url, api_key, payload, timeout, sessions[0])
+    done, _ = wait([primary], timeout=delay)
+    if done or not HEDGING.try_acquire(model):
+        response, elapsed = primary.result()
+        sessions[0].close()
+        if response.status_code == 200:
+            HEDGING.record_latency(model, elapsed)
+        return response
+
+    sessions.append(requests.Session())
+    hedge = pool.submit(_timed_post, api_url, api_key, payload, timeout, sessions[1])
+    pending = {primary, hedge}
+    error = None
+    failed = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            try:
+                response, elapsed = future.result()
+            except requests.exceptions.RequestException as e:
+                error = e
+                continue
+            if response.status_code != 200:
+                # 429 / 5xx 不算胜出，继续等另一个副本
+                failed = response
+                continue
+            # 取消落后的那个：关闭它的连接 (尽力而为，已发出的请求无法撤回)
+            for other in pending:
+                other.cancel()
+            for session in sessions:
+                session.close()
+            HEDGING.record_win(model, future is hedge)
+            HEDGING.record_latency(model, elapsed + (delay if future is hedge else 0))
+            return response
+    for session in sessions:
+        session.close()
+    # 两个副本都失败：有 HTTP 响应时交给调用方按状态码处理 (重试 / 切换模型)，否则抛出网络异常
+    if failed is not None:
+        return failed
+    raise error
+
+
+def _parse_response(result):
+    choices = sorted(result.get("choices") or [{}], key=lambda c: c.get("index", 0))
+    reasons = [c.get("finish_reason") for c in choices]
+    return {
+        "content": choices[0].get("message", {}).get("content", "") or "",
+        "choices": [(c.get("message", {}).get("content", "") or "") for c in choices],
+        # 多个回答时任意一个被截断就按截断处理
+        "finish_reason": "length" if "length" in reasons else reasons[0],
+        "usage": result.get("usage") or {},
+    }
+
+
+def chat_completion(api_url, api_key, model, messages, temperature=0.7, max_tokens=None,
+                    timeout=120, retries=3, budget_key=None, log_prefix="",
+                    default_max_tokens=DEFAULT_MAX_TOKENS, fallback_model=None, n=1, coalesce=None):
+    """
+    调用一次 chat/completions，返回
+        {"success": True, "model", "content", "choices", "finish_reason", "usage", "max_tokens"}
+    或  {"success": False, "model", "error", "status", "circuit_open"}
+
+    - max_tokens 为空时，按 (model, budget_key) 的历史输出长度自动设定 (不超过 default_max_tokens)
+    - 输出被截断 (finish_reason=length) 时，自动用更大的预算重试一次
+    - 模型已熔断时直接快速失败；给了 fallback_model 时改用备用模型 (例如备用裁判)
+    - n > 1 时在请求里带上 n，一次拿回多个回答 (choices)；接口是否支持由调用方处理，见 chat_completion_n
+    - temperature=0 (或 coalesce=True) 时，与正在进行的完全相同的请求合并，共用一个结果
+    """
+    if is_deterministic(temperature, coalesce):
+        key = request_key("chat", api_url, model, messages, temperature, max_tokens, n, budget_key, fallback_model)
+        result = SINGLE_FLIGHT.do("chat", key, lambda: _chat_completion(
+            api_url, api_key, model, messages, temperature, max_tokens, timeout, retries, budget_key,
+            log_prefix, default_max_tokens, fallback_model, n))
+        # 每个调用方拿到自己的一份，互不影响
+        return dict(result)
+    return _chat_completion(api_url, api_key, model, messages, temperature, max_tokens, timeout, retries,
+                            budget_key, log_prefix, default_max_tokens, fallback_model, n)
+
+
+def _chat_completion(api_url, api_key, model, messages, temperature, max_tokens, timeout, retries,
+                     budget_key, log_prefix, default_max_tokens, fallback_model, n):
+    result = _tracked_call(api_url, api_key, model, messages, temperature, max_tokens,
+                           timeout, retries, budget_key, log_prefix, default_max_tokens, n)
+    # 拒绝 n 参数不是模型故障，不切换备用模型，交给 chat_completion_n 改发单个请求
+    if result["success"] or result.get("n_rejected") or not fallback_model or fallback_model == model:
+        return result
+
+    RUN_METRICS.incr("failover")
+    RUN_METRICS.event("failover", model=model, fallback_model=fallback_model, reason=result["error"])
+    print(f"    {log_prefix}{model} 不可用，切换到备用模型 {fallback_model}")
+    return _tracked_call(api_url, api_key, fallback_model, messages, temperature, max_tokens,
+                         timeout, retries, budget_key, log_prefix, default_max_tokens, n)
+
+
+def _tracked_call(api_url, api_key, model, *args):
+    """一次完整调用 (含重试) 计入实时面板：在途数、成功/失败、耗时"""
+    started = DASHBOARD.call_started(model)
+    with span("llm_call", "llm", model=model) as s:
+        result = _call_with_retries(api_url, api_key, model, *args)
+        s.set(success=result["success"])
+    DASHBOARD.call_finished(model, started, result["success"])
+    return result
+
+
+def _call_with_retries(api_url, api_key, model, messages, temperature, max_tokens,
+                       timeout, retries, budget_key, log_prefix, default_max_tokens, n=1):
+    breaker = get_breaker(model)
+    if not breaker.allow():
+        return {"success": False, "model": model, "error": "circuit_open", "status": None, "circuit_open": True}
+
+    if max_tokens is None:
+        max_tokens = TOKEN_BUDGET.suggest(model, budget_key, default_max_tokens)
+
+    payload = {
+        "model": model,
+        "messages": messages,
+        "temperature": temperature,
+        "max_tokens": max_tokens
+    }
+    if n > 1:
+        # max_tokens 是每个回答各自的上限
+        payload["n"] = n
+
+    regrown = False
+    status = None
+    last_error = "API调用失败"
+    attempt = 0
+    sent = 0
+    while attempt < retries:
+        if sent:
+            DASHBOARD.call_retry(model)
+        sent += 1
+        # 重试过程中模型被熔断，就不再继续浪费时间
+        if attempt > 0 and not breaker.allow():
+            return {"success": False, "model": model, "error": "circuit_open", "status": status, "circuit_open": True}
+        try:
+            with span("attempt", "http", model=model, attempt=sent) as s:
+                response = _send(api_url, api_key, payload, timeout)
+                status = response.status_code
+                s.set(status=status)
+                with span("response_json", "parse"):
+                    result = response.json() if status == 200 else None
+        except (requests.exceptions.RequestException, ValueError) as e:
+            breaker.record_failure()
+            last_error = f"{type(e).__name__}: {e}"
+            print(f"    {log_prefix}请求重试 {attempt + 1}/{retries}: {e}")
+            attempt += 1
+            sleep(2, "retry_backoff")
+            continue
+
+        if status == 200:
+            breaker.record_success()
+            parsed = _parse_response(result)
+            truncated = parsed["finish_reason"] == "length"
+            # usage 是所有回答的合计，按单个回答的长度记账
+            completion_tokens = parsed["usage"].get("completion_tokens")
+            if completion_tokens and len(parsed["choices"]) > 1:
+                completion_tokens = completion_tokens // len(parsed["choices"])
+            TOKEN_BUDGET.record(model, budget_key, completion_tokens, truncated)
+
+            if truncated and not regrown and payload["max_tokens"] < TOKEN_BUDGET.grow(payload["max_tokens"]):
+                # 截断重试不占用普通重试次数
+                regrown = True
+                payload["max_tokens"] = TOKEN_BUDGET.grow(payload["max_tokens"])
+                print(f"    {log_prefix}输出被截断，max_tokens 提升到 {payload['max_tokens']} 后重试")
+                continue
+
+            parsed.update({"success": True, "model": model, "max_tokens": payload["max_tokens"]})
+            return parsed
+
+        last_error = f"HTTP {status}: {response.text[:200]}"
+        if n > 1 and 400 <= status < 500 and status != 429:
+            # 带 n 的请求被 4xx 拒绝：多半是不支持 n，重试也一样，直接返回
+            breaker.record_success()
+            return {"success": False, "model": model, "error": last_error, "status": status,
+                    "circuit_open": False, "n_rejected": True}
+        # 只有 5xx 计入熔断；4xx / 限流说明服务本身还活着 (熔断器处于 open 时 record_success 不会关闭它)
+        if status >= 500:
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+        if status == 429:
+            print(f"    {log_prefix}限流，等待后重试 {attempt + 1}/{retries}")
+            sleep(5 * (attempt + 1), "rate_limited")
+        else:
+            print(f"    {log_prefix}API 错误 {status}，重试 {attempt + 1}/{retries}")
+            sleep(2, "retry_backoff")
+        attempt += 1
+
+    return {"success": False, "model": model, "error": last_error, "status": status, "circuit_open": False}
+
+
+# ============================
+# 一次请求要多个回答 (n 参数)
+# ============================
+# 同一个 prompt 要采样多次时，带上 n 一次拿回，prompt 的预填充和往返只付一次。
+# 接口拒绝 n (第一次 4xx 就不再重试) 时记住该模型不支持，之后直接并行发单个请求；
+# 返回的回答比要求的少 (接口忽略了 n) 时，缺的部分同样用单个请求补齐。
+N_PARALLEL = 4      # 回退时并行的单个请求数
+_N_SUPPORT = {}     # 实际作答的模型 -> True / False (未探测过的模型不在表里)
+_N_SUPPORT_LOCK = threading.Lock()
+
+
+def _single(result, content):
+    """把多回答结果拆成和 chat_completion 一样的单个结果"""
+    single = dict(result)
+    single["content"] = content
+    single["choices"] = [content]
+    return single
+
+
+def chat_completion_n(api_url, api_key, model, messages, n, log_prefix="", **kwargs):
+    """
+    要 n 个回答，返回长度为 n 的列表，每一项和 chat_completion 的返回值格式相同
+    (成功的项 content 是对应的回答；失败的项 success=False)。
+    kwargs 原样传给 chat_completion (temperature / timeout / budget_key ...)。
+    """
+    results = []
+    if n > 1 and _N_SUPPORT.get(model) is not False:
+        result = chat_completion(api_url, api_key, model, messages, log_prefix=log_prefix, n=n, **kwargs)
+        # 记忆按实际作答的模型 (主模型故障时可能是备用模型)
+        served = result.get("model", model)
+        if result["success"]:
+            results = [_single(result, c) for c in result["choices"][:n]]
+            supported = len(results) == n
+            if not supported:
+                print(f"    {log_prefix}{served} 只返回了 {len(results)}/{n} 个回答，其余改用单个请求")
+        elif result.get("n_rejected"):
+            # 第一次 4xx 就返回了，不经过普通重试的等待
+            supported = False
+            print(f"    {log_prefix}{served} 不支持 n 参数 (HTTP {result['status']})，改用单个请求")
+        else:
+            # 熔断 / 网络 / 5xx 等普通失败不代表不支持 n，这次按失败返回，不记忆
+            return [result] * n
+        with _N_SUPPORT_LOCK:
+            if _N_SUPPORT.get(served) is None:
+                _N_SUPPORT[served] = supported
+                RUN_METRICS.event("n_support", model=served, supported=supported)
+        RUN_METRICS.incr("n_request")
+
+    missing = n - len(results)
+    if missing == 1:
+        results.append(chat_completion(api_url, api_key, model, messages, log_prefix=log_prefix, **kwargs))
+    elif missing > 1:
+        with ThreadPoolExecutor(max_workers=min(missing, N_PARALLEL)) as pool:
+            futures = [pool.submit(chat_completion, api_url, api_key, model, messages,
+                                   log_prefix=log_prefix, **kwargs) for _ in range(missing)]
+            results.extend(f.result() for f in futures)
+    return results
@@ -0,0 +1,112 @@
+import time
+import threading
+
+from utils.run_metrics import RUN_METRICS
+
+# ============================
+# 按模型的熔断器 (closed / open / half_open)
+# ============================
+FAILURE_THRESHOLD = 5   # 连续失败这么多次后熔断
+COOLDOWN_SECONDS = 30   # 熔断后多久放一个探测请求
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(RuntimeError):
+    """模型已熔断，调用被快速拒绝"""
+
+
+class CircuitBreaker:
+    """
+    - closed: 正常放行，连续失败达到阈值后转为 open
+    - open: 直接快速失败，冷却时间到后转为 half_open
+    - half_open: 只放行一个探测请求，成功则 closed，失败则重新 open
+    状态变化会写入 RUN_METRICS 事件日志。
+    """
+
+    def __init__(self, model, failure_threshold=FAILURE_THRESHOLD, cooldown=COOLDOWN_SECONDS):
+        self.model = model
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.lock = threading.Lock()
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+
+    def _transition(self, new_state, reason=""):
+        if new_state == self.state:
+            return
+        RUN_METRICS.event("breaker_transition", model=self.model, from_state=self.state, to_state=new_state, reason=reason)
+        RUN_METRICS.incr(f"breaker_{new_state}")
+        print(f"    ⚡ 熔断器 [{self.model}] {self.state} -> {new_state} {reason}")
+        self.state = new_state
+
+    def allow(self):
+        """本次调用是否放行"""
+        with self.lock:
+            if self.state == OPEN and time.time() - self.opened_at >= self.cooldown:
+                self._transition(HALF_OPEN, "冷却结束，放行探测请求")
+                self.probing = False
+            if self.state == CLOSED:
+                return True
+            if self.state == HALF_OPEN and not self.probing:
+                self.probing = True
+                return True
+            RUN_METRICS.incr("breaker_fast_fail")
+            return False
+
+    def retry_after(self):
+        """距离下一次允许探测还有多少秒 (未熔断时为 0)"""
+        with self.lock:
+            if self.state != OPEN:
+                return 0.0
+            return max(0.0, self.cooldown - (time.time() - self.opened_at))
+
+    def record_success(self):
+        """
+        只有 half_open 的探测成功才关闭熔断器；closed 时只清零连续失败数。
+        open 时忽略：熔断前就发出的慢请求此时才返回，不能跳过冷却和探测。
+        """
+        with self.lock:
+            if self.state == OPEN:
+                return
+            self.failures = 0
+            if self.state == HALF_OPEN:
+                self.probing = False
+                self._transition(CLOSED, "探测成功")
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.probing = False
+            if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+                self.opened_at = time.time()
+                self._transition(OPEN, f"连续失败 {self.failures} 次")
+
+
+_BREAKERS = {}
+_BREAKERS_LOCK = threading.Lock()
+
+
+def get_breaker(model):
+    with _BREAKERS_LOCK:
+        if model not in _BREAKERS:
+            _BREAKERS[model] = CircuitBreaker(model)
+        return _BREAKERS[model]
+
+
+def breaker_states():
+    with _BREAKERS_LOCK:
+        return {model: b.state for model, b in _BREAKERS.items()}
+
+
+def print_breaker_report():
+    transitions = [e for e in RUN_METRICS.snapshot()["events"] if e["kind"] == "breaker_transition"]
+    if not transitions:
+        return
+    print("⚡ 熔断器状态变化:")
+    for e in transitions:
+        print(f"   +{e['ts']}s {e['model']}: {e['from_state']} -> {e['to_state']} ({e['reason']})")
@@ -0,0 +1,230 @@
+import os
+import sys
+import time
+import atexit
+import threading
+from collections import deque
+from pathlib import Path
+
+from utils.token_budget import percentile
+
+# ============================
+# 实时终端面板 (可选，默认关闭)
+# ============================
+# 开启方式: COT_DASHBOARD=1 python step4_whole_judge.py
+# 开启后各脚本原有的 print 输出改写到 outputs/logs/<阶段>_<时间>.log，
+# 终端只显示面板 (最近几行日志附在面板底部)。
+DASHBOARD_ENV = "COT_DASHBOARD"
+REFRESH_SECONDS = 1.0          # 终端刷新间隔
+NON_TTY_REFRESH_SECONDS = 30.0 # 输出不是终端 (例如重定向到文件) 时的刷新间隔
+LATENCY_WINDOW = 500           # 每个 (阶段, 模型) 保留最近这么多次调用的耗时算分位数
+RATE_WINDOW_SECONDS = 30.0     # 请求速率按最近这么多秒统计
+LOG_TAIL_LINES = 8
+LOG_DIR = "outputs/logs"
+
+
+class CallStats:
+    """单个 (阶段, 模型) 的调用计数；工作线程只在锁内做加减，分位数等计算留给刷新线程"""
+
+    def __init__(self):
+        self.in_flight = 0
+        self.success = 0
+        self.retry = 0
+        self.error = 0
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.finished_at = deque()
+
+
+class _LogTee:
+    """开启面板期间替换 sys.stdout：写入日志文件，并保留最后几行给面板显示"""
+
+    def __init__(self, path, tail):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.file = open(path, "a", encoding="utf-8", buffering=1)
+        self.tail = tail
+        self.partial = ""
+
+    def write(self, text):
+        self.file.write(text)
+        lines = (self.partial + text).split("\n")
+        self.partial = lines.pop()
+        for line in lines:
+            if line.strip():
+                self.tail.append(line)
+        return len(text)
+
+    def flush(self):
+        self.file.flush()
+
+    def isatty(self):
+        return False
+
+
+class Dashboard:
+    def __init__(self, enabled=None):
+        self.enabled = os.environ.get(DASHBOARD_ENV) == "1" if enabled is None else enabled
+        self.lock = threading.Lock()
+        self.current = None
+        self.stages = {}   # 阶段 -> {"total", "done", "started_at"}
+        self.calls = {}    # (阶段, 模型) -> CallStats
+        self.tail = deque(maxlen=LOG_TAIL_LINES)
+        self.log_path = None
+        self._stdout = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    # ---------- 工作线程调用 (只做计数) ----------
+    def begin_stage(self, name, total=None):
+        with self.lock:
+            self.current = name
+            stage = self.stages.setdefault(name, {"total": 0, "done": 0, "started_at": time.time()})
+            if total is not None:
+                stage["total"] = total
+        self.start()
+
+    def add_total(self, n):
+        with self.lock:
+            if self.current in self.stages:
+                self.stages[self.current]["total"] += n
+
+    def advance(self, n=1):
+        with self.lock:
+            if self.current in self.stages:
+                self.stages[self.current]["done"] += n
+
+    def _stats(self, model):
+        key = (self.current or "-", model)
+        if key not in self.calls:
+            self.calls[key] = CallStats()
+        return self.calls[key]
+
+    # 面板关闭时不计数：没有刷新线程读这些统计，也不用在每次调用时抢锁
+    def call_started(self, model):
+        now = time.time()
+        if not self.enabled:
+            return now
+        with self.lock:
+            self._stats(model).in_flight += 1
+        return now
+
+    def call_finished(self, model, started, ok):
+        if not self.enabled:
+            return
+        now = time.time()
+        with self.lock:
+            stats = self._stats(model)
+            stats.in_flight -= 1
+            stats.finished_at.append(now)
+            # 在这里也裁掉窗口外的时间戳，不依赖刷新线程
+            while now - stats.finished_at[0] > RATE_WINDOW_SECONDS:
+                stats.finished_at.popleft()
+            if ok:
+                stats.success += 1
+                stats.latencies.append(now - started)
+            else:
+                stats.error += 1
+
+    def call_retry(self, model):
+        if not self.enabled:
+            return
+        with self.lock:
+            self._stats(model).retry += 1
+
+    # ---------- 刷新线程 ----------
+    def snapshot(self):
+        now = time.time()
+        with self.lock:
+            stages = {name: dict(s) for name, s in self.stages.items()}
+            calls = {}
+            for key, stats in self.calls.items():
+                while stats.finished_at and now - stats.finished_at[0] > RATE_WINDOW_SECONDS:
+                    stats.finished_at.popleft()
+                calls[key] = {
+                    "in_flight": stats.in_flight,
+                    "success": stats.success,
+                    "retry": stats.retry,
+                    "error": stats.error,
+                    "recent": len(stats.finished_at),
+                    "latencies": list(stats.latencies),
+                }
+
+        for name, s in stages.items():
+            elapsed = max(now - s["started_at"], 1e-6)
+            rate = s["done"] / elapsed
+            remaining = max(s["total"] - s["done"], 0)
+            s["eta_seconds"] = remaining / rate if rate and s["total"] else None
+            s["elapsed_seconds"] = elapsed
+        for (stage, _), c in calls.items():
+            window = min(RATE_WINDOW_SECONDS, max(now - stages.get(stage, {}).get("started_at", now), 1e-6))
+            c["rps"] = c["recent"] / window
+            lat = c.pop("latencies")
+            c["p50"], c["p95"], c["p99"] = (percentile(lat, q) for q in (0.5, 0.95, 0.99))
+        return stages, calls
+
+    def render(self):
+        stages, calls = self.snapshot()
+        lines = [f"📟 实时面板  {time.strftime('%H:%M:%S')}  (日志: {self.log_path})", ""]
+        for name, s in stages.items():
+            total = s["total"] or "?"
+            eta = _fmt_seconds(s["eta_seconds"]) if s["eta_seconds"] is not None else "--"
+            marker = "▶" if name == self.current else " "
+            lines.append(f"{marker} [{name}] 进度 {s['done']}/{total} | 已用 {_fmt_seconds(s['elapsed_seconds'])} | ETA {eta}")
+            lines.append(f"    {'模型':<24}{'req/s':>7}{'在途':>6}{'成功':>7}{'重试':>6}{'失败':>6}"
+                         f"{'p50':>8}{'p95':>8}{'p99':>8}")
+            for (stage, model), c in sorted(calls.items()):
+                if stage != name:
+                    continue
+                lines.append(f"    {model[-24:]:<24}{c['rps']:>7.2f}{c['in_flight']:>6}{c['success']:>7}"
+                             f"{c['retry']:>6}{c['error']:>6}{c['p50']:>7.1f}s{c['p95']:>7.1f}s{c['p99']:>7.1f}s")
+            lines.append("")
+        if self.tail:
+            lines.append("── 最近日志 " + "─" * 40)
+            lines.extend(line[:120] for line in list(self.tail))
+        return "\n".join(lines)
+
+    def _loop(self):
+        interactive = self._stdout.isatty()
+        interval = REFRESH_SECONDS if interactive else NON_TTY_REFRESH_SECONDS
+        while not self._stop.wait(interval):
+            self._draw(interactive)
+
+    def _draw(self, interactive):
+        text = self.render()
+        # 清屏后从左上角重画；非终端输出直接追加一份快照
+        self._stdout.write(("\x1b[H\x1b[J" if interactive else "\n") + text + "\n")
+        self._stdout.flush()
+
+    def start(self):
+        if not self.enabled or self._thread is not None:
+            return
+        self.log_path = os.path.join(LOG_DIR, f"{self.current or 'run'}_{time.strftime('%Y%m%d_%H%M%S')}.log")
+        self._stdout = sys.stdout
+        sys.stdout = _LogTee(self.log_path, self.tail)
+        self._thread = threading.Thread(target=self._loop, name="dashboard", daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join(timeout=REFRESH_SECONDS * 2)
+        self._thread = None
+        tee, sys.stdout = sys.stdout, self._stdout
+        tee.file.close()
+        # 结束时留下最后一帧，方便回看
+        self._draw(False)
+        print(f"📄 完整日志: {self.log_path}")
+
+
+def _fmt_seconds(seconds):
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}h{seconds % 3600 // 60:02d}m"
+    if seconds >= 60:
+        return f"{seconds // 60}m{seconds % 60:02d}s"
+    return f"{seconds}s"
+
+
+# 进程内共享的一份面板；未开启时只计数，不刷新、不改 stdout
+DASHBOARD = Dashboard()
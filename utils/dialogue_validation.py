@@ -0,0 +1,85 @@
+import re
+
+# ============================
+# 生成对话的本地结构校验 (送裁判之前)
+# ============================
+# 规则从 Prompt 的【生成要求】里读出来：
+#   "对话轮次：6-10轮"      -> 轮数范围
+#   "AiMe先开口" / "用户先开口" -> 第一句的角色
+#   "输出JSON格式"          -> 必须能解析出 {"messages": [...]}
+# 另外始终检查：角色只能是 user / assistant 且交替出现、内容不能为空。
+# Prompt 配置里可以用 "validation": {...} 覆盖读出来的规则。
+ROLES = ("user", "assistant")
+
+_TURN_RANGE = re.compile(r"对话轮次[:：]\s*(\d+)\s*[-~～到]\s*(\d+)\s*轮")
+_FIRST_SPEAKER = (
+    (re.compile(r"AiMe先开口"), "assistant"),
+    (re.compile(r"用户先开口"), "user"),
+)
+
+
+def rules_from_prompt(prompt_config):
+    """从单个 PROMPTS 条目推出校验规则"""
+    text = prompt_config.get("prompt", "")
+    rules = {"min_turns": None, "max_turns": None, "first_role": None, "require_json": "JSON" in text}
+
+    match = _TURN_RANGE.search(text)
+    if match:
+        rules["min_turns"], rules["max_turns"] = int(match.group(1)), int(match.group(2))
+    for pattern, role in _FIRST_SPEAKER:
+        if pattern.search(text):
+            rules["first_role"] = role
+            break
+
+    rules.update(prompt_config.get("validation", {}))
+    return rules
+
+
+def _turns_ok(count, rules):
+    """
+    Prompt 里的"轮"既可能被理解成一条消息，也可能是一问一答；
+    两种理解有一种落在范围内就算通过，只拦截明显不合格的输出 (例如 0 轮或只有 1-2 句)。
+    """
+    lo, hi = rules.get("min_turns"), rules.get("max_turns")
+    if lo is None and hi is None:
+        return count > 0
+    lo = lo or 1
+    hi = hi or float("inf")
+    exchanges = (count + 1) // 2
+    return lo <= count <= hi or lo <= exchanges <= hi
+
+
+def validate_dialogue(parse_result, rules):
+    """
+    parse_result: step_eval_full_new.parse_json 的返回值。
+    返回 (messages, 错误列表)；错误列表为空表示通过。
+    """
+    if not parse_result.get("success"):
+        return [], ["输出不是合法 JSON"] if rules.get("require_json", True) else ["无法解析出对话"]
+
+    data = parse_result["data"]
+    messages = data.get("messages") if isinstance(data, dict) else None
+    if not isinstance(messages, list) or not messages:
+        return [], ["JSON 中没有 messages 列表"]
+
+    errors = []
+    roles = [m.get("role") if isinstance(m, dict) else None for m in messages]
+    unknown = [r for r in roles if r not in ROLES]
+    if unknown:
+        errors.append(f"未知角色: {unknown[0]}")
+
+    if rules.get("first_role") and roles[0] != rules["first_role"]:
+        errors.append(f"第一句应由 {rules['first_role']} 说出，实际是 {roles[0]}")
+
+    repeated = [i for i in range(1, len(roles)) if roles[i] == roles[i - 1]]
+    if repeated:
+        errors.append(f"角色没有交替 (第 {repeated[0] + 1} 句与上一句相同)")
+
+    empty = [i for i, m in enumerate(messages) if not isinstance(m, dict) or not str(m.get("content") or "").strip()]
+    if empty:
+        errors.append(f"第 {empty[0] + 1} 句内容为空")
+
+    if not _turns_ok(len(messages), rules):
+        errors.append(f"轮数 {len(messages)} 不在 {rules.get('min_turns')}-{rules.get('max_turns')} 范围内")
+
+    return messages, errors
@@ -0,0 +1,46 @@
+import argparse
+
+# ============================
+# --dry-run: 只读取输入，列出计划执行的任务 (文件、条目、每个模型的调用数)
+# 不创建客户端、不发请求，也不会导入 openai / instructor
+# ============================
+
+
+def new_plan(stage):
+    return {"stage": stage, "files": {}, "items": 0, "calls": {}, "notes": []}
+
+
+def add_calls(plan, model, n):
+    plan["calls"][model] = plan["calls"].get(model, 0) + n
+
+
+def print_plan(plan):
+    print(f"🧪 [dry-run] {plan['stage']}")
+    for path, count in plan["files"].items():
+        print(f"   📄 {path}: {count} 条")
+    print(f"   📦 任务数: {plan['items']}")
+    total = sum(plan["calls"].values())
+    print(f"   📞 预计调用: {total}")
+    for model, n in sorted(plan["calls"].items(), key=lambda x: -x[1]):
+        print(f"      - {model}: {n}")
+    for note in plan["notes"]:
+        print(f"   ℹ️ {note}")
+
+
+def merge_calls(plans):
+    calls = {}
+    for plan in plans:
+        for model, n in plan["calls"].items():
+            calls[model] = calls.get(model, 0) + n
+    return calls
+
+
+def run_cli(main, plan, description):
+    """脚本入口：默认执行 main()；--dry-run 时只打印 plan() 的结果"""
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("--dry-run", action="store_true", help="只列出计划执行的任务，不调用接口")
+    args = parser.parse_args()
+    if args.dry_run:
+        print_plan(plan())
+    else:
+        main()
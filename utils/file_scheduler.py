@@ -0,0 +1,50 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from utils.run_metrics import RUN_METRICS
+
+# ============================
+# 跨文件的裁判调度：所有文件的条目共用一个有界线程池
+# ============================
+# - 按文件轮流取条目 (round-robin)，大文件不会把小文件饿住
+# - 某个文件的条目全部完成就立即回调 on_file_done (在调用线程里执行，写文件不需要加锁)，
+#   不用等其他文件
+# - 每个文件的结果按原始顺序返回
+DEFAULT_WORKERS = 8
+
+
+def run_files(files, process_item, on_file_done, workers=DEFAULT_WORKERS):
+    """
+    files: {文件: [条目, ...]} (dict 顺序即轮询顺序)
+    process_item(文件, 序号, 条目) -> 结果，在线程池里执行
+    on_file_done(文件, [结果, ...]) 每个文件完成时调用一次，结果与条目顺序一致
+    条目处理抛出的异常会在这里重新抛出 (与逐个文件串行处理时一致)。
+    """
+    results = {name: [None] * len(items) for name, items in files.items()}
+    remaining = {name: len(items) for name, items in files.items()}
+    rotation = deque((name, deque(enumerate(items))) for name, items in files.items() if items)
+    for name in [n for n, count in remaining.items() if count == 0]:
+        on_file_done(name, results.pop(name))
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="judge") as pool:
+        pending = {}
+
+        def fill():
+            while len(pending) < workers and rotation:
+                name, queue = rotation.popleft()
+                index, item = queue.popleft()
+                pending[pool.submit(process_item, name, index, item)] = (name, index)
+                if queue:
+                    rotation.append((name, queue))
+
+        fill()
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                name, index = pending.pop(future)
+                results[name][index] = future.result()
+                remaining[name] -= 1
+                if remaining[name] == 0:
+                    RUN_METRICS.event("file_done", file=str(name))
+                    on_file_done(name, results.pop(name))
+            fill()
@@ -2,6 +2,8 @@ import os
 import json
 from pathlib import Path
 
+from utils.tracing import traced
+
 # ============================
 # 读取 questions.txt
 # ============================
@@ -20,6 +22,7 @@ def load_questions(file_path: str):
 # ============================
 # 读取 JSONL 文件 (Step 2, 3, 4, 5 通用)
 # ============================
+@traced(cat="io")
 def read_jsonl(file_path: str):
     """读取 jsonl 文件，返回字典列表"""
     data = []
@@ -42,14 +45,29 @@ load_jsonl = read_jsonl
 # ============================
 # 写入 JSONL 文件
 # ============================
+@traced(cat="io")
 def write_jsonl(data_list, output_path: str):
-    """将每条数据写成一行 JSON"""
+    """将每条数据写成一行 JSON，返回每行起始的字节偏移 (供 sidecar 索引使用)"""
     # 自动创建父目录
     Path(output_path).parent.mkdir(parents=True, exist_ok=True)
 
+    offsets = []
+    pos = 0
     with open(output_path, "w", encoding="utf-8") as f:
         for item in data_list:
-            f.write(json.dumps(item, ensure_ascii=False))
-            f.write("\n")
+            line = json.dumps(item, ensure_ascii=False) + "\n"
+            f.write(line)
+            offsets.append(pos)
+            pos += len(line.encode("utf-8"))
 
     print(f"写入完成：{output_path}（共 {len(data_list)} 条）")
+    return offsets
+
+# ============================
+# 统计 JSONL 记录数 (不解析，只数非空行)
+# ============================
+def count_jsonl(file_path: str):
+    if not os.path.exists(file_path):
+        return 0
+    with open(file_path, "r", encoding="utf-8") as f:
+        return sum(1 for line in f if line.strip())
@@ -0,0 +1,206 @@
+import json
+import time
+import sqlite3
+import threading
+from pathlib import Path
+
+from utils.cache_utils import fingerprint
+
+# ============================
+# 基于 SQLite 的任务队列 (租约 / 确认 / 重试 / 优先级)
+# ============================
+DEFAULT_DB_PATH = "outputs/jobs.db"
+DEFAULT_LEASE_SECONDS = 300   # 租约时长，worker 挂掉后任务会在租约过期后被别人领走
+DEFAULT_MAX_ATTEMPTS = 3
+RETRY_BACKOFF_SECONDS = 10    # 失败后至少等这么久再重新领取
+
+PENDING = "pending"
+LEASED = "leased"
+DONE = "done"
+DEAD = "dead"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id            INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind          TEXT NOT NULL,
+    payload       TEXT NOT NULL,
+    dedup_key     TEXT UNIQUE,
+    priority      INTEGER NOT NULL DEFAULT 0,
+    status        TEXT NOT NULL DEFAULT 'pending',
+    attempts      INTEGER NOT NULL DEFAULT 0,
+    max_attempts  INTEGER NOT NULL DEFAULT 3,
+    lease_owner   TEXT,
+    lease_until   REAL,
+    not_before    REAL NOT NULL DEFAULT 0,
+    result        TEXT,
+    error         TEXT,
+    created_at    REAL NOT NULL,
+    updated_at    REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_pick ON jobs (kind, status, priority DESC, id);
+"""
+
+
+class JobQueue:
+    """
+    多个 worker (可以在不同机器上，只要能访问同一个数据库文件) 共享的任务表。
+    - enqueue: 相同 (kind, payload) 只会入队一次
+    - lease:   原子地领取一个任务，按优先级从高到低；过期租约的任务会被重新领取
+    - ack / fail / defer: 完成、失败 (超过次数进入 dead)、延后 (不计失败次数)
+
+    注意：多机共享时请把数据库放在支持文件锁的存储上；网络文件系统的锁不一定可靠。
+    """
+
+    def __init__(self, path=DEFAULT_DB_PATH):
+        self.path = path
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.local = threading.local()
+        self._raw().executescript(_SCHEMA)
+
+    def _raw(self):
+        # sqlite 连接不能跨线程共享，每个线程一个
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            self.local.conn = conn
+        return conn
+
+    def _conn(self):
+        return _Transaction(self._raw())
+
+    # ---------- 生产者 ----------
+    def enqueue(self, kind, payload, priority=0, max_attempts=DEFAULT_MAX_ATTEMPTS, dedup_exclude=()):
+        """
+        入队；返回是否新插入 (重复的任务会被忽略)。
+        dedup_exclude 里的字段不参与去重 (例如每次入队都不同的输出目录)。
+        """
+        now = time.time()
+        dedup = {k: v for k, v in payload.items() if k not in dedup_exclude}
+        with self._conn() as conn:
+            cur = conn.execute(
+                "INSERT OR IGNORE INTO jobs (kind, payload, dedup_key, priority, max_attempts, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (kind, json.dumps(payload, ensure_ascii=False), fingerprint(kind, dedup),
+                 priority, max_attempts, now, now),
+            )
+            return cur.rowcount == 1
+
+    def enqueue_many(self, kind, payloads, priority=0, max_attempts=DEFAULT_MAX_ATTEMPTS, dedup_exclude=()):
+        return sum(self.enqueue(kind, p, priority, max_attempts, dedup_exclude) for p in payloads)
+
+    # ---------- 消费者 ----------
+    def lease(self, worker_id, kinds=None, lease_seconds=DEFAULT_LEASE_SECONDS):
+        """领取一个任务，返回 dict (id, kind, payload, attempts) 或 None"""
+        now = time.time()
+        kind_filter, params = "", [now, now]
+        if kinds:
+            kind_filter = f"AND kind IN ({','.join('?' * len(kinds))})"
+            params.extend(kinds)
+
+        with self._conn() as conn:
+            # 租约过期且次数用完的任务直接判死
+            conn.execute(
+                "UPDATE jobs SET status = ?, error = COALESCE(error, 'lease expired'), updated_at = ? "
+                "WHERE status = ? AND lease_until < ? AND attempts >= max_attempts",
+                (DEAD, now, LEASED, now),
+            )
+            row = conn.execute(
+                f"SELECT id, kind, payload, attempts FROM jobs "
+                f"WHERE ((status = 'pending' AND not_before <= ?) OR (status = 'leased' AND lease_until < ?)) "
+                f"{kind_filter} ORDER BY priority DESC, id LIMIT 1",
+                params,
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                "UPDATE jobs SET status = ?, lease_owner = ?, lease_until = ?, attempts = attempts + 1, updated_at = ? "
+                "WHERE id = ?",
+                (LEASED, worker_id, now + lease_seconds, now, row["id"]),
+            )
+        return {"id": row["id"], "kind": row["kind"], "payload": json.loads(row["payload"]), "attempts": row["attempts"] + 1}
+
+    def heartbeat(self, job_id, worker_id, lease_seconds=DEFAULT_LEASE_SECONDS):
+        """续租；返回 False 表示租约已经不属于自己"""
+        with self._conn() as conn:
+            cur = conn.execute(
+                "UPDATE jobs SET lease_until = ?, updated_at = ? WHERE id = ? AND lease_owner = ? AND status = ?",
+                (time.time() + lease_seconds, time.time(), job_id, worker_id, LEASED),
+            )
+            return cur.rowcount == 1
+
+    def ack(self, job_id, worker_id, result=None):
+        with self._conn() as conn:
+            cur = conn.execute(
+                "UPDATE jobs SET status = ?, result = ?, error = NULL, lease_until = NULL, updated_at = ? "
+                "WHERE id = ? AND lease_owner = ? AND status = ?",
+                (DONE, json.dumps(result, ensure_ascii=False), time.time(), job_id, worker_id, LEASED),
+            )
+            return cur.rowcount == 1
+
+    def fail(self, job_id, worker_id, error):
+        """失败：次数没用完就退回队列 (带退避)，否则进入 dead"""
+        now = time.time()
+        with self._conn() as conn:
+            cur = conn.execute(
+                "UPDATE jobs SET status = CASE WHEN attempts >= max_attempts THEN ? ELSE ? END, "
+                "error = ?, lease_until = NULL, not_before = ? + ? * attempts, updated_at = ? "
+                "WHERE id = ? AND lease_owner = ? AND status = ?",
+                (DEAD, PENDING, str(error)[:2000], now, RETRY_BACKOFF_SECONDS, now, job_id, worker_id, LEASED),
+            )
+            return cur.rowcount == 1
+
+    def defer(self, job_id, worker_id, delay_seconds):
+        """延后执行且不计失败次数 (例如模型正在熔断)"""
+        now = time.time()
+        with self._conn() as conn:
+            cur = conn.execute(
+                "UPDATE jobs SET status = ?, attempts = attempts - 1, lease_until = NULL, not_before = ?, updated_at = ? "
+                "WHERE id = ? AND lease_owner = ? AND status = ?",
+                (PENDING, now + delay_seconds, now, job_id, worker_id, LEASED),
+            )
+            return cur.rowcount == 1
+
+    # ---------- 查看 / 导出 ----------
+    def stats(self):
+        """{kind: {status: count}}"""
+        with self._conn() as conn:
+            rows = conn.execute("SELECT kind, status, COUNT(*) AS n FROM jobs GROUP BY kind, status").fetchall()
+        result = {}
+        for r in rows:
+            result.setdefault(r["kind"], {})[r["status"]] = r["n"]
+        return result
+
+    def results(self, kind):
+        """按入队顺序遍历已完成任务的 (payload, result)"""
+        with self._conn() as conn:
+            rows = conn.execute(
+                "SELECT payload, result FROM jobs WHERE kind = ? AND status = ? ORDER BY id", (kind, DONE)
+            ).fetchall()
+        for r in rows:
+            yield json.loads(r["payload"]), json.loads(r["result"])
+
+    def retry_dead(self, kind=None):
+        """把 dead 任务重新放回队列"""
+        with self._conn() as conn:
+            sql = "UPDATE jobs SET status = ?, attempts = 0, not_before = 0, updated_at = ? WHERE status = ?"
+            params = [PENDING, time.time(), DEAD]
+            if kind:
+                sql += " AND kind = ?"
+                params.append(kind)
+            return conn.execute(sql, params).rowcount
+
+
+class _Transaction:
+    """BEGIN IMMEDIATE ... COMMIT，保证领取任务时的原子性"""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute("BEGIN IMMEDIATE")
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        self.conn.execute("ROLLBACK" if exc_type else "COMMIT")
+        return False
@@ -0,0 +1,263 @@
+import os
+import ast
+import json
+import mmap
+import struct
+import operator
+from array import array
+from bisect import bisect_right
+
+# ============================
+# JSONL 字节偏移索引 + mmap 随机访问
+# ============================
+# 索引文件放在数据文件旁边 (<file>.idx)：
+#   头部 16 字节 = 数据文件大小 + mtime_ns，用来判断索引是否过期
+#   之后是每条记录起始位置的 uint64 数组
+INDEX_SUFFIX = ".idx"
+_HEADER = struct.Struct("<Qq")
+
+
+class JsonlIndex:
+    """
+    第一次打开时扫描一遍换行符建立索引，之后直接读 .idx。
+    按编号取记录只需要一次切片 + json.loads，与文件大小无关。
+    """
+
+    def __init__(self, path, rebuild=False):
+        self.path = path
+        self.index_path = path + INDEX_SUFFIX
+        self.file = open(path, "rb")
+        size = os.fstat(self.file.fileno()).st_size
+        # 空文件不能 mmap
+        self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+        self.offsets = None if rebuild else self._load_index()
+        if self.offsets is None:
+            self.offsets = self._build_index()
+            self._save_index()
+
+    def close(self):
+        if isinstance(self.mm, mmap.mmap):
+            self.mm.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    # ---------- 索引 ----------
+    def _stamp(self):
+        st = os.stat(self.path)
+        return st.st_size, st.st_mtime_ns
+
+    def _load_index(self):
+        if not os.path.exists(self.index_path):
+            return None
+        with open(self.index_path, "rb") as f:
+            header = f.read(_HEADER.size)
+            if len(header) != _HEADER.size or _HEADER.unpack(header) != self._stamp():
+                return None
+            offsets = array("Q")
+            offsets.frombytes(f.read())
+        return offsets
+
+    def _build_index(self):
+        offsets = array("Q")
+        mm, pos, end = self.mm, 0, len(self.mm)
+        while pos < end:
+            nl = mm.find(b"\n", pos)
+            if nl == -1:
+                nl = end
+            # 跳过空行
+            if mm[pos:min(nl, pos + 64)].strip():
+                offsets.append(pos)
+            pos = nl + 1
+        return offsets
+
+    def _save_index(self):
+        try:
+            with open(self.index_path, "wb") as f:
+                f.write(_HEADER.pack(*self._stamp()))
+                self.offsets.tofile(f)
+        except OSError:
+            pass  # 只读目录下就不落盘，每次重建
+
+    # ---------- 访问 ----------
+    def __len__(self):
+        return len(self.offsets)
+
+    def raw(self, i):
+        start = self.offsets[i]
+        nl = self.mm.find(b"\n", start)
+        return self.mm[start:nl if nl != -1 else len(self.mm)]
+
+    def get(self, i):
+        return json.loads(self.raw(i))
+
+    def record_at_byte(self, pos):
+        """字节位置 -> 所在记录编号"""
+        return bisect_right(self.offsets, pos) - 1
+
+    def scan(self, needle, start=0):
+        """
+        在原始字节里查找 needle，按记录编号升序产出"可能包含它"的记录。
+        每条记录最多产出一次；调用方需要再解析校验。
+        """
+        if not len(self.offsets) or start >= len(self.offsets):
+            return
+        pos = self.offsets[start]
+        while True:
+            hit = self.mm.find(needle, pos)
+            if hit == -1:
+                return
+            i = self.record_at_byte(hit)
+            yield i
+            if i + 1 >= len(self.offsets):
+                return
+            pos = self.offsets[i + 1]
+
+
+def json_needles(value, quoted=True):
+    """
+    同一个值在 JSONL 里可能的字节形式 (ensure_ascii 开/关)。
+    quoted=False 时去掉两边引号，用于字符串内的子串搜索。
+    """
+    forms = {json.dumps(value, ensure_ascii=False), json.dumps(value)}
+    if not quoted:
+        forms = {f[1:-1] for f in forms}
+    return [f.encode("utf-8") for f in forms]
+
+
+# ============================
+# 字段过滤表达式
+# ============================
+# 支持: model == "deepseek-r1" and holistic_score < 5
+#       not (scheme_type in ["batch", "selfplay"]) or meta.round >= 2
+# 只允许比较 / 布尔运算 / 常量 / 字段名，不会执行任意代码
+_COMPARE_OPS = {
+    ast.Eq: operator.eq, ast.NotEq: operator.ne,
+    ast.Lt: operator.lt, ast.LtE: operator.le,
+    ast.Gt: operator.gt, ast.GtE: operator.ge,
+    ast.In: lambda a, b: a in b, ast.NotIn: lambda a, b: a not in b,
+}
+
+
+class RecordFilter:
+    def __init__(self, expr):
+        self.expr = expr
+        try:
+            self.tree = ast.parse(expr, mode="eval").body
+        except SyntaxError as e:
+            raise ValueError(f"过滤表达式语法错误: {expr}") from e
+        self._check(self.tree)
+
+    def _check(self, node):
+        allowed = (ast.BoolOp, ast.And, ast.Or, ast.UnaryOp, ast.Not, ast.USub, ast.Compare,
+                   ast.Name, ast.Attribute, ast.Constant, ast.List, ast.Tuple, ast.Load) + tuple(_COMPARE_OPS)
+        for child in ast.walk(node):
+            if not isinstance(child, allowed):
+                raise ValueError(f"过滤表达式不支持: {type(child).__name__}")
+
+    def __call__(self, record):
+        return bool(self._eval(self.tree, record))
+
+    def _eval(self, node, record):
+        if isinstance(node, ast.BoolOp):
+            values = (self._eval(v, record) for v in node.values)
+            return all(values) if isinstance(node.op, ast.And) else any(values)
+        if isinstance(node, ast.UnaryOp):
+            value = self._eval(node.operand, record)
+            return (not value) if isinstance(node.op, ast.Not) else -value
+        if isinstance(node, ast.Compare):
+            left = self._eval(node.left, record)
+            for op, comparator in zip(node.ops, node.comparators):
+                right = self._eval(comparator, record)
+                try:
+                    if not _COMPARE_OPS[type(op)](left, right):
+                        return False
+                except TypeError:
+                    return False  # 字段缺失 (None) 或类型不匹配，视为不满足
+                left = right
+            return True
+        if isinstance(node, ast.Constant):
+            return node.value
+        if isinstance(node, (ast.List, ast.Tuple)):
+            return [self._eval(e, record) for e in node.elts]
+        return _lookup(record, _field_path(node))
+
+    def required_literals(self):
+        """
+        顶层 and 链里 `字段 == "字符串"` 的常量：满足过滤条件的记录原文里一定包含它们，
+        可以先用 mmap 做字节预筛选，不必逐条解析。
+        """
+        terms = self.tree.values if isinstance(self.tree, ast.BoolOp) and isinstance(self.tree.op, ast.And) else [self.tree]
+        literals = []
+        for t in terms:
+            if isinstance(t, ast.Compare) and len(t.ops) == 1 and isinstance(t.ops[0], ast.Eq):
+                for side in (t.left, t.comparators[0]):
+                    if isinstance(side, ast.Constant) and isinstance(side.value, str) and side.value:
+                        literals.append(side.value)
+        return literals
+
+
+def _field_path(node):
+    if isinstance(node, ast.Name):
+        return [node.id]
+    if isinstance(node, ast.Attribute):
+        return _field_path(node.value) + [node.attr]
+    raise ValueError(f"过滤表达式不支持: {ast.dump(node)}")
+
+
+def _lookup(record, path):
+    value = record
+    for key in path:
+        if not isinstance(value, dict):
+            return None
+        value = value.get(key)
+    return value
+
+
+# ============================
+# 查询：过滤 + 子串搜索，惰性产出 (编号, 记录)
+# ============================
+def iter_matches(index, where=None, search=None, search_field="dialogue_content", start=0):
+    """
+    where:  过滤表达式 (字符串) 或 RecordFilter
+    search: 在 search_field 里做子串搜索
+    结果按记录编号升序惰性产出，翻页时只解析到够用为止。
+    """
+    record_filter = RecordFilter(where) if isinstance(where, str) else where
+
+    # 选一个最长的必需字节串做 mmap 预筛选
+    needles = []
+    if search:
+        needles.append(json_needles(search, quoted=False))
+    if record_filter is not None:
+        needles.extend(json_needles(lit) for lit in record_filter.required_literals())
+
+    if needles:
+        best = max(needles, key=lambda forms: min(len(f) for f in forms))
+        candidates = _merge_scans(index, best, start)
+    else:
+        candidates = range(start, len(index))
+
+    for i in candidates:
+        try:
+            record = index.get(i)
+        except json.JSONDecodeError:
+            continue
+        if search and search not in str(_lookup(record, search_field.split(".")) or ""):
+            continue
+        if record_filter is not None and not record_filter(record):
+            continue
+        yield i, record
+
+
+def _merge_scans(index, forms, start):
+    if len(forms) == 1:
+        yield from index.scan(forms[0], start)
+        return
+    # 同一个值的两种编码都可能出现，合并后去重
+    yield from sorted(set().union(*(index.scan(f, start) for f in forms)))
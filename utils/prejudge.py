@@ -0,0 +1,213 @@
+import os
+import re
+import json
+import threading
+from pathlib import Path
+
+from utils.run_metrics import RUN_METRICS
+
+# ============================
+# 本地预判 (裁判前的级联)：规则特征打一个本地分，
+# 明显好 / 明显差的对话直接给分，只有拿不准的才送 LLM 裁判
+# ============================
+# 开启: COT_PREJUDGE=1 python step4_whole_judge.py
+# 阈值每次运行前用历史裁判分数校准 (本地分 <= low 时历史上几乎都是低分，>= high 时几乎都是高分)；
+# 历史样本不足或找不到满足精度要求的阈值时，级联自动关闭，全部照常送裁判。
+PREJUDGE_ENV = "COT_PREJUDGE"
+CALIBRATION_DIR = "outputs/prejudge"
+
+FAIL_SCORE = 4              # 裁判分 <= 这个值算"差"
+PASS_SCORE = 7              # 裁判分 >= 这个值算"好"
+TARGET_PRECISION = 0.9      # 被本地直接判定的区间里，历史上判对的比例至少要这么高
+MIN_CALIBRATION = 50        # 历史样本少于这个数不开启级联
+MIN_BUCKET = 10             # 直接判定的区间里至少要有这么多历史样本
+
+# 通用情绪词 (孩子的情绪困扰 + AiMe 的共情/鼓励)
+EMOTION_KEYWORDS = (
+    "难过", "伤心", "开心", "高兴", "害怕", "生气", "担心", "委屈", "孤单", "紧张", "失望", "烦",
+    "哭", "心情", "感受", "抱抱", "别怕", "没关系", "理解", "陪着", "喜欢", "棒", "厉害", "勇敢",
+)
+
+_TURN = re.compile(r"【(AiMe|User)】[:：]\s*")
+_HAN = re.compile(r"[一-鿿]+")
+
+
+def split_turns(dialogue_text):
+    """把 "【AiMe】: ... 【User】: ..." 格式的对话拆成 [(角色, 内容), ...]"""
+    parts = _TURN.split(dialogue_text)
+    return [(parts[i], parts[i + 1].strip()) for i in range(1, len(parts) - 1, 2)]
+
+
+def _bigrams(text):
+    return {seg[i:i + 2] for seg in _HAN.findall(text) for i in range(len(seg) - 1)}
+
+
+def _step_terms(step):
+    """细分步骤的描述部分 ("1.情绪词的检索：检索用户提到的..." 冒号后面) 的汉字二元组"""
+    body = re.split(r"[:：]", step, maxsplit=1)[-1]
+    return _bigrams(body)
+
+
+def extract_features(dialogue_text, steps=None):
+    """规则特征，全部归一到 0-1 (越大越好)"""
+    turns = split_turns(dialogue_text)
+    aime = [c for r, c in turns if r == "AiMe"]
+    if not aime:
+        return {"turns": 0.0, "length": 0.0, "question": 0.0, "emotion": 0.0, "novelty": 0.0, "steps": 0.0}
+
+    mean_len = sum(len(c) for c in aime) / len(aime)
+    aime_text = "".join(aime)
+    grams = [c[i:i + 2] for c in aime for i in range(len(c) - 1)]
+    features = {
+        "turns": min(len(turns) / 8, 1.0),
+        # AiMe 单句 8-80 字最合适，太短敷衍、太长说教
+        "length": 1.0 if 8 <= mean_len <= 80 else max(0.0, 1 - abs(mean_len - (8 if mean_len < 8 else 80)) / 80),
+        # "加上问句引导"：AiMe 有多少句带问号
+        "question": sum(1 for c in aime if "？" in c or "?" in c) / len(aime),
+        "emotion": min(sum(1 for w in EMOTION_KEYWORDS if w in aime_text) / 4, 1.0),
+        # 重复：AiMe 说过的二元组里不重复的比例
+        "novelty": len(set(grams)) / len(grams) if grams else 0.0,
+    }
+    if steps:
+        aime_grams = _bigrams(aime_text)
+        covered = sum(1 for s in steps if len(_step_terms(s) & aime_grams) >= 2)
+        features["steps"] = covered / len(steps)
+    return features
+
+
+# 本地分 = 特征加权和，映射到和裁判一样的 0-10 分
+FEATURE_WEIGHTS = {"turns": 1.5, "length": 1.5, "question": 2.0, "emotion": 2.0, "novelty": 1.5, "steps": 1.5}
+
+
+def local_score(features):
+    used = {k: w for k, w in FEATURE_WEIGHTS.items() if k in features}
+    return round(10 * sum(features[k] * w for k, w in used.items()) / sum(used.values()), 3)
+
+
+def _median(values):
+    values = sorted(values)
+    mid = len(values) // 2
+    return values[mid] if len(values) % 2 else (values[mid - 1] + values[mid]) / 2
+
+
+def calibrate(pairs, fail_score=FAIL_SCORE, pass_score=PASS_SCORE, precision=TARGET_PRECISION,
+              min_bucket=MIN_BUCKET):
+    """
+    pairs: [(本地分, 历史裁判分), ...]
+    low  = 满足 "本地分 <= low 的样本里裁判分 <= fail_score 的比例 >= precision" 的最大值
+    high = 满足 "本地分 >= high 的样本里裁判分 >= pass_score 的比例 >= precision" 的最小值
+    两个区间里直接给的分数取该区间历史裁判分的中位数。找不到时对应一侧为 None。
+    """
+    pairs = sorted(pairs)
+    n = len(pairs)
+    result = {"samples": n, "low": None, "high": None, "low_score": None, "high_score": None}
+
+    bad = 0
+    for i, (local, judge) in enumerate(pairs):
+        bad += judge <= fail_score
+        # 相同本地分的样本要一起进区间
+        if i + 1 < n and pairs[i + 1][0] == local:
+            continue
+        if i + 1 >= min_bucket and bad / (i + 1) >= precision:
+            result["low"] = local
+            result["low_score"] = _median(j for _, j in pairs[:i + 1])
+
+    good = 0
+    for i in range(n - 1, -1, -1):
+        local, judge = pairs[i]
+        good += judge >= pass_score
+        if i > 0 and pairs[i - 1][0] == local:
+            continue
+        if n - i >= min_bucket and good / (n - i) >= precision:
+            result["high"] = local
+            result["high_score"] = _median(j for _, j in pairs[i:])
+
+    if result["low"] is not None and result["high"] is not None and result["low"] >= result["high"]:
+        # 两个区间重叠说明本地分分不开好坏，宁可全部送裁判
+        result.update(low=None, high=None, low_score=None, high_score=None)
+
+    coverage = sum(1 for local, _ in pairs if _decide(result, local) is not None)
+    result["history_coverage"] = round(coverage / n, 3) if n else 0.0
+    return result
+
+
+def _decide(calibration, score):
+    if calibration["low"] is not None and score <= calibration["low"]:
+        return "fail"
+    if calibration["high"] is not None and score >= calibration["high"]:
+        return "pass"
+    return None
+
+
+class PreJudge:
+    """
+    history_fn() -> [(对话文本, 细分步骤或 None, 历史裁判分), ...]，第一次 triage 时才调用并校准。
+    由本地直接判定的结果不要再作为历史样本 (调用方按来源字段排除)，否则会自我强化。
+    """
+
+    def __init__(self, stage, history_fn, enabled=None):
+        self.stage = stage
+        self.history_fn = history_fn
+        self.enabled = os.environ.get(PREJUDGE_ENV, "") not in ("", "0") if enabled is None else enabled
+        self.calibration = None
+        self.lock = threading.Lock()
+        self.counts = {"pass": 0, "fail": 0, "judge": 0}
+
+    def _calibrate(self):
+        pairs = [(local_score(extract_features(text, steps)), float(score)) for text, steps, score in self.history_fn()]
+        calibration = calibrate(pairs) if len(pairs) >= MIN_CALIBRATION else {"samples": len(pairs), "low": None, "high": None}
+        if len(pairs) < MIN_CALIBRATION:
+            print(f"⚖️ 本地预判: 历史裁判样本 {len(pairs)} 条 (< {MIN_CALIBRATION})，本次不启用")
+        elif calibration["low"] is None and calibration["high"] is None:
+            print(f"⚖️ 本地预判: {len(pairs)} 条历史样本中找不到精度 >= {TARGET_PRECISION:.0%} 的阈值，本次不启用")
+        else:
+            rules = []
+            if calibration["low"] is not None:
+                rules.append(f"本地分 <= {calibration['low']} 判差")
+            if calibration["high"] is not None:
+                rules.append(f"本地分 >= {calibration['high']} 判好")
+            print(f"⚖️ 本地预判: 用 {len(pairs)} 条历史样本校准，{'、'.join(rules)}，"
+                  f"历史上可免裁判 {calibration['history_coverage']:.1%}")
+
+        path = os.path.join(CALIBRATION_DIR, f"{self.stage}.json")
+        Path(CALIBRATION_DIR).mkdir(parents=True, exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(calibration, f, ensure_ascii=False, indent=2)
+        return calibration
+
+    def triage(self, dialogue_text, steps=None):
+        """
+        返回 None 表示需要送裁判；否则返回本地判定 {"score", "analysis", "local_score", "verdict"}。
+        """
+        if not self.enabled:
+            return None
+        with self.lock:
+            if self.calibration is None:
+                self.calibration = self._calibrate()
+        calibration = self.calibration
+
+        features = extract_features(dialogue_text, steps)
+        score = local_score(features)
+        verdict = _decide(calibration, score)
+        with self.lock:
+            self.counts[verdict or "judge"] += 1
+        RUN_METRICS.incr(f"prejudge_{verdict or 'judge'}")
+        if verdict is None:
+            return None
+
+        assigned = calibration[f"{'low' if verdict == 'fail' else 'high'}_score"]
+        label = "明显较差" if verdict == "fail" else "明显合格"
+        return {
+            "score": int(round(assigned)),
+            "analysis": f"本地预判{label} (本地分 {score}，未送裁判)",
+            "local_score": score,
+            "verdict": verdict,
+        }
+
+    def report(self):
+        total = sum(self.counts.values())
+        if not self.enabled or not total:
+            return
+        saved = self.counts["pass"] + self.counts["fail"]
+        print(f"⚖️ 本地预判 ({self.stage}): 共 {total} 条 | 直接判好 {self.counts['pass']} | "
+              f"直接判差 {self.counts['fail']} | 送裁判 {self.counts['judge']} | 节省裁判调用 {saved / total:.1%}")
@@ -14,4 +14,9 @@ class JudgeSchema(BaseModel):
     reasoning_analysis: str = Field(..., description="【引导与安全分析】：评估回复是否有趣、安全、符合儿童心理。")
     
     reason: str = Field(..., description="综合判定理由。")
-    winner: str = Field(..., description="胜者: 'model_a', 'model_b', or 'tie'。")
\ No newline at end of file
+    winner: str = Field(..., description="胜者: 'model_a', 'model_b', or 'tie'。")
+
+class CritiqueSchema(JudgeSchema):
+    """多轮自我优化时的单项评审结果（在 JudgeSchema 基础上增加分数）"""
+
+    score: int = Field(..., description="对模型A回复的综合评分 (0-10分)，用于判断优化是否仍有提升。")
@@ -0,0 +1,46 @@
+import json
+import time
+import threading
+from pathlib import Path
+
+# ============================
+# 运行指标：计数器 + 事件日志 (线程安全)
+# ============================
+MAX_EVENTS = 1000  # 事件日志只保留最近这么多条
+
+
+class RunMetrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started_at = time.time()
+        self.counters = {}
+        self.events = []
+
+    def incr(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def event(self, kind, **fields):
+        item = {"ts": round(time.time() - self.started_at, 3), "kind": kind}
+        item.update(fields)
+        with self.lock:
+            self.events.append(item)
+            if len(self.events) > MAX_EVENTS:
+                del self.events[: len(self.events) - MAX_EVENTS]
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "elapsed_seconds": round(time.time() - self.started_at, 3),
+                "counters": dict(self.counters),
+                "events": list(self.events),
+            }
+
+    def save(self, path):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.snapshot(), f, ensure_ascii=False, indent=2)
+
+
+# 进程内共享的一份指标
+RUN_METRICS = RunMetrics()
@@ -0,0 +1,218 @@
+import math
+from statistics import NormalDist
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.run_metrics import RUN_METRICS
+
+# ============================
+# 序贯抽样评估：排名一旦确定就停止继续采样
+# ============================
+ALPHA = 0.05              # 总体犯错概率 (对所有模型对、所有轮次做 Bonferroni 校正)
+MIN_SAMPLES = 3           # 每个单元至少采这么多次才参与判断
+MAX_SAMPLES_PER_CELL = 10 # 每个单元最多采样次数 (也就是最多轮数)
+VAR_FLOOR = 0.25          # 方差下限，防止少量样本恰好相同时方差为 0 导致过早判定
+MAX_WORKERS = 8
+
+
+class CellStats:
+    """单个 (模型, 类别) 单元的在线均值 / 方差 (Welford)"""
+
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.scores = []
+
+    def add(self, x):
+        self.n += 1
+        self.scores.append(x)
+        delta = x - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (x - self.mean)
+
+    def var(self):
+        if self.n < 2:
+            return float("inf")
+        return max(self.m2 / (self.n - 1), VAR_FLOOR)
+
+
+class SequentialEvaluator:
+    """
+    按轮次给 (模型, 类别) 单元分配样本：
+    - 每轮给所有仍在采样的单元各加一个样本，然后更新估计
+    - 类别内：某个模型与同类别其他所有模型的差值置信区间都不含 0，该单元停止
+    - 模型整体 (各类别均值的平均)：与其他所有模型都分开后，该模型全部单元停止
+    - goal="top" 时只关心第一名：领先者与所有人分开后整体结束
+    置信区间用正态近似，临界值按 模型对数 × 最大轮数 做 Bonferroni 校正，
+    保证"中途多次查看"也不会把显著性水平放大。
+
+    sample_fn(model, category, index) -> 分数；返回 None 表示本轮暂时采不到 (例如熔断)。
+    """
+
+    def __init__(self, models, categories, sample_fn, alpha=ALPHA, min_samples=MIN_SAMPLES,
+                 max_samples=MAX_SAMPLES_PER_CELL, goal="rank", workers=MAX_WORKERS):
+        self.models = list(models)
+        self.categories = list(categories)
+        self.sample_fn = sample_fn
+        self.min_samples = min_samples
+        self.max_samples = max_samples
+        self.goal = goal
+        self.workers = workers
+
+        self.cells = {(m, c): CellStats() for m in self.models for c in self.categories}
+        self.stopped = {}       # (模型, 类别) -> 停止原因
+        self.settled_models = set()
+        self.history = []
+
+        pairs = max(1, len(self.models) * (len(self.models) - 1) // 2)
+        self.z = NormalDist().inv_cdf(1 - alpha / (2 * pairs * max_samples))
+
+    # ---------- 估计 ----------
+    def model_estimate(self, model):
+        """模型整体分 = 各类别单元均值的平均；返回 (均值, 方差)，样本不足时方差为 inf"""
+        cells = [self.cells[(model, c)] for c in self.categories]
+        if any(cell.n == 0 for cell in cells):
+            return float("nan"), float("inf")
+        k = len(cells)
+        mean = sum(cell.mean for cell in cells) / k
+        var = sum(cell.var() / cell.n for cell in cells) / (k * k)
+        return mean, var
+
+    def _separated(self, mean_a, var_a, mean_b, var_b):
+        if math.isinf(var_a) or math.isinf(var_b):
+            return False
+        return abs(mean_a - mean_b) > self.z * math.sqrt(var_a + var_b)
+
+    def _cell_separated(self, model, category):
+        a = self.cells[(model, category)]
+        if a.n < self.min_samples:
+            return False
+        for other in self.models:
+            if other == model:
+                continue
+            b = self.cells[(other, category)]
+            if b.n < self.min_samples or not self._separated(a.mean, a.var() / a.n, b.mean, b.var() / b.n):
+                return False
+        return True
+
+    def _model_separated(self, model):
+        if any(self.cells[(model, c)].n < self.min_samples for c in self.categories):
+            return False
+        mean_a, var_a = self.model_estimate(model)
+        for other in self.models:
+            if other == model:
+                continue
+            mean_b, var_b = self.model_estimate(other)
+            if not self._separated(mean_a, var_a, mean_b, var_b):
+                return False
+        return True
+
+    def _update_stops(self):
+        for model in self.models:
+            if model not in self.settled_models and self._model_separated(model):
+                self.settled_models.add(model)
+                for c in self.categories:
+                    self.stopped.setdefault((model, c), "model_settled")
+        for (model, category), cell in self.cells.items():
+            if (model, category) in self.stopped:
+                continue
+            if self._cell_separated(model, category):
+                self.stopped[(model, category)] = "cell_settled"
+            elif cell.n >= self.max_samples:
+                self.stopped[(model, category)] = "max_samples"
+
+        if self.goal == "top":
+            leader = self.leader()
+            if leader in self.settled_models:
+                for key in self.cells:
+                    self.stopped.setdefault(key, "leader_settled")
+
+    def leader(self):
+        estimates = {m: self.model_estimate(m)[0] for m in self.models}
+        valid = {m: v for m, v in estimates.items() if not math.isnan(v)}
+        return max(valid, key=valid.get) if valid else None
+
+    # ---------- 主循环 ----------
+    def _draw(self, key):
+        model, category = key
+        index = self.cells[key].n
+        try:
+            score = self.sample_fn(model, category, index)
+        except Exception as e:
+            print(f"  ❌ [{model} / {category}] 采样失败: {e}")
+            return key, None
+        return key, score
+
+    def run(self):
+        for round_index in range(1, self.max_samples + 1):
+            active = [key for key in self.cells if key not in self.stopped]
+            if not active:
+                break
+            print(f"\n🔁 第 {round_index} 轮：采样 {len(active)} 个单元 "
+                  f"(已停止 {len(self.stopped)}/{len(self.cells)})")
+
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                results = list(executor.map(self._draw, active))
+            drawn = 0
+            for key, score in results:
+                if score is not None:
+                    self.cells[key].add(float(score))
+                    drawn += 1
+            RUN_METRICS.incr("sequential_samples", drawn)
+
+            self._update_stops()
+            estimates = {m: self.model_estimate(m)[0] for m in self.models}
+            self.history.append({
+                "round": round_index,
+                "sampled": drawn,
+                "stopped_cells": len(self.stopped),
+                "settled_models": sorted(self.settled_models),
+                "estimates": {m: round(v, 3) for m, v in estimates.items() if not math.isnan(v)},
+            })
+        return self.summary()
+
+    def summary(self):
+        used = sum(cell.n for cell in self.cells.values())
+        full = len(self.cells) * self.max_samples
+        models = {}
+        for m in self.models:
+            mean, var = self.model_estimate(m)
+            # 样本不足的模型没有区间，写 None 以保证 JSON 合法
+            known = not math.isinf(var)
+            half = self.z * math.sqrt(var) if known else 0
+            models[m] = {
+                "mean": round(mean, 3) if known else None,
+                "ci_low": round(mean - half, 3) if known else None,
+                "ci_high": round(mean + half, 3) if known else None,
+                "settled": m in self.settled_models,
+            }
+        # 没有区间的模型排在最后
+        ranking = sorted(models, key=lambda m: (models[m]["mean"] is None, -(models[m]["mean"] or 0)))
+        return {
+            "goal": self.goal,
+            "z": round(self.z, 3),
+            "samples_used": used,
+            "samples_full_grid": full,
+            "budget_saved": round(1 - used / full, 3) if full else 0,
+            "ranking": ranking,
+            "models": models,
+            "cells": [
+                {"model": m, "category": c, "n": cell.n, "mean": round(cell.mean, 3),
+                 "stop_reason": self.stopped.get((m, c), "unsettled")}
+                for (m, c), cell in self.cells.items()
+            ],
+            "rounds": self.history,
+        }
+
+
+def print_sequential_report(summary):
+    print("\n📊 序贯评估结果:")
+    for rank, m in enumerate(summary["ranking"], 1):
+        s = summary["models"][m]
+        if s["mean"] is None:
+            print(f"   {rank}. {m:<16} 样本不足")
+            continue
+        flag = "✅" if s["settled"] else "…"
+        print(f"   {rank}. {m:<16} {s['mean']:.2f}  [{s['ci_low']:.2f}, {s['ci_high']:.2f}] {flag}")
+    print(f"   样本: {summary['samples_used']} / 全量 {summary['samples_full_grid']} "
+          f"(节省 {summary['budget_saved']:.0%})")
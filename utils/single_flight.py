@@ -0,0 +1,138 @@
+import asyncio
+import threading
+
+from utils.cache_utils import fingerprint
+from utils.run_metrics import RUN_METRICS
+
+# ============================
+# single-flight：完全相同的请求正在进行时，后来的调用不再发请求，等同一个结果
+# ============================
+# 只合并确定性的请求 (temperature=0，或调用方显式 coalesce=True)；
+# temperature>0 的生成本来就要多次采样，不能合并。
+# 只合并"同时在途"的请求；跨运行的重复由 RecordCache 等缓存负责。
+
+
+def is_deterministic(temperature, coalesce=None):
+    """coalesce 显式给出时以它为准，否则 temperature 为 0 才合并"""
+    if coalesce is not None:
+        return coalesce
+    return temperature is not None and float(temperature) == 0.0
+
+
+def request_key(kind, *parts):
+    return fingerprint(kind, *parts)
+
+
+class _LeaderCancelled(Exception):
+    """do_async 的领头调用被取消，通知等待者接替"""
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.inflight = {}        # 指纹 -> _Flight (线程)
+        self.async_inflight = {}  # (事件循环, 指纹) -> asyncio.Future
+        self.stats = {}           # 类别 -> {"calls", "shared"}
+
+    def _count(self, kind, shared):
+        with self.lock:
+            s = self.stats.setdefault(kind, {"calls": 0, "shared": 0})
+            s["calls"] += 1
+            s["shared"] += shared
+        if shared:
+            RUN_METRICS.incr("single_flight_shared")
+
+    def do(self, kind, key, fn):
+        """同一 key 只有第一个调用者执行 fn()，其余等待并拿到同一个结果 (或同一个异常)"""
+        with self.lock:
+            flight = self.inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.inflight[key] = _Flight()
+        self._count(kind, not leader)
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = fn()
+            return flight.result
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.inflight[key]
+            flight.done.set()
+
+    async def do_async(self, kind, key, coro_fn):
+        """
+        do() 的协程版本；只在同一个事件循环内合并。
+        领头的调用被取消时不把取消传给等待者：由其中一个等待者接替领头重新执行。
+        """
+        loop_key = (id(asyncio.get_running_loop()), key)
+        counted = False
+        while True:
+            with self.lock:
+                future = self.async_inflight.get(loop_key)
+                leader = future is None
+                if leader:
+                    future = self.async_inflight[loop_key] = asyncio.get_running_loop().create_future()
+            if not counted:
+                self._count(kind, not leader)
+                counted = True
+
+            if not leader:
+                try:
+                    # shield：某个等待者被取消时不影响领头和其他等待者
+                    return await asyncio.shield(future)
+                except _LeaderCancelled:
+                    # 领头被取消：重新竞争，第一个回到这里的等待者成为新的领头
+                    continue
+
+            try:
+                result = await coro_fn()
+                future.set_result(result)
+                return result
+            except asyncio.CancelledError:
+                # 只取消领头自己，等待者收到 _LeaderCancelled 后接替
+                future.set_exception(_LeaderCancelled())
+                future.exception()
+                raise
+            except BaseException as e:
+                future.set_exception(e)
+                # 没有等待者时避免 "Future exception was never retrieved" 警告
+                future.exception()
+                raise
+            finally:
+                with self.lock:
+                    del self.async_inflight[loop_key]
+
+    def summary(self):
+        with self.lock:
+            return {k: dict(v) for k, v in self.stats.items()}
+
+
+# 进程内共享的一份
+SINGLE_FLIGHT = SingleFlight()
+
+
+def print_single_flight_report():
+    summary = SINGLE_FLIGHT.summary()
+    shared = sum(s["shared"] for s in summary.values())
+    if not shared:
+        return
+    print("🔗 相同请求合并 (single-flight):")
+    for kind, s in sorted(summary.items()):
+        print(f"   {kind}: 确定性调用 {s['calls']} | 合并 {s['shared']} | 实际请求 {s['calls'] - s['shared']} "
+              f"| 节省 {s['shared'] / s['calls']:.1%}")
@@ -0,0 +1,282 @@
+import os
+import re
+import json
+import atexit
+import threading
+import weakref
+from pathlib import Path
+
+from utils.run_metrics import RUN_METRICS
+from utils.dashboard import DASHBOARD
+from utils.tracing import span
+from utils.cassette import CASSETTE
+
+# ============================
+# 结构化输出模式 (按模型配置)
+# ============================
+# tools:  instructor 的 function calling 模式 (原来的默认行为)
+# json:   服务商原生 JSON 模式 (response_format=json_object)，由 instructor 解析校验
+# prompt: 普通对话调用，Schema 写进提示词，本地解析 + pydantic 校验
+MODES = ("tools", "json", "prompt")
+DEFAULT_MODE = os.environ.get("COT_STRUCTURED_MODE", "tools")
+
+# 按模型覆盖，例如 {"turing/deepseek-v3.1": "json"}
+# 也可以用环境变量: COT_STRUCTURED_MODES="turing/deepseek-v3.1=json,turing/qwen3-32b=prompt"
+MODEL_MODES = {}
+
+DEFAULT_STATS_FILE = "outputs/.structured_stats.json"
+
+REASK_TEMPLATE = "上一次的输出没有通过格式校验：\n{error}\n请严格按照要求的 JSON 结构重新输出，不要输出其他内容。"
+PROMPT_MODE_INSTRUCTION = (
+    "请只输出一个 JSON 对象，不要输出任何解释或 Markdown 代码块以外的内容。"
+    "JSON 必须符合以下 JSON Schema：\n{schema}"
+)
+
+
+def _instructor_mode(mode):
+    import instructor
+
+    return {"tools": instructor.Mode.TOOLS, "json": instructor.Mode.JSON}[mode]
+
+
+def _load_env_modes():
+    for item in os.environ.get("COT_STRUCTURED_MODES", "").split(","):
+        if "=" in item:
+            model, mode = item.rsplit("=", 1)
+            MODEL_MODES[model.strip()] = mode.strip()
+
+
+_load_env_modes()
+
+
+def mode_for(model):
+    mode = MODEL_MODES.get(model, DEFAULT_MODE)
+    if mode not in MODES:
+        raise ValueError(f"未知的结构化输出模式: {mode} (可选 {', '.join(MODES)})")
+    return mode
+
+
+# ============================
+# 重试 / 校验失败统计
+# ============================
+class StructuredStats:
+    """
+    按 (模型, Schema, 模式) 统计：
+        calls               调用次数
+        attempts            实际发出的请求数 (含重试)
+        validation_failures 输出未通过解析 / 校验的次数
+        exhausted           重试用尽仍失败的调用数
+    attempts - 成功数 就是浪费掉的请求，用来比较不同模式。
+    统计会跨运行累计保存，方便长期对比。
+    """
+
+    FIELDS = ("calls", "attempts", "successes", "validation_failures", "exhausted", "errors")
+
+    def __init__(self, path=DEFAULT_STATS_FILE):
+        self.path = path
+        self.lock = threading.Lock()
+        self.totals = {}
+        self.session = {}
+        if path and os.path.exists(path):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    self.totals = json.load(f)
+            except (json.JSONDecodeError, OSError):
+                print(f"Warning: 无法读取结构化输出统计文件: {path}")
+
+    @staticmethod
+    def _key(model, schema, mode):
+        return f"{model}::{schema}::{mode}"
+
+    def incr(self, model, schema, mode, field, n=1):
+        key = self._key(model, schema, mode)
+        with self.lock:
+            for table in (self.totals, self.session):
+                entry = table.setdefault(key, {f: 0 for f in self.FIELDS})
+                entry[field] = entry.get(field, 0) + n
+        RUN_METRICS.incr(f"structured_{field}", n)
+
+    def summary(self, cumulative=False):
+        with self.lock:
+            table = self.totals if cumulative else self.session
+            return {k: dict(v) for k, v in table.items()}
+
+    def save(self):
+        if not self.path or not self.session:
+            return
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, "w", encoding="utf-8") as f:
+            json.dump(self.summary(cumulative=True), f, ensure_ascii=False, indent=2)
+
+
+STRUCTURED_STATS = StructuredStats()
+atexit.register(STRUCTURED_STATS.save)
+
+
+def print_structured_report(cumulative=False):
+    summary = STRUCTURED_STATS.summary(cumulative)
+    if not summary:
+        return
+    print("🧩 结构化输出统计 (模型 / Schema / 模式):")
+    for key, s in sorted(summary.items()):
+        wasted = s["attempts"] - s["successes"]
+        rate = wasted / s["attempts"] if s["attempts"] else 0
+        print(f"   {key.replace('::', ' / ')}: 调用 {s['calls']} | 请求 {s['attempts']} | "
+              f"校验失败 {s['validation_failures']} | 用尽重试 {s['exhausted']} | 浪费 {rate:.1%}")
+
+
+# ============================
+# 各模式的一次调用
+# ============================
+# 原客户端 -> {模式: 派生客户端}；用弱引用，原客户端被回收后 id 复用也不会拿到旧客户端
+_mode_clients = weakref.WeakKeyDictionary()
+_mode_clients_lock = threading.Lock()
+
+
+def _client_for(client, mode):
+    """
+    get_*_client 返回的是 tools 模式的 instructor 客户端；
+    其他模式按同样的 api_key / base_url 另建一个客户端并缓存。
+    异步的派生客户端与原客户端在同一个事件循环里使用 (见 api_utils 的事件循环检查)。
+    """
+    if mode == "tools":
+        return client
+    import openai
+    import instructor
+
+    with _mode_clients_lock:
+        derived = _mode_clients.setdefault(client, {})
+        if mode not in derived:
+            is_async = isinstance(client, openai.AsyncOpenAI)
+            client_cls = openai.AsyncOpenAI if is_async else openai.OpenAI
+            raw = client_cls(api_key=client.api_key, base_url=client.base_url,
+                             **CASSETTE.openai_client_kwargs(async_client=is_async))
+            derived[mode] = raw if mode == "prompt" else instructor.patch(raw, mode=_instructor_mode(mode))
+        return derived[mode]
+
+
+def extract_json(text):
+    """从模型输出里取出 JSON 对象：兼容 ```json 代码块和前后多余文字"""
+    if not text:
+        raise ValueError("模型输出为空")
+    fenced = re.search(r"```(?:json)?\s*(\{.*?\})\s*```", text, re.S)
+    if fenced:
+        return fenced.group(1)
+    start, end = text.find("{"), text.rfind("}")
+    if start == -1 or end <= start:
+        raise ValueError(f"输出中没有 JSON 对象: {text[:100]}")
+    return text[start:end + 1]
+
+
+def _prompt_mode_messages(messages, response_model):
+    schema = json.dumps(response_model.model_json_schema(), ensure_ascii=False)
+    instruction = {"role": "system", "content": PROMPT_MODE_INSTRUCTION.format(schema=schema)}
+    return [instruction] + list(messages)
+
+
+def _parse_prompt_mode(completion, response_model):
+    content = completion.choices[0].message.content
+    result = response_model.model_validate_json(extract_json(content))
+    # 与 instructor 保持一致：把原始 completion 挂在 _raw_response 上 (调用方从中取 usage)
+    object.__setattr__(result, "_raw_response", completion)
+    return result
+
+
+def _call_once(client, mode, model, response_model, messages, kwargs):
+    if mode == "prompt":
+        completion = client.chat.completions.create(
+            model=model, messages=_prompt_mode_messages(messages, response_model), **kwargs
+        )
+        return _parse_prompt_mode(completion, response_model)
+    # instructor 内部不再重试，重试由外层统一计数
+    return client.chat.completions.create(
+        model=model, response_model=response_model, messages=messages, max_retries=1, **kwargs
+    )
+
+
+async def _acall_once(client, mode, model, response_model, messages, kwargs):
+    if mode == "prompt":
+        completion = await client.chat.completions.create(
+            model=model, messages=_prompt_mode_messages(messages, response_model), **kwargs
+        )
+        return _parse_prompt_mode(completion, response_model)
+    return await client.chat.completions.create(
+        model=model, response_model=response_model, messages=messages, max_retries=1, **kwargs
+    )
+
+
+def _is_validation_error(e):
+    from pydantic import ValidationError
+
+    # pydantic 的 ValidationError、JSON 解析失败都是 ValueError
+    if isinstance(e, (ValidationError, ValueError)):
+        return True
+    # instructor 把最后一次 ValidationError 包在 InstructorRetryException 里
+    return type(e).__name__ == "InstructorRetryException"
+
+
+def structured_create(client, model, response_model, messages, max_retries=1, **kwargs):
+    """
+    按模型配置的模式做一次结构化调用。
+    max_retries 与原来 instructor 的语义一致 (总共最多尝试几次)；
+    校验失败时把错误信息追加到对话里重新请求，每次尝试都会计入统计。
+    端点错误 (网络 / 5xx) 原样抛出，交给熔断器处理。
+    """
+    mode = mode_for(model)
+    schema = response_model.__name__
+    target = _client_for(client, mode)
+    STRUCTURED_STATS.incr(model, schema, mode, "calls")
+
+    messages = list(messages)
+    last_error = None
+    for attempt in range(max(1, max_retries)):
+        if attempt:
+            DASHBOARD.call_retry(model)
+        STRUCTURED_STATS.incr(model, schema, mode, "attempts")
+        try:
+            with span("attempt", "structured", model=model, schema=schema, mode=mode, attempt=attempt + 1):
+                result = _call_once(target, mode, model, response_model, messages, kwargs)
+        except Exception as e:
+            if not _is_validation_error(e):
+                STRUCTURED_STATS.incr(model, schema, mode, "errors")
+                raise
+            STRUCTURED_STATS.incr(model, schema, mode, "validation_failures")
+            last_error = e
+            messages = messages + [{"role": "user", "content": REASK_TEMPLATE.format(error=str(e)[:1000])}]
+            continue
+        STRUCTURED_STATS.incr(model, schema, mode, "successes")
+        return result
+
+    STRUCTURED_STATS.incr(model, schema, mode, "exhausted")
+    raise last_error
+
+
+async def async_structured_create(client, model, response_model, messages, max_retries=1, **kwargs):
+    """structured_create 的异步版本 (client 为 AsyncOpenAI)，重试与统计逻辑相同"""
+    mode = mode_for(model)
+    schema = response_model.__name__
+    target = _client_for(client, mode)
+    STRUCTURED_STATS.incr(model, schema, mode, "calls")
+
+    messages = list(messages)
+    last_error = None
+    for attempt in range(max(1, max_retries)):
+        if attempt:
+            DASHBOARD.call_retry(model)
+        STRUCTURED_STATS.incr(model, schema, mode, "attempts")
+        try:
+            with span("attempt", "structured", model=model, schema=schema, mode=mode, attempt=attempt + 1):
+                result = await _acall_once(target, mode, model, response_model, messages, kwargs)
+        except Exception as e:
+            if not _is_validation_error(e):
+                STRUCTURED_STATS.incr(model, schema, mode, "errors")
+                raise
+            STRUCTURED_STATS.incr(model, schema, mode, "validation_failures")
+            last_error = e
+            messages = messages + [{"role": "user", "content": REASK_TEMPLATE.format(error=str(e)[:1000])}]
+            continue
+        STRUCTURED_STATS.incr(model, schema, mode, "successes")
+        return result
+
+    STRUCTURED_STATS.incr(model, schema, mode, "exhausted")
+    raise last_error
@@ -0,0 +1,138 @@
+import re
+
+from utils.json_fix_utils import clean_text
+
+# ============================
+# 裁判输入压缩 (长对话 / 未解析的原始输出)
+# ============================
+JUDGE_INPUT_MAX_TOKENS = 6000  # 超过这个估算 token 数才做首尾截断
+HEAD_RATIO = 0.4               # 截断时保留开头的比例，其余留给结尾
+MIN_BOILERPLATE_CHARS = 20     # 只对足够长的重复行去重，避免误伤"哼""嗯"这类短回复
+MIN_RECORDED_SAVING = 20       # 某一步省下的估算 token 少于这个数时不写进压缩记录 (几乎每条都有的零星空白不算)
+
+# 裁判看到的文本格式版本；裁判打分缓存的指纹包含它，压缩规则改变时加一，让旧缓存有意失效
+# 1: 开始压缩裁判输入 (此前的缓存按未压缩的原文计算指纹，全部失效)
+JUDGE_INPUT_VERSION = 1
+
+_CJK = re.compile(r"[\u3000-\u303f\u3400-\u4dbf\u4e00-\u9fff\uff00-\uffef]")
+_ROLE_PREFIX = re.compile(r"^(【[^】]{1,10}】\s*[:：]?|(?:User|AiMe)\s*[:：])\s*")
+
+
+def estimate_tokens(text):
+    """
+    本地粗估 token 数，不调用 tokenizer：
+    中文 (含全角标点) 大约 1 字 1 token，其余字符大约 4 个 1 token。
+    """
+    if not text:
+        return 0
+    cjk = len(_CJK.findall(text))
+    other = len(text) - cjk - text.count(" ") - text.count("\n")
+    return cjk + max(0, other) // 4 + 1
+
+
+def _saved_tokens(before, after):
+    """
+    某一步省下的估算 token 数。estimate_tokens 不计空白，
+    这里把删掉的空白也按非中文字符 4 个 1 token 算上。
+    """
+    blank = lambda t: t.count(" ") + t.count("\n")
+    return max(0, estimate_tokens(before) - estimate_tokens(after)) + max(0, blank(before) - blank(after)) // 4
+
+
+def normalize_whitespace(text):
+    text = clean_text(text)
+    text = re.sub(r"[ \u00a0]+", " ", text)
+    text = re.sub(r" *\n *", "\n", text)
+    return re.sub(r"\n{3,}", "\n\n", text)
+
+
+def drop_duplicate_lines(text, min_chars=MIN_BOILERPLATE_CHARS):
+    """
+    后面再出现的、完全相同的长行只保留角色前缀，内容换成占位说明。
+    重复本身也是质量问题，所以保留"这里重复了"的信号给裁判。
+    """
+    seen = set()
+    lines, dropped = [], 0
+    for line in text.split("\n"):
+        match = _ROLE_PREFIX.match(line)
+        prefix = match.group(0) if match else ""
+        body = line[len(prefix):].strip()
+        if len(body) >= min_chars and body in seen:
+            lines.append(f"{prefix}（与前文重复，已省略）")
+            dropped += 1
+            continue
+        if len(body) >= min_chars:
+            seen.add(body)
+        lines.append(line)
+    return "\n".join(lines), dropped
+
+
+def head_tail(text, max_tokens, head_ratio=HEAD_RATIO):
+    """按行保留开头和结尾，中间换成省略说明；返回 (文本, 省略的字符数)"""
+    lines = text.split("\n")
+    head_budget = int(max_tokens * head_ratio)
+    tail_budget = max_tokens - head_budget
+
+    head, used = [], 0
+    for line in lines:
+        cost = estimate_tokens(line)
+        if used + cost > head_budget:
+            break
+        head.append(line)
+        used += cost
+
+    tail, used = [], 0
+    for line in reversed(lines[len(head):]):
+        cost = estimate_tokens(line)
+        if used + cost > tail_budget:
+            break
+        tail.append(line)
+        used += cost
+    tail.reverse()
+
+    # 单行就超预算 (例如没有换行的原始输出)：按平均每 token 字符数换算后直接按字符截
+    if not head and not tail:
+        chars = max(1, int(max_tokens * len(text) / estimate_tokens(text)))
+        head_chars = int(chars * head_ratio)
+        omitted = len(text) - chars
+        return f"{text[:head_chars]}\n……（中间省略约 {omitted} 字）……\n{text[-(chars - head_chars):]}", omitted
+
+    middle = lines[len(head):len(lines) - len(tail)]
+    if not middle:
+        return text, 0
+    omitted = sum(len(line) + 1 for line in middle)
+    return "\n".join(head + [f"……（中间省略 {len(middle)} 行，约 {omitted} 字）……"] + tail), omitted
+
+
+def compact_for_judge(text, max_tokens=JUDGE_INPUT_MAX_TOKENS):
+    """
+    送给裁判之前的压缩：空白规整 -> 重复长行去重 -> 超预算时首尾保留。
+    返回 (压缩后的文本, 压缩记录)，记录写回样本，方便事后核对裁判看到的是什么；
+    steps 里只记省下至少 MIN_RECORDED_SAVING 个 token 的步骤。
+    """
+    original_tokens = estimate_tokens(text)
+    steps = []
+
+    compacted = normalize_whitespace(text)
+    if _saved_tokens(text, compacted) >= MIN_RECORDED_SAVING:
+        steps.append("whitespace")
+
+    deduped, dropped = drop_duplicate_lines(compacted)
+    if dropped and _saved_tokens(compacted, deduped) >= MIN_RECORDED_SAVING:
+        steps.append("dedup")
+    compacted = deduped
+
+    omitted = 0
+    if estimate_tokens(compacted) > max_tokens:
+        compacted, omitted = head_tail(compacted, max_tokens)
+        if omitted:
+            steps.append("head_tail")
+
+    return compacted, {
+        "steps": steps,
+        "original_tokens": original_tokens,
+        "compacted_tokens": estimate_tokens(compacted),
+        "max_tokens": max_tokens,
+        "duplicate_lines": dropped,
+        "omitted_chars": omitted,
+    }
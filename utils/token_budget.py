@@ -0,0 +1,106 @@
+import os
+import json
+import math
+import threading
+from collections import deque
+from pathlib import Path
+
+# ============================
+# max_tokens 自适应配置
+# ============================
+DEFAULT_STATS_FILE = "outputs/.token_stats.json"
+PERCENTILE = 0.95     # 按历史输出长度的 p95 设定预算
+HEADROOM = 0.25       # 在 p95 基础上再留 25% 余量
+MIN_SAMPLES = 20      # 样本太少时沿用调用方给的默认值
+MIN_TOKENS = 256      # 预算下限
+MAX_TOKENS_CAP = 8192 # 截断重试时的预算上限
+WINDOW = 500          # 每个 (模型, prompt) 只保留最近这么多条样本
+
+
+def percentile(values, q):
+    """简单的分位数 (线性插值)，避免依赖 numpy"""
+    if not values:
+        return 0
+    ordered = sorted(values)
+    pos = (len(ordered) - 1) * q
+    lo, hi = math.floor(pos), math.ceil(pos)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (pos - lo)
+
+
+class TokenBudget:
+    """
+    按 (模型, prompt) 记录 usage.completion_tokens，
+    给之后的调用推荐一个 "够用但不过量" 的 max_tokens。
+    """
+
+    def __init__(self, path=DEFAULT_STATS_FILE, persist=True):
+        self.path = path
+        # persist=False 时只读取历史统计，退出时不写回 (例如 cassette 回放)
+        self.persist = persist
+        self.lock = threading.Lock()
+        self.samples = {}
+        self.truncated = {}
+        self.session = 0   # 本次运行新记录的样本数
+        if path and os.path.exists(path):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    saved = json.load(f)
+                for key, item in saved.items():
+                    self.samples[key] = deque(item.get("samples", []), maxlen=WINDOW)
+                    self.truncated[key] = item.get("truncated", 0)
+            except (json.JSONDecodeError, OSError):
+                print(f"Warning: 无法读取 token 统计文件: {path}")
+
+    @staticmethod
+    def _key(model, prompt_key):
+        return f"{model}::{prompt_key or 'default'}"
+
+    def record(self, model, prompt_key, completion_tokens, truncated=False):
+        if not completion_tokens:
+            return
+        key = self._key(model, prompt_key)
+        with self.lock:
+            self.samples.setdefault(key, deque(maxlen=WINDOW)).append(int(completion_tokens))
+            self.session += 1
+            if truncated:
+                self.truncated[key] = self.truncated.get(key, 0) + 1
+
+    def suggest(self, model, prompt_key, default):
+        """样本足够时返回 p95 * (1 + HEADROOM)，并限制在 [MIN_TOKENS, default] 之间"""
+        key = self._key(model, prompt_key)
+        with self.lock:
+            values = list(self.samples.get(key, ()))
+        if len(values) < MIN_SAMPLES:
+            return default
+        budget = int(percentile(values, PERCENTILE) * (1 + HEADROOM))
+        return max(MIN_TOKENS, min(default, budget))
+
+    @staticmethod
+    def grow(max_tokens):
+        """被截断 (finish_reason=length) 后重试用的更大预算"""
+        return min(MAX_TOKENS_CAP, max(max_tokens * 2, MIN_TOKENS))
+
+    def summary(self):
+        with self.lock:
+            return {
+                key: {
+                    "count": len(values),
+                    "p50": percentile(list(values), 0.5),
+                    "p95": percentile(list(values), PERCENTILE),
+                    "truncated": self.truncated.get(key, 0),
+                }
+                for key, values in self.samples.items()
+            }
+
+    def save(self):
+        # 本次运行没有发生调用 (--help / --dry-run 等) 时不重写统计文件
+        if not self.path or not self.persist or not self.session:
+            return
+        with self.lock:
+            data = {
+                key: {"samples": list(values), "truncated": self.truncated.get(key, 0)}
+                for key, values in self.samples.items()
+            }
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
@@ -0,0 +1,169 @@
+import os
+import sys
+import json
+import time
+import atexit
+import asyncio
+import threading
+import functools
+from pathlib import Path
+
+# ============================
+# 轻量级 span 追踪，导出 Chrome trace-event JSON (可在 Perfetto / chrome://tracing 打开)
+# ============================
+# 开启方式: COT_TRACE=1 python step4_whole_judge.py
+#   或指定输出文件: COT_TRACE=outputs/traces/judge.json
+# 未开启时 span() 返回同一个空上下文，traced() 只多一次属性判断。
+TRACE_ENV = "COT_TRACE"
+TRACE_DIR = "outputs/traces"
+MAX_TRACE_EVENTS = 500000  # 超过后丢弃新事件，避免超长运行把内存吃满
+SLEEP_SCALE = 1.0          # 固定等待的倍数；cassette 回放时设为 0
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **args):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    def __init__(self, tracer, name, cat, args):
+        self.tracer = tracer
+        self.name = name
+        self.cat = cat
+        self.args = args
+
+    def __enter__(self):
+        self.tid = _track_id()
+        self.start = time.perf_counter()
+        return self
+
+    def set(self, **args):
+        """span 结束前补充参数，例如调用结果的状态码"""
+        self.args.update(args)
+
+    def __exit__(self, exc_type, exc, tb):
+        end = time.perf_counter()
+        if exc_type is not None:
+            self.args["error"] = exc_type.__name__
+        self.tracer.add({
+            "name": self.name,
+            "cat": self.cat,
+            "ph": "X",
+            "ts": self.tracer.micros(self.start),
+            "dur": round((end - self.start) * 1e6, 1),
+            "pid": self.tracer.pid,
+            "tid": self.tid,
+            "args": self.args,
+        })
+        return False
+
+
+def _track_id():
+    """同一线程里并发的 asyncio 任务各占一条轨道，否则它们的 span 会互相交叠"""
+    if asyncio._get_running_loop() is not None:
+        task = asyncio.current_task()
+        if task is not None:
+            return id(task)
+    return threading.get_ident()
+
+
+class Tracer:
+    def __init__(self, output_path=None):
+        self.output_path = output_path
+        self.enabled = bool(output_path)
+        self.pid = os.getpid()
+        self.origin = time.perf_counter()
+        self.lock = threading.Lock()
+        self.events = []
+        self.dropped = 0
+        self.track_names = {}
+
+    def micros(self, t):
+        return round((t - self.origin) * 1e6, 1)
+
+    def add(self, event):
+        with self.lock:
+            if len(self.events) >= MAX_TRACE_EVENTS:
+                self.dropped += 1
+                return
+            self.events.append(event)
+            tid = event["tid"]
+            if tid not in self.track_names:
+                thread = threading.current_thread()
+                self.track_names[tid] = thread.name if tid == thread.ident else f"{thread.name} / asyncio 任务"
+
+    def span(self, name, cat="", **args):
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name, cat, args)
+
+    def export(self):
+        with self.lock:
+            events = list(self.events)
+            tracks = dict(self.track_names)
+        meta = [{"name": "process_name", "ph": "M", "pid": self.pid, "args": {"name": os.path.basename(sys.argv[0]) or "python"}}]
+        meta += [{"name": "thread_name", "ph": "M", "pid": self.pid, "tid": tid, "args": {"name": name}}
+                 for tid, name in tracks.items()]
+        return {"traceEvents": meta + events, "displayTimeUnit": "ms", "otherData": {"dropped_events": self.dropped}}
+
+    def save(self, path=None):
+        path = path or self.output_path
+        if not self.enabled or not path or not self.events:
+            return
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.export(), f, ensure_ascii=False)
+        # 这时 stdout 可能已被实时面板接管，直接写 stderr
+        print(f"🧵 trace 已导出: {path} ({len(self.events)} 个 span)", file=sys.stderr)
+
+
+def _default_output_path():
+    value = os.environ.get(TRACE_ENV, "")
+    if not value or value == "0":
+        return None
+    if value == "1":
+        script = os.path.splitext(os.path.basename(sys.argv[0]))[0] or "run"
+        return os.path.join(TRACE_DIR, f"{script}_{time.strftime('%Y%m%d_%H%M%S')}.json")
+    return value
+
+
+# 进程内共享的一份 tracer，退出时导出
+TRACER = Tracer(_default_output_path())
+atexit.register(TRACER.save)
+
+
+def span(name, cat="", **args):
+    return TRACER.span(name, cat, **args)
+
+
+def traced(name=None, cat="func"):
+    """函数级 span 装饰器；未开启追踪时直接调用原函数"""
+    def decorator(fn):
+        label = name or fn.__name__
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not TRACER.enabled:
+                return fn(*args, **kwargs)
+            with _Span(TRACER, label, cat, {}):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def sleep(seconds, reason=""):
+    """time.sleep 的带 span 版本：固定等待在 trace 里单独显示，方便与网络等待区分"""
+    seconds *= SLEEP_SCALE
+    if seconds <= 0:
+        return
+    with TRACER.span("sleep", "sleep", seconds=seconds, reason=reason):
+        time.sleep(seconds)
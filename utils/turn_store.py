@@ -0,0 +1,158 @@
+import os
+import json
+import shutil
+from pathlib import Path
+
+import numpy as np
+
+# ============================
+# 逐轮打分的列式 sidecar (<score_xxx.jsonl>.turns/)
+# ============================
+# 每一列一个 .npy，读取时 mmap，几百万轮也只占用实际用到的列：
+#   dialogue_id    uint32   对话在 JSONL 中的序号 (第几条记录)
+#   turn_index     int16    轮次 (从 1 开始)
+#   score          float32  分数；裁判出错的轮次记为 NaN
+#   model          int16    模型编码 -> meta.json 里的 models
+#   category       int16    类别编码 -> meta.json 里的 categories
+#   record_offset  uint64   该对话在 JSONL 中的字节偏移，需要原文时按偏移读一行，不再复制文本
+# meta.json 记录数据文件的大小 + mtime_ns，JSONL 变了 sidecar 就视为过期。
+STORE_SUFFIX = ".turns"
+COLUMNS = {
+    "dialogue_id": np.uint32,
+    "turn_index": np.int16,
+    "score": np.float32,
+    "model": np.int16,
+    "category": np.int16,
+    "record_offset": np.uint64,
+}
+
+
+def store_path(jsonl_path):
+    return jsonl_path + STORE_SUFFIX
+
+
+def _stamp(path):
+    st = os.stat(path)
+    return {"source_size": st.st_size, "source_mtime_ns": st.st_mtime_ns}
+
+
+def _category(sample):
+    return sample.get("category") or sample.get("scheme_type") or "unknown"
+
+
+def _turn_score(turn):
+    if turn.get("analysis") == "Error":
+        return np.nan
+    try:
+        return float(turn.get("score"))
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def _default_model(jsonl_path):
+    name = os.path.basename(jsonl_path)
+    if name.startswith("score_") and name.endswith(".jsonl"):
+        return name[len("score_"):-len(".jsonl")]
+    return "unknown"
+
+
+def write_turn_store(jsonl_path, records, offsets):
+    """
+    用刚写入 JSONL 的记录 (以及 write_jsonl 返回的每行字节偏移) 生成 sidecar。
+    只写数值列，不复制 user / AiMe 文本。
+    """
+    default_model = _default_model(jsonl_path)
+    models, categories = {}, {}
+    cols = {name: [] for name in COLUMNS}
+    for i, (sample, offset) in enumerate(zip(records, offsets)):
+        model = models.setdefault(sample.get("model", default_model), len(models))
+        category = categories.setdefault(_category(sample), len(categories))
+        for t in sample.get("turn_details", []):
+            cols["dialogue_id"].append(i)
+            cols["turn_index"].append(t.get("turn_index", 0))
+            cols["score"].append(_turn_score(t))
+            cols["model"].append(model)
+            cols["category"].append(category)
+            cols["record_offset"].append(offset)
+
+    out_dir = store_path(jsonl_path)
+    tmp_dir = out_dir + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    Path(tmp_dir).mkdir(parents=True)
+    for name, dtype in COLUMNS.items():
+        np.save(os.path.join(tmp_dir, f"{name}.npy"), np.asarray(cols[name], dtype=dtype))
+    meta = {"rows": len(cols["score"]), "models": list(models), "categories": list(categories)}
+    meta.update(_stamp(jsonl_path))
+    with open(os.path.join(tmp_dir, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2)
+    # 先写临时目录再替换，读取方不会看到写了一半的 sidecar
+    shutil.rmtree(out_dir, ignore_errors=True)
+    os.replace(tmp_dir, out_dir)
+    return meta["rows"]
+
+
+def build_turn_store(jsonl_path):
+    """从已有的 score_*.jsonl 重建 sidecar (旧文件或 JSONL 被改动过时使用)"""
+    records, offsets = [], []
+    with open(jsonl_path, "rb") as f:
+        pos = 0
+        for line in f:
+            if line.strip():
+                try:
+                    sample = json.loads(line)
+                except json.JSONDecodeError:
+                    sample = None
+                if sample is not None:
+                    # 只保留建列需要的字段，避免把整份文本留在内存里
+                    records.append({
+                        "model": sample.get("model", _default_model(jsonl_path)),
+                        "category": _category(sample),
+                        "turn_details": [{"turn_index": t.get("turn_index", 0), "score": t.get("score"),
+                                          "analysis": "Error" if t.get("analysis") == "Error" else ""}
+                                         for t in sample.get("turn_details", [])],
+                    })
+                    offsets.append(pos)
+            pos += len(line)
+    return write_turn_store(jsonl_path, records, offsets)
+
+
+class TurnStore:
+    """按列 mmap 读取的逐轮打分；labels 把编码还原成字符串"""
+
+    def __init__(self, jsonl_path):
+        self.jsonl_path = jsonl_path
+        self.dir = store_path(jsonl_path)
+        with open(os.path.join(self.dir, "meta.json"), "r", encoding="utf-8") as f:
+            self.meta = json.load(f)
+        self.labels = {"model": self.meta["models"], "category": self.meta["categories"]}
+        for name in COLUMNS:
+            setattr(self, name, np.load(os.path.join(self.dir, f"{name}.npy"), mmap_mode="r"))
+
+    def __len__(self):
+        return self.meta["rows"]
+
+    def text(self, row):
+        """取第 row 行对应轮次的原文 {"user", "aime", "analysis"}，按字节偏移只读一行"""
+        with open(self.jsonl_path, "rb") as f:
+            f.seek(int(self.record_offset[row]))
+            sample = json.loads(f.readline())
+        for t in sample.get("turn_details", []):
+            if t.get("turn_index") == int(self.turn_index[row]):
+                return {"user": t.get("user"), "aime": t.get("aime"), "analysis": t.get("analysis")}
+        return None
+
+
+def is_fresh(jsonl_path):
+    meta_path = os.path.join(store_path(jsonl_path), "meta.json")
+    if not os.path.exists(meta_path):
+        return False
+    with open(meta_path, "r", encoding="utf-8") as f:
+        meta = json.load(f)
+    return all(meta.get(k) == v for k, v in _stamp(jsonl_path).items())
+
+
+def load_turn_store(jsonl_path, rebuild=False):
+    """打开 sidecar；不存在或已过期时先从 JSONL 重建"""
+    if rebuild or not is_fresh(jsonl_path):
+        build_turn_store(jsonl_path)
+    return TurnStore(jsonl_path)
@@ -1,38 +1,112 @@
 import json
 import sys
 import os
+import time
+import argparse
 
-def view_pretty(file_path):
+from utils.jsonl_index import JsonlIndex, iter_matches
+
+DEFAULT_PAGE_SIZE = 10
+
+
+def _print_record(i, data, fields=None):
+    if fields:
+        data = {k: data.get(k) for k in fields}
+    print(f"📄 第 {i+1} 条数据:")
+    # 【关键】indent=4 让它缩进显示，ensure_ascii=False 让中文正常显示
+    print(json.dumps(data, indent=4, ensure_ascii=False))
+    print("-" * 60)
+
+
+def view_pretty(file_path, page=1, page_size=DEFAULT_PAGE_SIZE, at=None, where=None, search=None,
+                search_field="dialogue_content", fields=None, count=False, rebuild=False):
+    """
+    分页查看大 JSONL 文件：
+    - 第一次打开时在文件旁边建立 .idx 字节偏移索引，之后直接 mmap 随机访问
+    - at:     直接跳到第 N 条 (从 1 开始)
+    - where:  字段过滤，例如 'model == "deepseek-r1" and holistic_score < 5'
+    - search: 在 search_field (默认 dialogue_content) 里做子串搜索
+    """
     print(f"正在查看文件: {file_path}")
     print("=" * 60)
-    
+
     if not os.path.exists(file_path):
         print("❌ 文件不存在")
         return
 
+    start_time = time.time()
     try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            for i, line in enumerate(f):
-                if not line.strip(): continue
-                # 把每一行（那一大长串）解析回 JSON 对象
-                data = json.loads(line)
-                
-                print(f"📄 第 {i+1} 条数据:")
-                # 【关键】indent=4 让它缩进显示，ensure_ascii=False 让中文正常显示
-                print(json.dumps(data, indent=4, ensure_ascii=False))
-                print("-" * 60)
-                
-                # 如果只想看前几条，可以在这里加 break
-                # if i >= 2: break 
+        with JsonlIndex(file_path, rebuild=rebuild) as index:
+            total = len(index)
+            print(f"共 {total} 条记录 (索引耗时 {time.time() - start_time:.2f}s)")
+
+            if at is not None:
+                if not 1 <= at <= total:
+                    print(f"❌ 超出范围: 1 ~ {total}")
+                    return
+                _print_record(at - 1, index.get(at - 1), fields)
+                return
+
+            if count:
+                n = sum(1 for _ in iter_matches(index, where, search, search_field))
+                print(f"🔎 符合条件: {n} 条 (耗时 {time.time() - start_time:.2f}s)")
+                return
+
+            # 没有过滤条件时直接按编号切页；有条件时惰性匹配，只解析到当前页为止
+            skip = (page - 1) * page_size
+            if where is None and search is None:
+                matches = ((i, index.get(i)) for i in range(skip, min(skip + page_size, total)))
+            else:
+                matches = _page(iter_matches(index, where, search, search_field), skip, page_size)
+
+            shown = 0
+            for i, data in matches:
+                _print_record(i, data, fields)
+                shown += 1
+
+            if shown == 0:
+                print("（这一页没有数据）")
+            else:
+                print(f"第 {page} 页，显示 {shown} 条 (耗时 {time.time() - start_time:.2f}s)"
+                      f"  下一页: --page {page + 1}")
+    except ValueError as e:
+        print(f"❌ {e}")
     except Exception as e:
         print(f"读取出错: {e}")
 
+
+def _page(matches, skip, size):
+    for n, item in enumerate(matches):
+        if n >= skip + size:
+            return
+        if n >= skip:
+            yield item
+
+
 if __name__ == "__main__":
     # 默认查看 Step 3 的抽取结果
-    target_file = "outputs/extracted/extracted_data.jsonl"
-    
-    # 也可以通过命令行参数指定文件
-    if len(sys.argv) > 1:
-        target_file = sys.argv[1]
-        
-    view_pretty(target_file)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="分页查看 JSONL 输出文件")
+    parser.add_argument("file", nargs="?", default="outputs/extracted/extracted_data.jsonl")
+    parser.add_argument("--page", type=int, default=1)
+    parser.add_argument("--page-size", type=int, default=DEFAULT_PAGE_SIZE)
+    parser.add_argument("--at", type=int, default=None, help="直接查看第 N 条 (从 1 开始)")
+    parser.add_argument("--where", default=None, help='字段过滤，例如 \'model == "deepseek-r1" and holistic_score < 5\'')
+    parser.add_argument("--search", default=None, help="子串搜索")
+    parser.add_argument("--search-field", default="dialogue_content")
+    parser.add_argument("--fields", default=None, help="只显示这些字段 (逗号分隔)")
+    parser.add_argument("--count", action="store_true", help="只统计符合条件的条数")
+    parser.add_argument("--reindex", action="store_true", help="强制重建 .idx 索引")
+    args = parser.parse_args()
+
+    view_pretty(
+        args.file,
+        page=max(1, args.page),
+        page_size=args.page_size,
+        at=args.at,
+        where=args.where,
+        search=args.search,
+        search_field=args.search_field,
+        fields=args.fields.split(",") if args.fields else None,
+        count=args.count,
+        rebuild=args.reindex,
+    )
@@ -0,0 +1,310 @@
+"""
+worker.py
+基于 SQLite 任务表的多 worker / 多机执行入口
+
+把生成和打分拆成一条条任务放进共享的任务表 (utils/job_queue.py)，
+任意多个 worker 从表里领取任务执行；某个 worker 挂掉，它手上的任务在租约过期后会被别人接走。
+
+使用方法：
+    # 1. 入队 (重复执行不会重复入队)
+    python worker.py enqueue gen_batch --rounds 10
+    python worker.py enqueue gen_selfplay
+    python worker.py enqueue judge_whole
+    python worker.py enqueue score_turns
+    python worker.py enqueue eval_cell
+
+    # 2. 在一台或多台机器上启动 worker (指向同一个 --db)
+    python worker.py run --kinds gen_batch,gen_selfplay --threads 4
+
+    # 3. 查看进度 / 导出结果
+    python worker.py status
+    python worker.py export --kind gen_batch
+"""
+
+import os
+import sys
+import glob
+import time
+import socket
+import argparse
+import threading
+from datetime import datetime
+
+from step0_config import DEFAULT_RAW_DIR, DEFAULT_JUDGED_DIR
+from utils.file_utils import load_questions, read_jsonl, write_jsonl
+from utils.job_queue import JobQueue, DEFAULT_DB_PATH, DEFAULT_LEASE_SECONDS
+
+QUESTIONS_FILE = "inputs/questions.txt"
+POLL_SECONDS = 5  # 没有任务可领时的轮询间隔
+
+
+class DeferJob(Exception):
+    """任务暂时无法执行 (例如模型熔断)，延后重新入队，不计失败次数"""
+
+    def __init__(self, delay_seconds):
+        super().__init__(f"deferred {delay_seconds:.0f}s")
+        self.delay_seconds = delay_seconds
+
+
+# ================= 各类任务的执行函数 =================
+# 模块都在函数内导入：只跑打分的 worker 不需要加载生成脚本，反之亦然
+
+_generators = {}
+_generators_lock = threading.Lock()
+
+
+def handle_gen_batch(payload):
+    from step1_gen_batch import MODELS_CONFIG, MultiModelGenerator, build_record
+    from utils.circuit_breaker import get_breaker
+
+    name = payload["model_name"]
+    with _generators_lock:
+        if name not in _generators:
+            config = next(c for c in MODELS_CONFIG if c["name"] == name)
+            _generators[name] = MultiModelGenerator(config)
+    generator = _generators[name]
+
+    messages = generator.generate_single_dialogue(payload["question"])
+    if messages is None:
+        raise DeferJob(get_breaker(generator.model).retry_after() or POLL_SECONDS)
+    if not messages:
+        raise RuntimeError("生成失败")
+    return build_record(payload["question"], messages, name, payload["generation_round"])
+
+
+def handle_gen_selfplay(payload):
+    from step1_gen_selfplay import build_agents, run_selfplay_dialogue
+
+    user_bot, aime_bot = build_agents()
+    return run_selfplay_dialogue(payload["question"], user_bot, aime_bot)
+
+
+def handle_judge_whole(payload):
+    from step4_whole_judge import judge_sample
+    from utils.api_utils import get_judge_client
+
+    scored, _ = judge_sample(get_judge_client(), payload["sample"])
+    if scored is not None and str(scored["holistic_analysis"]).startswith("Error"):
+        raise RuntimeError(scored["holistic_analysis"])
+    return scored
+
+
+def handle_score_turns(payload):
+    from step4_score_turns import score_sample
+    from utils.api_utils import get_judge_client
+
+    scored = score_sample(get_judge_client(), payload["sample"])
+    # 任何一轮裁判出错都让任务失败，交给队列重试 / 死信，不把 0 分当成真实分数导出
+    failed = [t["turn_index"] for t in (scored or {}).get("turn_details", []) if t["analysis"] == "Error"]
+    if failed:
+        raise RuntimeError(f"第 {', '.join(map(str, failed))} 轮打分出错")
+    return scored
+
+
+def handle_eval_cell(payload):
+    from step_eval_full_new import PROMPTS, MODELS, JUDGE_FAILURES, run_eval_cell
+    from utils.circuit_breaker import get_breaker
+
+    model = next(m for m in MODELS if m["name"] == payload["model_name"])
+    os.makedirs(payload["output_dir"], exist_ok=True)
+    result = run_eval_cell(payload["prompt_name"], PROMPTS[payload["prompt_name"]], model, payload["output_dir"])
+    if result is None:
+        raise DeferJob(get_breaker(model["model_id"]).retry_after() or POLL_SECONDS)
+    # 裁判失败给的 0 分不是真实分数，让任务失败重试 (与 judge_whole / score_turns 一致)
+    if result["comment"] in JUDGE_FAILURES:
+        raise RuntimeError(result["comment"])
+    return result
+
+
+HANDLERS = {
+    "gen_batch": handle_gen_batch,
+    "gen_selfplay": handle_gen_selfplay,
+    "judge_whole": handle_judge_whole,
+    "score_turns": handle_score_turns,
+    "eval_cell": handle_eval_cell,
+}
+
+
+# ================= 入队 =================
+def enqueue_jobs(queue, kind, args):
+    payloads = []
+    dedup_exclude = ()
+
+    if kind == "gen_batch":
+        from step1_gen_batch import MODELS_CONFIG
+        questions = load_questions(args.questions)
+        for model_config in MODELS_CONFIG:
+            output_file = os.path.join(args.output_dir or DEFAULT_RAW_DIR, f"data_{model_config['name']}.jsonl")
+            for r in range(1, args.rounds + 1):
+                for q in questions:
+                    payloads.append({"model_name": model_config["name"], "question": q,
+                                     "generation_round": r, "output_file": output_file})
+
+    elif kind == "gen_selfplay":
+        output_file = os.path.join(args.output_dir or DEFAULT_RAW_DIR, "data_scheme_A.jsonl")
+        payloads = [{"question": q, "output_file": output_file} for q in load_questions(args.questions)]
+
+    elif kind in ("judge_whole", "score_turns"):
+        pattern, prefix = ("data_*.jsonl", "holistic_score_") if kind == "judge_whole" else ("*.jsonl", "score_")
+        for input_file in sorted(glob.glob(os.path.join(args.input_dir or DEFAULT_RAW_DIR, pattern))):
+            output_file = os.path.join(args.output_dir or DEFAULT_JUDGED_DIR,
+                                       os.path.basename(input_file).replace("data_", prefix))
+            for sample in read_jsonl(input_file):
+                payloads.append({"sample": sample, "output_file": output_file})
+
+    elif kind == "eval_cell":
+        from step_eval_full_new import PROMPTS, MODELS
+        output_dir = args.output_dir or f"outputs/eval_full/{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+        payloads = [{"prompt_name": p, "model_name": m["name"], "output_dir": output_dir}
+                    for p in PROMPTS for m in MODELS]
+        # 默认输出目录带时间戳，每次入队都不同，不参与去重；目录由 worker 执行时创建
+        dedup_exclude = ("output_dir",)
+
+    added = queue.enqueue_many(kind, payloads, priority=args.priority, dedup_exclude=dedup_exclude)
+    print(f"📥 [{kind}] 新入队 {added} 个任务 (共 {len(payloads)} 个，重复的已忽略)")
+
+
+# ================= worker 循环 =================
+def _run_one(queue, job, worker_id, lease_seconds):
+    handler = HANDLERS[job["kind"]]
+
+    # 执行期间定期续租，防止长任务被别的 worker 抢走
+    stop = threading.Event()
+
+    def keep_alive():
+        while not stop.wait(lease_seconds / 3):
+            if not queue.heartbeat(job["id"], worker_id, lease_seconds):
+                return
+
+    heartbeat = threading.Thread(target=keep_alive, daemon=True)
+    heartbeat.start()
+    try:
+        result = handler(job["payload"])
+    except DeferJob as e:
+        queue.defer(job["id"], worker_id, e.delay_seconds)
+        print(f"  ⏳ [{worker_id}] 任务 {job['id']} ({job['kind']}) 延后 {e.delay_seconds:.0f}s")
+        return
+    except Exception as e:
+        queue.fail(job["id"], worker_id, f"{type(e).__name__}: {e}")
+        print(f"  ❌ [{worker_id}] 任务 {job['id']} ({job['kind']}) 第 {job['attempts']} 次失败: {e}")
+        return
+    finally:
+        stop.set()
+
+    if queue.ack(job["id"], worker_id, result):
+        print(f"  ✅ [{worker_id}] 任务 {job['id']} ({job['kind']}) 完成")
+    else:
+        print(f"  ⚠️ [{worker_id}] 任务 {job['id']} 租约已失效，结果丢弃")
+
+
+def worker_loop(db_path, worker_id, kinds, lease_seconds, idle_exit):
+    queue = JobQueue(db_path)
+    while True:
+        job = queue.lease(worker_id, kinds, lease_seconds)
+        if job is None:
+            if idle_exit and not _has_open_jobs(queue, kinds):
+                return
+            time.sleep(POLL_SECONDS)
+            continue
+        _run_one(queue, job, worker_id, lease_seconds)
+
+
+def _has_open_jobs(queue, kinds):
+    for kind, counts in queue.stats().items():
+        if kinds and kind not in kinds:
+            continue
+        if counts.get("pending") or counts.get("leased"):
+            return True
+    return False
+
+
+# ================= 导出 =================
+def export_results(queue, kind):
+    if kind == "eval_cell":
+        print("ℹ️ eval_cell 的对话与打分文件已由 worker 直接写入各自的 output_dir")
+        return
+
+    grouped = {}
+    for payload, result in queue.results(kind):
+        if result is not None:
+            grouped.setdefault(payload["output_file"], []).append(result)
+    if not grouped:
+        print(f"❌ [{kind}] 还没有已完成的任务")
+        return
+    for output_file, records in grouped.items():
+        offsets = write_jsonl(records, output_file)
+        if kind == "score_turns":
+            # 与 step4_score_turns 一样写逐轮分数的列式 sidecar，step6 直接读取
+            from step4_score_turns import write_turn_sidecar
+            write_turn_sidecar(output_file, records, offsets)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="SQLite 任务队列 worker")
+    parser.add_argument("--db", default=DEFAULT_DB_PATH, help="任务表路径 (多机时放在共享存储上)")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_enqueue = sub.add_parser("enqueue", help="把一批任务放进队列")
+    p_enqueue.add_argument("kind", choices=sorted(HANDLERS))
+    p_enqueue.add_argument("--questions", default=QUESTIONS_FILE)
+    p_enqueue.add_argument("--rounds", type=int, default=10, help="gen_batch: 每个模型每个问题生成次数")
+    p_enqueue.add_argument("--input-dir", default=None)
+    p_enqueue.add_argument("--output-dir", default=None)
+    p_enqueue.add_argument("--priority", type=int, default=0, help="数值越大越先执行")
+
+    p_run = sub.add_parser("run", help="启动 worker")
+    p_run.add_argument("--kinds", default="", help="只领取这些类型 (逗号分隔)，默认全部")
+    p_run.add_argument("--worker-id", default=f"{socket.gethostname()}-{os.getpid()}")
+    p_run.add_argument("--threads", type=int, default=1)
+    p_run.add_argument("--lease", type=int, default=DEFAULT_LEASE_SECONDS, help="租约秒数")
+    p_run.add_argument("--idle-exit", action="store_true", help="队列里没有待办任务时退出")
+
+    sub.add_parser("status", help="查看各类任务的状态统计")
+
+    p_export = sub.add_parser("export", help="把已完成任务的结果写回 JSONL")
+    p_export.add_argument("--kind", required=True, choices=sorted(HANDLERS))
+
+    p_retry = sub.add_parser("retry-dead", help="把失败次数用完的任务重新放回队列")
+    p_retry.add_argument("--kind", default=None)
+
+    args = parser.parse_args()
+    queue = JobQueue(args.db)
+
+    if args.command == "enqueue":
+        enqueue_jobs(queue, args.kind, args)
+
+    elif args.command == "run":
+        kinds = [k for k in args.kinds.split(",") if k] or None
+        unknown = set(kinds or []) - set(HANDLERS)
+        if unknown:
+            print(f"❌ 未知任务类型: {', '.join(sorted(unknown))}")
+            sys.exit(1)
+        print(f"👷 worker {args.worker_id} 启动 | 线程 {args.threads} | 类型 {kinds or '全部'} | 数据库 {args.db}")
+        threads = [
+            threading.Thread(target=worker_loop,
+                             args=(args.db, f"{args.worker_id}-{i}", kinds, args.lease, args.idle_exit))
+            for i in range(args.threads)
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        print(f"✅ worker {args.worker_id} 退出")
+
+    elif args.command == "status":
+        stats = queue.stats()
+        if not stats:
+            print("队列为空")
+        for kind, counts in sorted(stats.items()):
+            summary = " | ".join(f"{status}: {n}" for status, n in sorted(counts.items()))
+            print(f"  {kind:<13} {summary}")
+
+    elif args.command == "export":
+        export_results(queue, args.kind)
+
+    elif args.command == "retry-dead":
+        print(f"🔁 重新入队 {queue.retry_dead(args.kind)} 个任务")
+
+
+if __name__ == "__main__":
+    main()